@@ -1,12 +1,14 @@
 from django.contrib import admin
-from .models import Project, Prompt, ChatMessage, ProjectFile
+from . import search
+from .models import (Project, Prompt, ChatArchiveSegment, ChatMessage, ChatJob, ProjectFile, UserStats, ConversationSummary,
+                     UserRateLimit)
 
 @admin.register(Project)
 class ProjectAdmin(admin.ModelAdmin):
-    list_display = ('name', 'user', 'created_at')
+    list_display = ('name', 'user', 'message_count', 'last_activity_at', 'created_at')
     list_filter = ('created_at', 'user')
     search_fields = ('name', 'description')
-    readonly_fields = ('created_at',)
+    readonly_fields = ('created_at', 'message_count', 'archived_message_count', 'last_activity_at')
 
 @admin.register(Prompt)
 class PromptAdmin(admin.ModelAdmin):
@@ -16,13 +18,53 @@ class PromptAdmin(admin.ModelAdmin):
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ('project', 'role', 'timestamp')
+    list_display = ('project', 'role', 'model', 'latency_ms', 'timestamp')
     list_filter = ('role', 'timestamp', 'project')
     readonly_fields = ('timestamp',)
     search_fields = ('content',)
 
+    def get_search_results(self, request, queryset, search_term):
+        # The full-text index instead of a LIKE scan of every message
+        query = search.match_query(search_term)
+        if query is None:
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(id__in=search.matching_ids(query)), False
+
+@admin.register(ChatArchiveSegment)
+class ChatArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ('project', 'message_count', 'first_timestamp', 'last_timestamp', 'codec', 'raw_bytes', 'created_at')
+    list_filter = ('codec', 'project')
+    exclude = ('data',)
+    readonly_fields = ('project', 'first_timestamp', 'first_id', 'last_timestamp', 'last_id', 'message_count',
+                       'codec', 'raw_bytes', 'created_at')
+
 @admin.register(ProjectFile)
 class ProjectFileAdmin(admin.ModelAdmin):
-    list_display = ('name', 'project', 'uploaded_at')
-    list_filter = ('uploaded_at', 'project')
-    readonly_fields = ('uploaded_at',)
+    list_display = ('name', 'project', 'status', 'bytes_processed', 'size_bytes', 'chunk_count', 'uploaded_at')
+    list_filter = ('status', 'uploaded_at', 'project')
+    readonly_fields = ('uploaded_at', 'status', 'bytes_processed', 'size_bytes', 'chunk_count', 'attempts', 'error')
+
+@admin.register(UserStats)
+class UserStatsAdmin(admin.ModelAdmin):
+    list_display = ('user', 'message_count', 'last_activity_at')
+    search_fields = ('user__username',)
+    readonly_fields = ('user', 'message_count', 'last_activity_at')
+
+@admin.register(ConversationSummary)
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ('project', 'updated_at')
+    readonly_fields = ('through_timestamp', 'through_id', 'updated_at')
+
+@admin.register(UserRateLimit)
+class UserRateLimitAdmin(admin.ModelAdmin):
+    list_display = ('user', 'requests_per_minute', 'burst', 'exempt')
+    list_filter = ('exempt',)
+    search_fields = ('user__username',)
+    autocomplete_fields = ('user',)
+
+@admin.register(ChatJob)
+class ChatJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'project', 'status', 'attempts', 'latency_ms', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    readonly_fields = ('created_at', 'status', 'response', 'model', 'latency_ms', 'error', 'attempts', 'claimed_at',
+                       'finished_at')
@@ -0,0 +1,396 @@
+"""Admission control in front of the chat endpoints.
+
+A chat turn is let through only if:
+
+1. the user's and the project's token buckets each hold a token. Buckets
+   refill at `*_RATE_PER_MINUTE` up to `*_BURST` tokens; admins can give a
+   user other limits, or exempt them, with a UserRateLimit row;
+2. one of `MAX_CONCURRENT` upstream slots is free. Otherwise the request
+   takes one of `MAX_QUEUE` places in the wait queue and polls for a slot
+   for up to `MAX_WAIT` seconds, backing off from `POLL_INTERVAL` to
+   `MAX_POLL_INTERVAL`.
+
+Anything else is answered straight away with a 429 and a Retry-After
+header, so a saturated site sheds load instead of piling up workers.
+
+All state is in the coordination cache (see api/coordination.py), so
+limits hold across workers. Slots
+and queue places are counted leases (see Lease) that a turn renews while
+it streams; one that is not renewed is forgotten `SLOT_TTL` to twice
+that seconds after it was taken, so a worker killed mid-request cannot
+leak it for long. The counters need an atomic `cache.add` and
+`cache.incr`: Redis, Memcached or api.filecache.LockingFileBasedCache,
+not Django's FileBasedCache (the `api.W001` check warns).
+Bucket updates are read-modify-write without locking, like the routing
+statistics: requests racing on the same bucket may occasionally both get
+its last token.
+"""
+import asyncio
+import functools
+import math
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import chat, metrics
+from .coordination import cache
+from .models import UserRateLimit
+
+DEFAULTS = {
+    'ENABLED': True,
+    'USER_RATE_PER_MINUTE': 20,
+    'USER_BURST': 10,
+    'PROJECT_RATE_PER_MINUTE': 30,
+    'PROJECT_BURST': 15,
+    'MAX_CONCURRENT': 64,
+    'MAX_QUEUE': 128,
+    'MAX_WAIT': 5.0,
+    'POLL_INTERVAL': 0.05,
+    'MAX_POLL_INTERVAL': 0.5,
+    'SLOT_TTL': 120,
+    'LIMITS_TTL': 3600,
+    'KEY_PREFIX': 'admission',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ADMISSION', {})}
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+    def response(self):
+        metrics.registry.inc('chat_admission_rejections_total', {'reason': self.reason})
+        response = JsonResponse({'error': 'Too many requests, please retry shortly.', 'reason': self.reason},
+                                status=429)
+        response['Retry-After'] = str(self.retry_after)
+        return response
+
+
+def _limits_key(config, user_id):
+    return f"{config['KEY_PREFIX']}:limits:{user_id}"
+
+
+def user_limits(config, user_id):
+    """(requests per minute, burst, exempt) for a user, cached."""
+    limits = cache.get(_limits_key(config, user_id))
+    if limits is None:
+        row = UserRateLimit.objects.filter(user_id=user_id).first()
+        limits = (
+            row.requests_per_minute if row and row.requests_per_minute is not None else config['USER_RATE_PER_MINUTE'],
+            row.burst if row and row.burst is not None else config['USER_BURST'],
+            bool(row and row.exempt),
+        )
+        cache.set(_limits_key(config, user_id), limits, config['LIMITS_TTL'])
+    return limits
+
+
+def forget_user_limits(user_id):
+    """Drop the cached limits; the user's bucket restarts full under the new ones."""
+    config = get_config()
+    cache.delete_many([_limits_key(config, user_id), f"{config['KEY_PREFIX']}:bucket:user:{user_id}"])
+
+
+def _refill(state, rate, burst, now):
+    tokens, stamp = state if state else (burst, now)
+    return min(burst, tokens + (now - stamp) * rate / 60)
+
+
+def check_buckets(config, user_id, project_id):
+    """Take a token from the user's and the project's bucket, or raise Rejected."""
+    rate, burst, exempt = user_limits(config, user_id)
+    if exempt:
+        return
+    buckets = {
+        f"{config['KEY_PREFIX']}:bucket:user:{user_id}": ('user', rate, burst),
+        f"{config['KEY_PREFIX']}:bucket:project:{project_id}": (
+            'project', config['PROJECT_RATE_PER_MINUTE'], config['PROJECT_BURST']),
+    }
+    # A rate of 0 means no limit
+    buckets = {key: spec for key, spec in buckets.items() if spec[1]}
+    now = time.time()
+    states = cache.get_many(list(buckets))
+    updated = {}
+    for key, (reason, rate, burst) in buckets.items():
+        tokens = _refill(states.get(key), rate, burst, now)
+        if tokens < 1:
+            raise Rejected(reason, (1 - tokens) * 60 / rate)
+        updated[key] = (tokens - 1, now)
+    for key, state in updated.items():
+        reason, rate, burst = buckets[key]
+        # Past this the bucket is full again and the entry is not needed
+        cache.set(key, state, math.ceil(burst * 60 / rate) + 1)
+
+
+def _generation(length):
+    return int(time.time() // length)
+
+
+class Lease:
+    """One unit of a counted resource: an upstream slot or a queue place.
+
+    Leases are counted, not listed: a lease taken or renewed during
+    generation g (`time // length`) adds one to the counter key
+    `<prefix>:<g>`, and only the current and the previous generation's
+    counters are in use. A lease that is not renewed is forgotten one or
+    two generations after it was taken, so a worker killed mid-request
+    cannot leak it for longer than that.
+    """
+
+    def __init__(self, prefix, length, generation):
+        self.prefix = prefix
+        self.length = length
+        self.generation = generation
+
+    @property
+    def key(self):
+        return _counter_key(self.prefix, self.generation)
+
+    @property
+    def stale(self):
+        return self.generation is not None and _generation(self.length) != self.generation
+
+    def renew(self):
+        """Count the lease in the current generation, so it is not forgotten."""
+        if not self.stale:
+            return
+        generation = _generation(self.length)
+        _increment(_counter_key(self.prefix, generation), self.length)
+        _decrement(self.key)
+        self.generation = generation
+
+    def release(self):
+        if self.generation is not None:
+            _decrement(self.key)
+            self.generation = None
+
+
+def _counter_key(prefix, generation):
+    return f'{prefix}:{generation}'
+
+
+def _increment(key, length):
+    while True:
+        # Past the next generation the counter is not read any more
+        if cache.add(key, 1, 2 * length + 1):
+            return 1
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Evicted since the add; create it again
+            pass
+
+
+def _decrement(key):
+    try:
+        cache.decr(key)
+    except ValueError:
+        # The counter expired, and the lease with it
+        pass
+
+
+def _lease(prefix, size, length):
+    """Take one of `size` leases counted under `prefix`; returns a Lease or None.
+
+    Costs one read of two counters when all leases are taken, so waiters
+    can poll cheaply. Needs an atomic `cache.incr` (see api.filecache).
+    """
+    generation = _generation(length)
+    key, previous = _counter_key(prefix, generation), _counter_key(prefix, generation - 1)
+    counts = cache.get_many([key, previous])
+    if counts.get(key, 0) + counts.get(previous, 0) >= size:
+        return None
+    taken = _increment(key, length)
+    if taken + counts.get(previous, 0) > size:
+        # Others took the last leases since the read
+        _decrement(key)
+        return None
+    return Lease(prefix, length, generation)
+
+
+def lease_slot(config):
+    return _lease(f"{config['KEY_PREFIX']}:slots", config['MAX_CONCURRENT'], config['SLOT_TTL'])
+
+
+def join_queue(config):
+    place = _lease(f"{config['KEY_PREFIX']}:queue", config['MAX_QUEUE'], math.ceil(config['MAX_WAIT']) + 1)
+    if place is None:
+        raise Rejected('busy', config['MAX_WAIT'])
+    return place
+
+
+def release(lease):
+    if lease is not None:
+        lease.release()
+
+
+def renew(lease):
+    """Keep a long-running turn's slot; cheap unless its generation has passed."""
+    if lease is not None and lease.stale:
+        lease.renew()
+
+
+async def arenew(lease):
+    if lease is not None and lease.stale:
+        await sync_to_async(lease.renew)()
+
+
+def _poll_delays(config):
+    """Pauses between polls for a slot: doubling from `POLL_INTERVAL` up to
+    `MAX_POLL_INTERVAL`, jittered so waiters spread out, until `MAX_WAIT`."""
+    deadline = time.monotonic() + config['MAX_WAIT']
+    delay = config['POLL_INTERVAL']
+    while (remaining := deadline - time.monotonic()) > 0:
+        yield min(remaining, delay * random.uniform(0.5, 1))
+        delay = min(delay * 2, config['MAX_POLL_INTERVAL'])
+
+
+def admit(user, project_id):
+    """Admit a chat turn; returns the slot to `release` once it is done."""
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    check_buckets(config, user.id, project_id)
+    return acquire_slot(config)
+
+
+def acquire_slot(config):
+    """An upstream slot, after waiting in the queue if need be, or raise Rejected."""
+    slot = lease_slot(config)
+    if slot:
+        return slot
+    place = join_queue(config)
+    try:
+        for delay in _poll_delays(config):
+            time.sleep(delay)
+            slot = lease_slot(config)
+            if slot:
+                return slot
+    finally:
+        release(place)
+    raise Rejected('busy', config['MAX_WAIT'])
+
+
+async def aadmit(user, project_id):
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    await sync_to_async(check_buckets)(config, user.id, project_id)
+    slot = await sync_to_async(lease_slot)(config)
+    if slot:
+        return slot
+    place = await sync_to_async(join_queue)(config)
+    try:
+        for delay in _poll_delays(config):
+            await asyncio.sleep(delay)
+            slot = await sync_to_async(lease_slot)(config)
+            if slot:
+                return slot
+    finally:
+        await sync_to_async(release)(place)
+    raise Rejected('busy', config['MAX_WAIT'])
+
+
+class _ReleasingStream:
+    """Streaming content that renews its slot while it runs and frees it
+    when exhausted or closed."""
+
+    def __init__(self, content, slot):
+        self.content = content
+        self.slot = slot
+
+    def __iter__(self):
+        try:
+            for chunk in self.content:
+                renew(self.slot)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        # Django closes the response even if the client left before the first chunk
+        release(self.slot)
+        self.slot = None
+
+
+class _AsyncReleasingStream:
+    """Async twin of _ReleasingStream, for responses of async views."""
+
+    def __init__(self, content, slot):
+        self.content = content
+        self.slot = slot
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.content:
+                await arenew(self.slot)
+                yield chunk
+        finally:
+            await sync_to_async(self.close)()
+
+    def close(self):
+        release(self.slot)
+        self.slot = None
+
+
+def _releasing(response, slot):
+    stream = _AsyncReleasingStream if response.is_async else _ReleasingStream
+    response.streaming_content = stream(response.streaming_content, slot)
+
+
+def admission_control(view):
+    """Gate a chat view taking `project_id` behind `admit`.
+
+    Ownership is checked first, so nobody can drain another user's project
+    bucket. A streamed response keeps its slot until the stream ends.
+    """
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, project_id, *args, **kwargs):
+            if request.method != 'POST':
+                return await view(request, project_id, *args, **kwargs)
+            user = await request.auser()
+            await chat.aget_project(project_id, user)
+            try:
+                slot = await aadmit(user, project_id)
+            except Rejected as e:
+                return e.response()
+            try:
+                response = await view(request, project_id, *args, **kwargs)
+            except BaseException:
+                await sync_to_async(release)(slot)
+                raise
+            if response.streaming:
+                _releasing(response, slot)
+            else:
+                await sync_to_async(release)(slot)
+            return response
+        return wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, project_id, *args, **kwargs):
+        if request.method != 'POST':
+            return view(request, project_id, *args, **kwargs)
+        chat.get_project(project_id, request.user)
+        try:
+            slot = admit(request.user, project_id)
+        except Rejected as e:
+            return e.response()
+        try:
+            response = view(request, project_id, *args, **kwargs)
+        except BaseException:
+            release(slot)
+            raise
+        if response.streaming:
+            _releasing(response, slot)
+        else:
+            release(slot)
+        return response
+    return wrapper
@@ -0,0 +1,202 @@
+"""Cold storage for old chat messages.
+
+The live chat path only ever reads a project's newest messages, yet every
+message ever sent stays in the ChatMessage table and its indexes. Messages
+older than a project's horizon (`Project.archive_after_days`, or the site
+default `HORIZON_DAYS`) are moved into ChatArchiveSegment rows: runs of up
+to `SEGMENT_MESSAGES` consecutive messages, packed as JSON and compressed
+with zlib (or Zstandard with `CODEC = 'zstd'` and the `zstandard` package).
+
+`python manage.py compact_chat_history` runs the compaction. It is
+incremental and resumable: each segment is written in the same
+transaction that deletes its messages, oldest first, so an interrupted
+run leaves nothing half-done and the next run carries on from there. Runs
+shorter than `MIN_SEGMENT_MESSAGES` wait for more messages to age. The
+newest `context.MAX_WINDOW_MESSAGES` messages of a project always stay in
+the hot table, so the context window of a turn never changes.
+
+Archived messages stay readable through the history API: when a page
+reaches past the hot rows, `fill_page` decompresses the segments it needs,
+newest first, and no others. Archived messages keep their ids and
+timestamps, so history cursors work across the boundary. Project and user
+message counters keep counting them; `Project.archived_message_count`
+lets projects without an archive skip the segment lookup.
+"""
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .context import MAX_WINDOW_MESSAGES
+from .models import ChatArchiveSegment, ChatMessage, Project
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'HORIZON_DAYS': 90,
+    'SEGMENT_MESSAGES': 500,
+    'MIN_SEGMENT_MESSAGES': 100,
+    'CODEC': ChatArchiveSegment.ZLIB,
+}
+
+# Segments are written once and read rarely: favour size over speed
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+
+# Order of the values of each message in a segment
+FIELDS = ('id', 'role', 'content', 'timestamp', 'model', 'latency_ms')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def codec(config=None):
+    """The codec new segments are written with."""
+    config = config or get_config()
+    if config['CODEC'] == ChatArchiveSegment.ZSTD:
+        if _zstandard() is not None:
+            return ChatArchiveSegment.ZSTD
+        logger.warning("CHAT_ARCHIVE['CODEC'] is 'zstd' but the 'zstandard' package is not installed; using zlib")
+    return ChatArchiveSegment.ZLIB
+
+
+def compress(raw, codec):
+    if codec == ChatArchiveSegment.ZSTD:
+        return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return zlib.compress(raw, ZLIB_LEVEL)
+
+
+def decompress(data, codec):
+    if codec == ChatArchiveSegment.ZSTD:
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise RuntimeError("Reading Zstandard archive segments needs the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def pack(project_id, messages, codec):
+    """An unsaved segment holding `messages` (ChatMessages, oldest first)."""
+    raw = json.dumps(
+        [[msg.id, msg.role, msg.content, msg.timestamp.isoformat(), msg.model, msg.latency_ms] for msg in messages],
+        ensure_ascii=False, separators=(',', ':'),
+    ).encode()
+    first, last = messages[0], messages[-1]
+    return ChatArchiveSegment(
+        project_id=project_id, first_timestamp=first.timestamp, first_id=first.id,
+        last_timestamp=last.timestamp, last_id=last.id, message_count=len(messages),
+        codec=codec, data=compress(raw, codec), raw_bytes=len(raw),
+    )
+
+
+def unpack(segment):
+    """The segment's messages, oldest first, as unsaved ChatMessage instances."""
+    values = json.loads(decompress(bytes(segment.data), segment.codec))
+    messages = []
+    for row in values:
+        fields = dict(zip(FIELDS, row))
+        fields['timestamp'] = datetime.fromisoformat(fields['timestamp'])
+        messages.append(ChatMessage(project_id=segment.project_id, **fields))
+    return messages
+
+
+def _older(prefix, timestamp, pk):
+    # Keyset comparison on (timestamp, id)
+    return Q(**{f'{prefix}timestamp__lt': timestamp}) | Q(**{f'{prefix}timestamp': timestamp, f'{prefix}id__lt': pk})
+
+
+def _position(message):
+    return message.timestamp, message.id
+
+
+def fill_page(project, rows, wanted, before=None):
+    """Top up `rows` (hot messages newest first, all before the (timestamp, id)
+    position `before`) with archived ones to `wanted` messages, newest first."""
+    # Segments only ever take a project's oldest messages
+    if len(rows) >= wanted or not project.archived_message_count:
+        return rows
+    segments = ChatArchiveSegment.objects.filter(project_id=project.id).defer('data')
+    if before is not None:
+        segments = segments.filter(_older('first_', *before))
+    merged = list(rows)
+    for segment in segments.order_by('-last_timestamp', '-last_id'):
+        if len(merged) >= wanted and (segment.last_timestamp, segment.last_id) < _position(merged[wanted - 1]):
+            break
+        archived = unpack(segment)
+        if before is not None:
+            archived = [msg for msg in archived if _position(msg) < before]
+        merged = sorted(merged + archived, key=_position, reverse=True)[:wanted]
+    return merged
+
+
+def horizon(project, config=None):
+    config = config or get_config()
+    days = project.archive_after_days
+    return timedelta(days=config['HORIZON_DAYS'] if days is None else days)
+
+
+def compact_project(project, config=None, now=None, max_segments=None):
+    """Archive the project's messages past its horizon; returns (segments, messages, raw bytes, stored bytes)."""
+    config = config or get_config()
+    cutoff = (now or timezone.now()) - horizon(project, config)
+    hot = ChatMessage.objects.filter(project_id=project.id)
+    # The context window reads at most the newest MAX_WINDOW_MESSAGES; keep them
+    newest = hot.order_by('-timestamp', '-id').values_list('timestamp', 'id')
+    kept = list(newest[MAX_WINDOW_MESSAGES - 1:MAX_WINDOW_MESSAGES])
+    totals = [0, 0, 0, 0]
+    if not kept:
+        return tuple(totals)
+    eligible = hot.filter(timestamp__lt=cutoff).filter(_older('', *kept[0])).order_by('timestamp', 'id')
+    segment_codec = codec(config)
+    while max_segments is None or totals[0] < max_segments:
+        messages = list(eligible[:config['SEGMENT_MESSAGES']])
+        if len(messages) < max(config['MIN_SEGMENT_MESSAGES'], 1):
+            break
+        segment = pack(project.id, messages, segment_codec)
+        with transaction.atomic():
+            deleted, _ = ChatMessage.objects.filter(pk__in=[msg.pk for msg in messages]).delete()
+            if deleted != len(messages):
+                # Another run archived (or someone deleted) some of them meanwhile: read again
+                transaction.set_rollback(True)
+                continue
+            segment.save()
+            Project.objects.filter(pk=project.id).update(
+                archived_message_count=F('archived_message_count') + len(messages))
+        totals[0] += 1
+        totals[1] += len(messages)
+        totals[2] += segment.raw_bytes
+        totals[3] += len(segment.data)
+    return tuple(totals)
+
+
+def hot_table_size():
+    """(rows, bytes of table and indexes or None) of the ChatMessage table."""
+    rows = ChatMessage.objects.count()
+    table = ChatMessage._meta.db_table
+    if connection.vendor != 'sqlite':
+        return rows, None
+    try:
+        with connection.cursor() as cursor:
+            # dbstat is compiled into most SQLite builds, but not all
+            cursor.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = %s)", [table],
+            )
+            size = cursor.fetchone()[0]
+    except OperationalError:
+        size = None
+    return rows, size
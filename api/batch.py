@@ -0,0 +1,253 @@
+"""Batch chat: many (project, message) items run concurrently.
+
+Evaluation runs send hundreds of messages; one HTTP call per message
+spends most of the time waiting on the model one answer at a time. A batch
+is answered by a pool of at most `concurrency` worker threads, which all
+share the upstream client (see api/upstream.py):
+
+* `isolated` history (the default): every item is answered against the
+  project's history as it was when the batch started, so items are
+  independent and all of them run concurrently;
+* `shared` history: the items of one project form a conversation, each
+  seeing the turns answered before it in the batch. They run one after
+  the other; different projects still run concurrently.
+
+Contexts are loaded up front in the request thread, so the workers never
+touch the database. Each upstream call holds an admission slot (see
+api/admission.py), and the batch is charged once to the user's and each
+project's token bucket. Answered turns are saved in bulk, every
+`SAVE_EVERY` turns and when the batch ends, including when a streaming
+client goes away mid-batch.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
+
+from . import admission, chat, context
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_ITEMS': 500,
+    'CONCURRENCY': 8,
+    'MAX_CONCURRENCY': 32,
+    'SAVE_EVERY': 100,
+}
+
+ISOLATED = 'isolated'
+SHARED = 'shared'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_BATCH', {})}
+
+
+class BatchError(ValueError):
+    """The batch request is malformed; the message is safe to show."""
+
+
+class Job:
+    def __init__(self, index, project_id, message):
+        self.index = index
+        self.project_id = project_id
+        self.message = message
+        self.project = None
+        self.prompt = None
+        self.history = None
+        self.error = None
+
+
+def parse(data):
+    """(jobs, history mode, concurrency, stream) from a decoded request body, or raise BatchError."""
+    config = get_config()
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list) or not data['items']:
+        raise BatchError("'items' must be a non-empty list of {project_id, message} objects.")
+    if len(data['items']) > config['MAX_ITEMS']:
+        raise BatchError(f"A batch holds at most {config['MAX_ITEMS']} items.")
+    jobs = []
+    for index, item in enumerate(data['items']):
+        project_id = item.get('project_id') if isinstance(item, dict) else None
+        message = item.get('message') if isinstance(item, dict) else None
+        if not isinstance(project_id, int) or isinstance(project_id, bool) or not isinstance(message, str) \
+                or not message:
+            raise BatchError(f"Item {index} needs an integer 'project_id' and a non-empty 'message'.")
+        jobs.append(Job(index, project_id, message))
+    mode = data.get('history', ISOLATED)
+    if mode not in (ISOLATED, SHARED):
+        raise BatchError(f"'history' must be '{ISOLATED}' or '{SHARED}'.")
+    concurrency = data.get('concurrency', config['CONCURRENCY'])
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        raise BatchError("'concurrency' must be a positive integer.")
+    return jobs, mode, min(concurrency, config['MAX_CONCURRENCY']), bool(data.get('stream'))
+
+
+def prepare(jobs, user):
+    """Resolve each job's project and load its context; jobs that cannot run get `error` set."""
+    projects = {}
+    for job in jobs:
+        if job.project_id not in projects:
+            try:
+                projects[job.project_id] = chat.get_project(job.project_id, user)
+            except Http404:
+                projects[job.project_id] = None
+        job.project = projects[job.project_id]
+        if job.project is None:
+            job.error = 'Project not found.'
+            continue
+        job.prompt, job.history = chat.load_context(job.project, job.message)
+
+
+def admit(user, jobs):
+    """Charge the batch once to the user's and every project's bucket; raises admission.Rejected."""
+    config = admission.get_config()
+    if not config['ENABLED']:
+        return
+    for project_id in dict.fromkeys(job.project_id for job in jobs if job.project is not None):
+        admission.check_buckets(config, user.id, project_id)
+
+
+def _trim(history, budget):
+    """Drop the oldest messages until `history` fits in `budget` tokens."""
+    costs = [context.count_tokens(msg['content']) + context.MESSAGE_OVERHEAD for msg in history]
+    total = sum(costs)
+    start = 0
+    while start < len(history) and total > budget:
+        total -= costs[start]
+        start += 1
+    return history[start:]
+
+
+def _run_chain(chain, shared, results, stop):
+    """Answer `chain` in order, putting (job, completion or None, error or None) on `results`."""
+    config = admission.get_config()
+    history = None
+    for job in chain:
+        if stop.is_set():
+            return
+        if not shared or history is None:
+            history = job.history
+        completion = error = None
+        try:
+            slot = admission.acquire_slot(config) if config['ENABLED'] else None
+            try:
+                completion = chat.complete(job.project, job.message, job.prompt, history)
+            finally:
+                admission.release(slot)
+        except admission.Rejected:
+            error = 'Too many requests, please retry shortly.'
+        except Exception as e:
+            logger.exception("Batch Chat Error")
+            error = str(e)
+        results.put((job, completion, error))
+        if shared and completion is not None:
+            turn = [{'role': 'user', 'content': job.message}, {'role': 'assistant', 'content': completion.content}]
+            budget = job.project.context_token_budget - context.count_tokens(job.prompt)
+            history = _trim(history + turn, budget)
+
+
+def result(job, completion=None, error=None):
+    if error is not None:
+        return {'index': job.index, 'project_id': job.project_id, 'error': error}
+    return {'index': job.index, 'project_id': job.project_id, 'response': completion.content,
+            'model': completion.model, 'latency_ms': completion.latency_ms, 'cached': completion.cached}
+
+
+class _Run:
+    """One batch in flight: its worker pool and the answered turns not saved yet.
+
+    Workers put (job, completion, error) on `results`, a _Handoff.
+    """
+
+    def __init__(self, jobs, mode, concurrency, results):
+        self.config = get_config()
+        self.failed = [job for job in jobs if job.error]
+        runnable = [job for job in jobs if not job.error]
+        self.pending = len(runnable)
+        self.stop = threading.Event()
+        self.unsaved = []
+        self.pool = None
+        if not runnable:
+            return
+        if mode == SHARED:
+            chains = {}
+            for job in runnable:
+                chains.setdefault(job.project_id, []).append(job)
+            chains = list(chains.values())
+        else:
+            chains = [[job] for job in runnable]
+        self.pool = ThreadPoolExecutor(max_workers=min(concurrency, len(chains)), thread_name_prefix='chat-batch')
+        for chain in chains:
+            self.pool.submit(_run_chain, chain, mode == SHARED, results, self.stop)
+
+    def keep(self, item):
+        job, completion, error = item
+        if completion is not None:
+            self.unsaved.append((job.project, job.message, completion))
+
+    def take(self, item):
+        """The result dict of a finished item."""
+        self.pending -= 1
+        self.keep(item)
+        return result(*item)
+
+    @property
+    def due(self):
+        return len(self.unsaved) >= self.config['SAVE_EVERY']
+
+    def save(self):
+        chat.save_turns(self.unsaved)
+        self.unsaved = []
+
+    def shutdown(self):
+        # On a client disconnect the items not started yet are dropped
+        self.stop.set()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class _Handoff:
+    """Lets the worker threads put results on an asyncio.Queue."""
+
+    def __init__(self, queue):
+        self.loop = asyncio.get_running_loop()
+        self.queue = queue
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+async def arun(jobs, mode=ISOLATED, concurrency=DEFAULTS['CONCURRENCY']):
+    """Yield a result dict per job, in completion order; see the module docstring.
+
+    Results are awaited on the event loop rather than waited for in a
+    thread, and only saving leaves the loop.
+    """
+    results = asyncio.Queue()
+    batch = _Run(jobs, mode, concurrency, _Handoff(results))
+    for job in batch.failed:
+        yield result(job, error=job.error)
+    if not batch.pending:
+        return
+    try:
+        while batch.pending:
+            item = batch.take(await results.get())
+            if batch.due:
+                await sync_to_async(batch.save)()
+            yield item
+    finally:
+        # A client going away cancels the stream; the answered turns are saved regardless
+        await asyncio.shield(_finish(batch, results))
+
+
+async def _finish(batch, results):
+    await sync_to_async(batch.shutdown, thread_sensitive=False)()
+    # Workers handed their last results over before the pool shut down, so
+    # those callbacks ran ahead of this coroutine resuming
+    while not results.empty():
+        batch.keep(results.get_nowait())
+    await sync_to_async(batch.save)()
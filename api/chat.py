@@ -0,0 +1,210 @@
+"""Chat turn pipeline shared by the chat views.
+
+A turn is: load the project's context (active prompt, summary and recent history),
+get a completion (from the response cache or the upstream models) and
+persist the user/assistant pair.
+
+The project configuration comes from api/project_cache.py and the summary
+and history window from the cache kept by api/context.py, so in steady
+state nothing is read from the database before the upstream call.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from django.utils import timezone
+
+from . import coalesce, context, project_cache, rag, response_cache, writebehind
+from .fallback import Completion, FallbackPolicy
+from .llm import AI_MODELS, get_ai_completion, aget_ai_completion, sandbox_mode
+from .models import ChatMessage, Project
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+
+def projects():
+    """Project queryset for pages showing a project; joins the active prompt in the same query."""
+    return Project.objects.select_related('active_prompt')
+
+
+def get_project(project_id, user):
+    """The cached chat configuration of one of `user`'s projects; raises Http404 otherwise."""
+    project = project_cache.get(project_id)
+    if project is None or project.user_id != user.id:
+        raise Http404("No Project matches the given query.")
+    return project
+
+
+async def aget_project(project_id, user):
+    return await sync_to_async(get_project)(project_id, user)
+
+
+def load_context(project, message=None):
+    """Return (system prompt text, history dicts oldest first) for a turn.
+
+    When `message` is given, the best matching excerpts of the project's
+    uploaded files are added to the system prompt (see api/rag.py).
+    History is as many recent messages as fit the project's token budget,
+    older ones are carried by the rolling summary (see api/context.py).
+    With the project from `get_project()` and a warm window cache this
+    runs no query; a summary folded on the way is saved by `save_turn`.
+    """
+    system_prompt = project.active_prompt
+    prompt_content = system_prompt.content if system_prompt else DEFAULT_SYSTEM_PROMPT
+    if message:
+        prompt_content += context.knowledge_section(rag.retrieve(project.id, message),
+                                                    int(project.context_token_budget * context.KNOWLEDGE_SHARE))
+    return context.build_context(project, prompt_content)
+
+
+async def aload_context(project, message=None):
+    return await sync_to_async(load_context)(project, message)
+
+
+def cache_lookup(project, message, prompt_content, history):
+    """Return (cache key, cached Completion or None); the key is None when caching is off."""
+    if not project.response_cache_enabled or sandbox_mode():
+        return None, None
+    started = time.monotonic()
+    digest = response_cache.make_key(AI_MODELS, prompt_content, history, message)
+    entry = response_cache.lookup(project, digest)
+    if entry is None:
+        return digest, None
+    latency_ms = int((time.monotonic() - started) * 1000)
+    return digest, Completion(entry['content'], entry['model'], latency_ms, cached=True)
+
+
+def cache_store(project, digest, content, model):
+    if digest is not None:
+        response_cache.store(project, digest, content, model)
+
+
+def complete(project, message, prompt_content, history):
+    digest, cached = cache_lookup(project, message, prompt_content, history)
+    if cached:
+        return cached
+    completion = get_ai_completion(message, system_prompt=prompt_content, history=history,
+                                   policy=FallbackPolicy.for_project(project))
+    # Only successful upstream answers are cached, never errors
+    if completion.model:
+        cache_store(project, digest, completion.content, completion.model)
+    return completion
+
+
+async def acomplete(project, message, prompt_content, history):
+    digest, cached = await sync_to_async(cache_lookup)(project, message, prompt_content, history)
+    if cached:
+        return cached
+    completion = await aget_ai_completion(message, system_prompt=prompt_content, history=history,
+                                          policy=FallbackPolicy.for_project(project))
+    if completion.model:
+        await sync_to_async(cache_store)(project, digest, completion.content, completion.model)
+    return completion
+
+
+def turn_rows(project, message, completion=None):
+    """ChatMessage rows for a turn; `completion` is None if nothing was generated."""
+    now = timezone.now()
+    rows = [ChatMessage(project=project, role='user', content=message, timestamp=now)]
+    if completion is not None:
+        # Same timestamp, so (timestamp, id) keeps the reply after the message
+        rows.append(ChatMessage(project=project, role='assistant', content=completion.content, timestamp=now,
+                                model=completion.model or '', latency_ms=completion.latency_ms))
+    return rows
+
+
+def save_turn(project, message, completion=None):
+    """Persist a turn in one INSERT, or hand it to the write-behind buffer."""
+    context.save_folded(project)
+    rows = turn_rows(project, message, completion)
+    buffer = writebehind.get_buffer()
+    if buffer is not None:
+        buffer.submit(rows)
+    else:
+        writebehind.write_rows(rows)
+
+
+def save_turns(turns):
+    """Persist many (project, message, completion) turns in one bulk INSERT, in list order."""
+    rows = []
+    for project, message, completion in turns:
+        context.save_folded(project)
+        rows.extend(turn_rows(project, message, completion))
+    if not rows:
+        return
+    buffer = writebehind.get_buffer()
+    if buffer is not None:
+        buffer.submit(rows)
+    else:
+        writebehind.write_rows(rows)
+
+
+async def asave_turn(project, message, completion=None):
+    await sync_to_async(context.save_folded)(project)
+    rows = turn_rows(project, message, completion)
+    buffer = writebehind.get_buffer()
+    if buffer is not None:
+        await buffer.asubmit(rows)
+    else:
+        await sync_to_async(writebehind.write_rows)(rows)
+
+
+def join_flight(project, message, history, idempotency_key=None):
+    """Coalesce with an identical turn: (Completion to reuse or None, Flight to lead or None)."""
+    key = coalesce.flight_key(project, message, history, idempotency_key)
+    replayed = coalesce.lookup(key)
+    if replayed is not None:
+        return replayed, None
+    flight = coalesce.start(key, coalesce.timeout_for(project))
+    if flight is not None and not flight.leader:
+        # If the leader failed or timed out, run the turn without coalescing
+        return flight.wait(coalesce.timeout_for(project)), None
+    return None, flight
+
+
+def land_flight(flight, project, message, completion, ok=None):
+    """Hand the leader's result to its followers; `ok` defaults to "a model or the cache answered"."""
+    if flight is None:
+        return
+    if ok is None:
+        ok = completion is not None and bool(completion.model or completion.cached)
+    flight.finish(completion, ok, coalesce.replay_key(project, message, completion.content) if completion else None)
+
+
+def turn(project, message, prompt_content, history, idempotency_key=None):
+    """Complete and persist a turn; a duplicate gets the original's Completion and saves nothing."""
+    reused, flight = join_flight(project, message, history, idempotency_key)
+    if reused is not None:
+        return reused
+    completion = None
+    try:
+        completion = complete(project, message, prompt_content, history)
+        save_turn(project, message, completion)
+    finally:
+        land_flight(flight, project, message, completion)
+    return completion
+
+
+async def ajoin_flight(project, message, history, idempotency_key=None):
+    key = coalesce.flight_key(project, message, history, idempotency_key)
+    replayed = await sync_to_async(coalesce.lookup)(key)
+    if replayed is not None:
+        return replayed, None
+    timeout = coalesce.timeout_for(project)
+    flight = await sync_to_async(coalesce.start)(key, timeout)
+    if flight is not None and not flight.leader:
+        return await flight.await_result(timeout), None
+    return None, flight
+
+
+async def aturn(project, message, prompt_content, history, idempotency_key=None):
+    reused, flight = await ajoin_flight(project, message, history, idempotency_key)
+    if reused is not None:
+        return reused
+    completion = None
+    try:
+        completion = await acomplete(project, message, prompt_content, history)
+        await asave_turn(project, message, completion)
+    finally:
+        await sync_to_async(land_flight)(flight, project, message, completion)
+    return completion
@@ -0,0 +1,21 @@
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+
+from .coordination import ALIAS
+
+
+@checks.register(checks.Tags.caches)
+def check_atomic_cache(app_configs, **kwargs):
+    """Admission slots and coalescing locks need an atomic `add` and `incr`."""
+    backend = type(caches[ALIAS])
+    if backend.add is not FileBasedCache.add and backend.incr is not BaseCache.incr:
+        return []
+    return [checks.Warning(
+        f'The {ALIAS} cache ({backend.__module__}.{backend.__qualname__}) does not add or '
+        f'increment keys atomically, so two workers can take the same admission slot or '
+        f'lead the same chat turn.',
+        hint='Use Redis, Memcached or api.filecache.LockingFileBasedCache.',
+        id='api.W001',
+    )]
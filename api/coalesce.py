@@ -0,0 +1,185 @@
+"""Single-flight coalescing of duplicate chat turns.
+
+Double-clicks and client retries send the same message for the same
+project twice. A turn is identified by (project, active prompt, message,
+fingerprint of the latest history turn), or by (project, message,
+`Idempotency-Key` header) when the client sends one:
+
+* the first request for a key becomes the leader and runs the turn;
+* concurrent requests for the same key are followers: they wait for the
+  leader's Completion and return it without calling the upstream or
+  saving another pair of ChatMessage rows;
+* the leader stores its result so that replays get the stored answer.
+  With an idempotency key it is kept `TTL` seconds. Without one it is
+  kept `REPLAY_TTL` seconds, under its own key and under the key a retry
+  computes once the turn is in the history (its latest turn is then this
+  message and this reply); the window is short because a user may well
+  send the same message again on purpose ("continue"). Failed turns are
+  kept only `FAILED_TTL` seconds, enough for followers already waiting,
+  so a retry tries again.
+
+Followers in the same process wait on a threading.Event; other workers
+see the leader through a lock key taken with `cache.add`, which must be
+atomic (see api.filecache), and poll for the result. A follower whose leader dies or overruns `timeout` gets None and
+runs the turn itself.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .coordination import cache
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TTL': 60,
+    'REPLAY_TTL': 10,
+    'FAILED_TTL': 5,
+    'GRACE': 5,
+    'POLL_INTERVAL': 0.05,
+    'KEY_PREFIX': 'flight',
+}
+
+# History messages that go into the fingerprint: the latest turn
+TAIL_MESSAGES = 2
+
+_lock = threading.Lock()
+_flights = {}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'COALESCE', {})}
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+IDEMPOTENT = ':idem:'
+
+
+def flight_key(project, message, history, idempotency_key=None):
+    """The key identifying this turn; see the module docstring."""
+    if idempotency_key:
+        return f'{project.id}{IDEMPOTENT}{_digest([idempotency_key, message])}'
+    tail = [(msg['role'], msg['content']) for msg in (history or [])[-TAIL_MESSAGES:]]
+    return f'{project.id}:{_digest([project.active_prompt_id, message, tail])}'
+
+
+def replay_key(project, message, content):
+    """The key a retry of this turn computes once the turn is in the history."""
+    history = [{'role': 'user', 'content': message}, {'role': 'assistant', 'content': content}]
+    return flight_key(project, message, history)
+
+
+def _result_key(config, key):
+    return f"{config['KEY_PREFIX']}:result:{key}"
+
+
+def _lock_key(config, key):
+    return f"{config['KEY_PREFIX']}:lock:{key}"
+
+
+def lookup(key):
+    """The stored Completion of a finished turn with this key, or None."""
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    return cache.get(_result_key(config, key))
+
+
+class Flight:
+    """A leader's claim on a key, or a follower's handle on someone else's."""
+
+    def __init__(self, key, leader, local=None):
+        self.key = key
+        self.leader = leader
+        # The in-process leader's flight, for followers in the same process
+        self.local = local
+        self.completion = None
+        self.done = threading.Event()
+
+    def finish(self, completion, ok, replay=None):
+        """Publish the leader's result (None if nothing was generated) and release the key.
+
+        Only an `ok` result is kept for replays; a failed one just reaches
+        the followers already waiting.
+        """
+        config = get_config()
+        if completion is not None and ok and IDEMPOTENT in self.key:
+            cache.set(_result_key(config, self.key), completion, config['TTL'])
+        elif completion is not None and ok:
+            keys = [self.key, replay] if replay else [self.key]
+            cache.set_many({_result_key(config, k): completion for k in keys}, config['REPLAY_TTL'])
+        elif completion is not None:
+            cache.set(_result_key(config, self.key), completion, config['FAILED_TTL'])
+        cache.delete(_lock_key(config, self.key))
+        self.completion = completion
+        with _lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        self.done.set()
+
+    def _poll(self, config):
+        """(finished, completion) from the other workers' view of the key."""
+        completion = cache.get(_result_key(config, self.key))
+        if completion is not None:
+            return True, completion
+        # No lock and no result: the leader gave up or died
+        return cache.get(_lock_key(config, self.key)) is None, None
+
+    def wait(self, timeout):
+        """Follower: the leader's Completion, or None if there is none to share."""
+        if self.local is not None:
+            self.local.done.wait(timeout)
+            return self.local.completion
+        config = get_config()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            finished, completion = self._poll(config)
+            if finished:
+                return completion
+            time.sleep(config['POLL_INTERVAL'])
+        return None
+
+    async def await_result(self, timeout):
+        config = get_config()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.local is not None:
+                if self.local.done.is_set():
+                    return self.local.completion
+            else:
+                finished, completion = await sync_to_async(self._poll)(config)
+                if finished:
+                    return completion
+            await asyncio.sleep(config['POLL_INTERVAL'])
+        return None
+
+
+def timeout_for(project):
+    """How long followers wait for a leader: the turn's deadline plus `GRACE` seconds."""
+    return project.request_deadline_ms / 1000 + get_config()['GRACE']
+
+
+def start(key, timeout):
+    """Claim `key`: a leader Flight, a follower Flight, or None when coalescing is off.
+
+    `timeout` bounds how long the leader may hold the key in the cache.
+    """
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    with _lock:
+        local = _flights.get(key)
+        if local is not None:
+            return Flight(key, leader=False, local=local)
+        if not cache.add(_lock_key(config, key), True, int(timeout) + 1):
+            # Another worker leads; wait for its result in the cache
+            return Flight(key, leader=False)
+        flight = _flights[key] = Flight(key, leader=True)
+    return flight
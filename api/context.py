@@ -0,0 +1,223 @@
+"""Token-budgeted context windows with a rolling conversation summary.
+
+Instead of a fixed number of messages, a turn gets as much recent history
+as fits in `Project.context_token_budget`, counted with a local tokenizer
+approximation (no tokenizer package or upstream call needed). Messages
+that slide out of the window are folded into a short per-project summary
+(ConversationSummary) which is sent along with the system prompt.
+
+The summary is extractive and incremental: each evicted message adds one
+condensed line, and only messages newer than the summary's high-water mark
+are folded, so it is never regenerated from scratch. When the summary
+itself outgrows its share of the budget its oldest lines are dropped.
+If more messages are unsummarised than one window holds (after an import,
+say), the ones older than the window are folded first, up to
+`MAX_WINDOW_MESSAGES` per turn, so the mark never moves past a message
+that was not folded.
+
+The summary and the unsummarised tail of the conversation (the "window")
+are kept in the Django cache, so a steady-state turn reads no rows at
+all. The write path refreshes the cached window after each batch of
+messages is committed (see writebehind.write_rows), and a fold is saved
+with the turn (`save_folded`) rather than before the upstream call; of
+two turns folding at once, the one that folded further wins. Two turns of
+one project finishing at the same moment can leave the cache a message
+behind until the next write; messages deleted outside the chat
+pipeline stay in the cached window for up to `WINDOW_TTL`.
+"""
+import math
+import re
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChatMessage, ConversationSummary
+
+# Upper bound on rows read per turn, whatever the budget
+MAX_WINDOW_MESSAGES = 50
+# Share of the budget the summary may use
+SUMMARY_SHARE = 0.25
+# Share of the budget retrieved file excerpts may use
+KNOWLEDGE_SHARE = 0.4
+# Words kept from each message folded into the summary
+SUMMARY_LINE_WORDS = 30
+# Role/separator tokens the chat format adds around every message
+MESSAGE_OVERHEAD = 4
+# Seconds a cached window lives without being refreshed by a write
+WINDOW_TTL = 24 * 3600
+
+SUMMARY_HEADER = "\n\nSummary of the earlier conversation:\n"
+KNOWLEDGE_HEADER = "\n\nRelevant excerpts from the project's knowledge base:\n"
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def count_tokens(text):
+    """Approximate BPE token count: ~4 characters per token of a word,
+    one token per punctuation mark."""
+    return sum(math.ceil(len(piece) / 4) for piece in _TOKEN_RE.findall(text or ''))
+
+
+def truncate_to_tokens(text, budget):
+    """Cut `text` after roughly `budget` tokens, on a word boundary."""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += math.ceil(len(match.group()) / 4)
+        if used > budget:
+            return text[:match.start()].rstrip() + ' …'
+    return text
+
+
+def knowledge_section(chunks, budget):
+    """Render retrieved DocumentChunks for the system prompt, best first, within `budget` tokens."""
+    if not chunks:
+        return ''
+    remaining = budget - count_tokens(KNOWLEDGE_HEADER)
+    parts = []
+    for chunk in chunks:
+        text = f"[{chunk.file.name}] {chunk.content}"
+        cost = count_tokens(text)
+        if cost > remaining:
+            if remaining > 20:
+                parts.append(truncate_to_tokens(text, remaining))
+            break
+        parts.append(text)
+        remaining -= cost
+    return KNOWLEDGE_HEADER + '\n\n'.join(parts) if parts else ''
+
+
+def _summary_line(message):
+    words = message.content.split()
+    text = ' '.join(words[:SUMMARY_LINE_WORDS])
+    if len(words) > SUMMARY_LINE_WORDS:
+        text += ' …'
+    return f"- {message.role.capitalize()}: {text}"
+
+
+def _trim_summary(lines, budget):
+    # Oldest lines go first once the summary is over budget
+    total = sum(count_tokens(line) for line in lines)
+    while lines and total > budget:
+        total -= count_tokens(lines.pop(0))
+    return lines
+
+
+def _window_key(project_id):
+    return f'ctxwindow:{project_id}'
+
+
+def _unsummarised(project_id, summary):
+    messages = ChatMessage.objects.filter(project_id=project_id)
+    if summary is not None:
+        # Only what the summary does not cover yet
+        messages = messages.filter(timestamp__gte=summary.through_timestamp).exclude(
+            timestamp=summary.through_timestamp, id__lte=summary.through_id)
+    return messages
+
+
+def read_window(project_id):
+    """(summary or None, unsummarised messages newest first) from the database."""
+    summary = ConversationSummary.objects.filter(project_id=project_id).first()
+    messages = _unsummarised(project_id, summary).order_by('-timestamp', '-id')
+    return summary, list(messages[:MAX_WINDOW_MESSAGES])
+
+
+def read_backlog(project_id, summary, before):
+    """Unsummarised messages older than `before`, oldest first, at most MAX_WINDOW_MESSAGES."""
+    messages = _unsummarised(project_id, summary).filter(
+        Q(timestamp__lt=before.timestamp) | Q(timestamp=before.timestamp, id__lt=before.id))
+    return list(messages.order_by('timestamp', 'id')[:MAX_WINDOW_MESSAGES])
+
+
+def load_window(project_id):
+    window = cache.get(_window_key(project_id))
+    if window is None:
+        window = read_window(project_id)
+        cache.set(_window_key(project_id), window, WINDOW_TTL)
+    return window
+
+
+def refresh_windows(project_ids):
+    """Re-read the cached windows of projects that just got new messages."""
+    cache.set_many({_window_key(pk): read_window(pk) for pk in project_ids}, WINDOW_TTL)
+
+
+def forget_window(project_id):
+    cache.delete(_window_key(project_id))
+
+
+def fold(project, summary, evicted, budget):
+    """Append `evicted` messages (oldest first) to the project's summary, unsaved."""
+    lines = summary.content.splitlines() if summary else []
+    lines = _trim_summary(lines + [_summary_line(msg) for msg in evicted], budget)
+    newest = evicted[-1]
+    if summary is None:
+        summary = ConversationSummary(project=project)
+    summary.content = '\n'.join(lines)
+    summary.through_timestamp = newest.timestamp
+    summary.through_id = newest.id
+    project.folded_summary = summary
+    return summary
+
+
+def save_folded(project):
+    """Save the summary folded while building this turn's context, if any.
+
+    Concurrent turns may fold from the same window: the first one creates
+    the row, and a summary only replaces one that was folded less far.
+    """
+    summary = getattr(project, 'folded_summary', None)
+    if summary is None:
+        return
+    project.folded_summary = None
+    fields = {'content': summary.content, 'through_timestamp': summary.through_timestamp,
+              'through_id': summary.through_id, 'updated_at': timezone.now()}
+    rows = ConversationSummary.objects.filter(project_id=project.id)
+    behind = rows.filter(Q(through_timestamp__lt=summary.through_timestamp)
+                         | Q(through_timestamp=summary.through_timestamp, through_id__lt=summary.through_id))
+    if behind.update(**fields):
+        return
+    _, created = rows.get_or_create(project_id=project.id, defaults=fields)
+    if not created:
+        # Saved meanwhile by another turn, possibly folded less far than this one
+        behind.update(**fields)
+
+
+def _fill(recent, remaining):
+    """Take messages newest first while they fit in `remaining` tokens."""
+    window = []
+    for msg in recent:
+        cost = count_tokens(msg.content) + MESSAGE_OVERHEAD
+        if cost > remaining:
+            if not window and remaining > MESSAGE_OVERHEAD:
+                # Keep at least the latest message, shortened to fit
+                window.append({'role': msg.role,
+                               'content': truncate_to_tokens(msg.content, remaining - MESSAGE_OVERHEAD)})
+            break
+        window.append({'role': msg.role, 'content': msg.content})
+        remaining -= cost
+    return window
+
+
+def build_context(project, prompt_content):
+    """Return (system prompt incl. summary, history dicts oldest first)."""
+    budget = project.context_token_budget
+    summary_budget = int(budget * SUMMARY_SHARE)
+    summary, recent = load_window(project.id)
+
+    fixed = count_tokens(prompt_content) + count_tokens(SUMMARY_HEADER)
+    window = _fill(recent, budget - fixed - (count_tokens(summary.content) if summary else 0))
+    if len(window) < len(recent):
+        # The summary is about to grow: leave room for its full share
+        window = _fill(recent, budget - fixed - summary_budget)
+        evicted = recent[len(window):][::-1]
+        if len(recent) == MAX_WINDOW_MESSAGES:
+            # A full window may not reach back to the summary: fold what lies between first
+            backlog = read_backlog(project.id, summary, recent[-1])
+            evicted = backlog if len(backlog) == MAX_WINDOW_MESSAGES else backlog + evicted
+        summary = fold(project, summary, evicted, summary_budget)
+
+    if summary is not None and summary.content:
+        prompt_content = prompt_content + SUMMARY_HEADER + summary.content
+    return prompt_content, window[::-1]
@@ -0,0 +1,18 @@
+"""The cache the workers coordinate through.
+
+Admission buckets and slot counters, coalescing locks and results, the
+router's statistics and circuit breakers, metrics snapshots and the
+response cache's generations live in the `coordination` cache alias. The
+default cache holds bulk, read-through entries (replies, context windows,
+project configuration) and may cull them when it is full; culling
+coordination state instead would let requests past the concurrency cap,
+run duplicate turns or serve replies written for an old prompt. The
+coordination cache needs an atomic add and incr, and room for all of its
+keys (see api/filecache.py and api/checks.py).
+"""
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+ALIAS = 'coordination'
+
+cache = ConnectionProxy(caches, ALIAS)
@@ -0,0 +1,92 @@
+"""Denormalised message counters for the dashboard.
+
+`record_messages` runs in the same transaction as the INSERT of a turn's
+rows (see writebehind.write_rows) and bumps Project.message_count /
+last_activity_at and the owner's UserStats with F() expressions, so
+concurrent writers never lose an increment.
+
+Messages deleted outside the chat pipeline (admin, shell) are not tracked;
+`python manage.py rebuild_chat_counters` recomputes everything from the
+messages table and the archive segments.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import ChatArchiveSegment, ChatMessage, Project, UserStats
+
+
+def _bump(queryset, count, latest):
+    return queryset.update(
+        message_count=F('message_count') + count,
+        last_activity_at=Greatest(Coalesce('last_activity_at', Value(latest)), Value(latest)),
+    )
+
+
+def record_messages(rows):
+    """Add freshly inserted ChatMessage rows to the counters."""
+    per_project = defaultdict(lambda: [0, None, None])
+    for row in rows:
+        entry = per_project[row.project_id]
+        entry[0] += 1
+        entry[1] = row.timestamp if entry[1] is None else max(entry[1], row.timestamp)
+        entry[2] = row.project.user_id
+
+    per_user = defaultdict(lambda: [0, None])
+    for project_id, (count, latest, user_id) in per_project.items():
+        _bump(Project.objects.filter(pk=project_id), count, latest)
+        entry = per_user[user_id]
+        entry[0] += count
+        entry[1] = latest if entry[1] is None else max(entry[1], latest)
+
+    for user_id, (count, latest) in per_user.items():
+        if not _bump(UserStats.objects.filter(user_id=user_id), count, latest):
+            # First message of a user created before counters existed
+            UserStats.objects.get_or_create(user_id=user_id)
+            _bump(UserStats.objects.filter(user_id=user_id), count, latest)
+
+
+def forget_project(project):
+    """Take a project's messages off its owner's total before it is deleted."""
+    # Read the count in SQL: the instance being deleted may be stale
+    count = Project.objects.filter(pk=project.pk).values('message_count')
+    UserStats.objects.filter(user_id=project.user_id).update(
+        message_count=Greatest(F('message_count') - Subquery(count), Value(0)),
+    )
+
+
+def rebuild(user_ids=None):
+    """Recompute every counter from ChatMessage and the archive; returns the number of projects updated."""
+    projects = Project.objects.all()
+    if user_ids is not None:
+        projects = projects.filter(user_id__in=user_ids)
+    messages = ChatMessage.objects.filter(project=OuterRef('pk')).order_by().values('project')
+    # Archived messages (see api/archive.py) are all older than the hot ones
+    segments = ChatArchiveSegment.objects.filter(project=OuterRef('pk')).order_by().values('project')
+    archived = Coalesce(Subquery(segments.annotate(n=Sum('message_count')).values('n')), 0)
+    with transaction.atomic():
+        updated = projects.update(
+            message_count=Coalesce(Subquery(messages.annotate(n=Count('id')).values('n')), 0) + archived,
+            archived_message_count=archived,
+            last_activity_at=Coalesce(Subquery(messages.annotate(latest=Max('timestamp')).values('latest')),
+                                      Subquery(segments.annotate(latest=Max('last_timestamp')).values('latest'))),
+        )
+        # From the project counters just rebuilt
+        owners = projects.order_by().values('user_id').annotate(
+            total=Sum('message_count'), latest=Max('last_activity_at'),
+        )
+        seen = set()
+        for owner in owners:
+            UserStats.objects.update_or_create(
+                user_id=owner['user_id'],
+                defaults={'message_count': owner['total'], 'last_activity_at': owner['latest']},
+            )
+            seen.add(owner['user_id'])
+        # Users without projects
+        stale = UserStats.objects.exclude(user_id__in=seen)
+        if user_ids is not None:
+            stale = stale.filter(user_id__in=user_ids)
+        stale.update(message_count=0, last_activity_at=None)
+    return updated
@@ -0,0 +1,115 @@
+"""Hedged model fallback with one overall deadline per chat turn.
+
+Instead of trying the models one after another with a full timeout each,
+`race` starts the first model and, if it has not answered after
+`hedge_delay` seconds, starts the next one alongside it (up to
+`max_parallel` at a time). A failed attempt is replaced straight away.
+The first successful answer wins and every other attempt is cancelled.
+Nothing runs past `deadline` seconds from the start of the turn.
+"""
+import asyncio
+import logging
+from collections import namedtuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEDGE_DELAY = 4.0
+DEFAULT_MAX_PARALLEL = 2
+DEFAULT_DEADLINE = 30.0
+
+Completion = namedtuple('Completion', ['content', 'model', 'latency_ms', 'cached'], defaults=[False])
+
+# response/last_error are what the sequential loop used to leave behind, so
+# llm._read_completion can keep producing the same error messages.
+Outcome = namedtuple('Outcome', ['model', 'response', 'last_error', 'latency_ms'])
+
+
+class FallbackPolicy:
+    def __init__(self, hedge_delay=DEFAULT_HEDGE_DELAY, max_parallel=DEFAULT_MAX_PARALLEL, deadline=DEFAULT_DEADLINE):
+        self.hedge_delay = hedge_delay
+        self.max_parallel = max(1, max_parallel)
+        self.deadline = deadline
+
+    @classmethod
+    def for_project(cls, project):
+        if project is None:
+            return cls()
+        return cls(
+            hedge_delay=project.hedge_delay_ms / 1000,
+            max_parallel=project.max_parallel_attempts,
+            deadline=project.request_deadline_ms / 1000,
+        )
+
+    def __repr__(self):
+        return (f"FallbackPolicy(hedge_delay={self.hedge_delay}, "
+                f"max_parallel={self.max_parallel}, deadline={self.deadline})")
+
+
+async def race(models, attempt, policy):
+    """Run `attempt(model, time_left)` coroutines as hedged requests.
+
+    An attempt succeeds when it returns a response with status 200; any
+    other response or exception counts as a failure of that model.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + policy.deadline
+    queue = list(models)
+    running = {}
+    last_response = None
+    last_error = None
+    next_hedge_at = None
+
+    def elapsed_ms():
+        return int((loop.time() - started) * 1000)
+
+    def launch():
+        nonlocal next_hedge_at
+        model = queue.pop(0)
+        running[asyncio.ensure_future(attempt(model, deadline - loop.time()))] = model
+        next_hedge_at = loop.time() + policy.hedge_delay
+
+    try:
+        launch()
+        while running:
+            now = loop.time()
+            if now >= deadline:
+                last_error = last_error or "Request deadline exceeded."
+                break
+            timeout = deadline - now
+            if queue and len(running) < policy.max_parallel:
+                timeout = min(timeout, max(next_hedge_at - now, 0))
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                model = running.pop(task)
+                try:
+                    response = task.result()
+                except httpx.TimeoutException:
+                    logger.info("Model %s timed out", model)
+                    last_error = "Request timed out."
+                except Exception as e:
+                    logger.info("Model %s raised %s", model, e)
+                    last_error = e
+                else:
+                    if response.status_code == 200:
+                        logger.info("Model %s won after %d ms", model, elapsed_ms())
+                        return Outcome(model, response, None, elapsed_ms())
+                    logger.info("Model %s failed with status %s", model, response.status_code)
+                    last_response = last_error = response
+                # A failure frees its slot for the next model right away
+                if queue:
+                    launch()
+
+            if not done and queue and len(running) < policy.max_parallel and loop.time() >= next_hedge_at:
+                # The running attempts are past the hedge delay
+                launch()
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    return Outcome(None, last_response, last_error, elapsed_ms())
@@ -0,0 +1,71 @@
+"""A file cache that is safe to coordinate workers through.
+
+Admission slots, coalescing locks and the routing probe rely on
+`cache.add` taking a key only if nobody holds it, and counters on `incr`
+not losing updates. Django's FileBasedCache does neither atomically:
+`add` is `has_key` then `set` and `incr` is `get` then `set`, so two
+workers can both take the same key. LockingFileBasedCache runs both under
+an exclusive lock on `<LOCATION>/cache.lock`, which every process sharing
+the directory sees. Redis and Memcached are atomic on their own.
+
+A full FileBasedCache deletes a random third of its entries, live or not;
+this one drops the expired entries first.
+"""
+import contextlib
+import os
+import pickle
+import time
+import zlib
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+
+LOCK_FILE = 'cache.lock'
+
+
+class LockingFileBasedCache(FileBasedCache):
+    @contextlib.contextmanager
+    def _locked(self):
+        self._createdir()
+        # Not a cache file, so clear() and culling leave it alone
+        with open(os.path.join(self._dir, LOCK_FILE), 'ab') as lock_file:
+            locks.lock(lock_file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(lock_file)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            return super().add(key, value, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        # decr() is incr() with a negative delta. Unlike BaseCache.incr this
+        # keeps the key's expiry, as Redis and Memcached do.
+        with self._locked():
+            try:
+                with open(self._key_to_file(key, version), 'rb') as f:
+                    expiry = pickle.load(f)
+                    value = pickle.loads(zlib.decompress(f.read()))
+            except FileNotFoundError:
+                raise ValueError(f"Key '{key}' not found") from None
+            now = time.time()
+            if expiry is not None and expiry <= now:
+                raise ValueError(f"Key '{key}' not found")
+            value += delta
+            self.set(key, value, None if expiry is None else expiry - now, version)
+            return value
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        if len(filelist) < self._max_entries:
+            return
+        for fname in filelist:
+            try:
+                with open(fname, 'rb') as f:
+                    # Deletes the file if it has expired
+                    self._is_expired(f)
+            except FileNotFoundError:
+                pass
+        super()._cull()
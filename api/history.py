@@ -0,0 +1,48 @@
+"""Keyset (cursor) pagination over a project's chat messages.
+
+Pages are walked newest to oldest by (timestamp, id). A cursor encodes the
+position of the oldest message on the current page, so fetching the next
+page is a range scan of the (project, -timestamp, -id) index no matter how
+deep into the conversation it is; unlike OFFSET it never re-reads the rows
+of earlier pages.
+
+Messages moved to cold storage (see api/archive.py) are merged in when a
+page reaches past the hot rows, so scrolling back never ends early.
+"""
+import base64
+from datetime import datetime
+
+from . import archive
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(message):
+    raw = f'{message.timestamp.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) for a cursor; raise ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def history_page(project, before=None, limit=PAGE_SIZE):
+    """Return (messages oldest first, cursor for the next older page or None)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    messages = project.messages.order_by('-timestamp', '-id')
+    position = None
+    if before:
+        position = decode_cursor(before)
+        timestamp, message_id = position
+        messages = messages.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=message_id)
+    # One extra row tells whether an older page exists
+    rows = archive.fill_page(project, list(messages[:limit + 1]), limit + 1, before=position)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit][::-1], next_cursor
@@ -0,0 +1,212 @@
+"""Background ingestion of uploaded files, queued in the database.
+
+An upload only saves the file; the ProjectFile row itself is the job, in
+status `queued`. Workers (`python manage.py run_ingest_worker`) claim jobs
+with a conditional UPDATE, so any number of threads and processes can
+poll the same table without a broker and each job runs once at a time.
+
+Processing streams the file: text is decoded in fixed-size blocks and
+PDFs page by page, words go through a sliding chunker and chunks are
+inserted in batches, so memory stays bounded whatever the file size.
+`bytes_processed` is updated as the file is read.
+
+A job is idempotent: it starts by deleting whatever chunks an earlier,
+interrupted attempt left behind, and the index is rebuilt from the
+database. Failed jobs are retried after `RETRY_DELAY` seconds up to
+`MAX_ATTEMPTS` times; a job left in `processing` by a dead worker is
+picked up again once its lease (`LEASE_SECONDS`) runs out.
+"""
+import codecs
+import logging
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import rag, workqueue
+from .models import DocumentChunk, ProjectFile
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WORKERS': 2,
+    'POLL_INTERVAL': 2.0,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 30,
+    'LEASE_SECONDS': 600,
+    'READ_BLOCK_BYTES': 64 * 1024,
+    'INSERT_BATCH': 500,
+    'IN_PROCESS': False,
+}
+
+TEXT_EXTENSIONS = {'.txt', '.md', '.markdown', '.rst', '.csv'}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'INGEST', {})}
+
+
+# --- streaming extraction ----------------------------------------------------
+
+def iter_text_blocks(path, block_size):
+    """Yield (text, bytes read so far) for a UTF-8 file, one block at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    read = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    yield tail, read
+                return
+            read += len(block)
+            yield decoder.decode(block), read
+
+
+def iter_pdf_pages(path, size_bytes):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("PDF support needs the 'pypdf' package")
+    reader = PdfReader(path)
+    pages = len(reader.pages)
+    for number, page in enumerate(reader.pages, 1):
+        # pypdf has no byte offsets; report progress by page
+        yield (page.extract_text() or '') + '\n', size_bytes * number // pages
+
+
+def iter_words(blocks):
+    """Split streamed text into words without breaking words across blocks.
+
+    Passes (word, bytes read so far) through for progress reporting.
+    """
+    carry = ''
+    read = 0
+    for text, read in blocks:
+        text = carry + text
+        words = text.split()
+        # The last word may continue in the next block
+        carry = words.pop() if words and not text[-1].isspace() else ''
+        for word in words:
+            yield word, read
+    if carry:
+        yield carry, read
+
+
+def chunk_words(words, size=None, overlap=None):
+    """Group a word stream into overlapping chunks; yields (chunk, progress)."""
+    config = rag.get_config()
+    size = size or config['CHUNK_WORDS']
+    overlap = config['CHUNK_OVERLAP'] if overlap is None else overlap
+    step = max(size - overlap, 1)
+    buffer = []
+    fresh = 0
+    progress = 0
+    for word, progress in words:
+        buffer.append(word)
+        fresh += 1
+        if len(buffer) == size:
+            yield ' '.join(buffer), progress
+            buffer = buffer[step:]
+            fresh = 0
+    if fresh:
+        yield ' '.join(buffer), progress
+
+
+def chunk_text(text, size=None, overlap=None):
+    return [chunk for chunk, _ in chunk_words(((w, 0) for w in text.split()), size, overlap)]
+
+
+def iter_chunks(project_file, config):
+    path = project_file.file.path
+    suffix = Path(path).suffix.lower()
+    if suffix in TEXT_EXTENSIONS:
+        blocks = iter_text_blocks(path, config['READ_BLOCK_BYTES'])
+    elif suffix == '.pdf':
+        blocks = iter_pdf_pages(path, project_file.size_bytes)
+    else:
+        raise ValueError(f"Unsupported file type '{suffix or project_file.name}'")
+    return chunk_words(iter_words(blocks))
+
+
+# --- jobs --------------------------------------------------------------------
+
+def process(project_file):
+    """Ingest one claimed file and rebuild its project's index."""
+    config = get_config()
+    # Idempotent retries: start from a clean slate
+    DocumentChunk.objects.filter(file=project_file).delete()
+    batch = []
+    count = 0
+    for content, progress in iter_chunks(project_file, config):
+        batch.append(DocumentChunk(project_id=project_file.project_id, file=project_file,
+                                   ordinal=count, content=content))
+        count += 1
+        if len(batch) >= config['INSERT_BATCH']:
+            DocumentChunk.objects.bulk_create(batch)
+            batch = []
+            ProjectFile.objects.filter(pk=project_file.pk).update(bytes_processed=progress)
+    DocumentChunk.objects.bulk_create(batch)
+    ProjectFile.objects.filter(pk=project_file.pk).update(
+        status=ProjectFile.READY, bytes_processed=project_file.size_bytes, chunk_count=count, error='',
+    )
+    rag.build_index(project_file.project_id)
+    return count
+
+
+def claim(config=None):
+    """Atomically take the next runnable job; returns the ProjectFile or None."""
+    config = config or get_config()
+    now = timezone.now()
+    runnable = (
+        Q(status=ProjectFile.QUEUED, claimed_at__isnull=True)
+        | Q(status=ProjectFile.QUEUED, claimed_at__lte=now - timedelta(seconds=config['RETRY_DELAY']))
+        | Q(status=ProjectFile.PROCESSING, claimed_at__lte=now - timedelta(seconds=config['LEASE_SECONDS']))
+    )
+    for candidate in ProjectFile.objects.filter(runnable).order_by('uploaded_at', 'id').values('pk', 'claimed_at')[:10]:
+        # Whoever flips the row first owns the job
+        won = ProjectFile.objects.filter(pk=candidate['pk'], claimed_at=candidate['claimed_at']).filter(runnable).update(
+            status=ProjectFile.PROCESSING, claimed_at=now, attempts=F('attempts') + 1,
+        )
+        if won:
+            return ProjectFile.objects.get(pk=candidate['pk'])
+    return None
+
+
+def run_job(project_file, config=None):
+    config = config or get_config()
+    started = time.monotonic()
+    try:
+        count = process(project_file)
+    except Exception as e:
+        retry = project_file.attempts < config['MAX_ATTEMPTS']
+        logger.warning("Ingesting %s (attempt %d) failed: %s", project_file, project_file.attempts, e,
+                       exc_info=not isinstance(e, ValueError))
+        ProjectFile.objects.filter(pk=project_file.pk).update(
+            status=ProjectFile.QUEUED if retry and not isinstance(e, ValueError) else ProjectFile.FAILED,
+            error=str(e)[:1000],
+        )
+        return False
+    logger.info("Ingested %s: %d chunks in %.1fs", project_file, count, time.monotonic() - started)
+    return True
+
+
+def run_pending(limit=None, config=None):
+    """Process queued jobs in this thread until none is left; returns how many ran."""
+    return workqueue.run_pending(claim, run_job, config or get_config(), limit)
+
+
+def run_worker(workers=None, poll_interval=None, stop_event=None):
+    """Poll for jobs forever with a pool of `workers` threads."""
+    config = get_config()
+    workqueue.run_worker(claim, run_job, config, 'ingest', workers or config['WORKERS'],
+                         config['POLL_INTERVAL'] if poll_interval is None else poll_interval, stop_event)
+
+
+def kick():
+    """Drain the queue in a background thread of this process (IN_PROCESS mode)."""
+    workqueue.kick(run_pending, 'ingest-inline')
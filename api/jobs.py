@@ -0,0 +1,180 @@
+"""Background chat turns for slow models, queued in the database.
+
+A turn that may outlast the proxy's request timeout can be enqueued
+instead: the ChatJob row is the job, in status `queued`, and the client
+gets its id straight away. Workers (`python manage.py run_chat_worker`)
+claim jobs with a conditional UPDATE like the ingest workers (see
+api/ingest.py), run the turn and store the answer on the row, so results
+survive restarts of both web and worker processes. Clients poll the job,
+or long-poll it for up to `MAX_WAIT` seconds.
+
+A job is retried up to `MAX_ATTEMPTS` times if the turn raises, and one
+left in `running` by a dead worker is picked up again once its lease
+(`LEASE_SECONDS`) runs out. The turn is saved in the same transaction
+that marks the job done, so a retry never saves it twice. Finished jobs
+are deleted after `KEEP_HOURS`.
+
+Queue wait and end-to-end latency are recorded in api/metrics.py, and the
+number of jobs per status is reported at every scrape.
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from . import chat, metrics, project_cache, workqueue
+from .models import ChatJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WORKERS': 8,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 2,
+    'LEASE_SECONDS': 300,
+    'MAX_WAIT': 25.0,
+    'WAIT_POLL_INTERVAL': 0.25,
+    'KEEP_HOURS': 24,
+    'IN_PROCESS': False,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_JOBS', {})}
+
+
+def enqueue(project, message):
+    job = ChatJob.objects.create(project_id=project.id, message=message)
+    if get_config()['IN_PROCESS']:
+        transaction.on_commit(kick)
+    return job
+
+
+def as_dict(job):
+    data = {'job_id': job.pk, 'status': job.status, 'created_at': job.created_at.isoformat()}
+    if job.status == ChatJob.DONE:
+        data.update(response=job.response, model=job.model or None, latency_ms=job.latency_ms)
+    elif job.status == ChatJob.FAILED:
+        data['error'] = job.error
+    if job.finished_at:
+        data['finished_at'] = job.finished_at.isoformat()
+    return data
+
+
+def queue_depth():
+    """{(('status', status),): jobs} for the jobs not finished yet."""
+    counts = dict.fromkeys([ChatJob.QUEUED, ChatJob.RUNNING], 0)
+    counts.update(ChatJob.objects.filter(status__in=list(counts)).values_list('status').annotate(Count('id')))
+    return {(('status', status),): count for status, count in counts.items()}
+
+
+metrics.register_gauge('chat_jobs', 'Chat jobs waiting or running, by status.', queue_depth)
+
+
+def claim(config=None):
+    """Atomically take the next runnable job; returns the ChatJob or None."""
+    config = config or get_config()
+    now = timezone.now()
+    runnable = (
+        Q(status=ChatJob.QUEUED)
+        | Q(status=ChatJob.RUNNING, claimed_at__lte=now - timedelta(seconds=config['LEASE_SECONDS']))
+    )
+    for candidate in ChatJob.objects.filter(runnable).order_by('created_at', 'id').values('pk', 'claimed_at')[:10]:
+        # Whoever flips the row first owns the job
+        won = ChatJob.objects.filter(pk=candidate['pk'], claimed_at=candidate['claimed_at']).filter(runnable).update(
+            status=ChatJob.RUNNING, claimed_at=now, attempts=F('attempts') + 1,
+        )
+        if won:
+            job = ChatJob.objects.get(pk=candidate['pk'])
+            if job.attempts == 1:
+                metrics.registry.observe('chat_job_wait_seconds', {}, (now - job.created_at).total_seconds())
+            return job
+    return None
+
+
+def _finish(job, status, **fields):
+    finished_at = timezone.now()
+    ChatJob.objects.filter(pk=job.pk).update(status=status, finished_at=finished_at, **fields)
+    metrics.registry.observe('chat_job_duration_seconds', {'status': status},
+                             (finished_at - job.created_at).total_seconds())
+
+
+def process(job):
+    project = project_cache.get(job.project_id)
+    if project is None:
+        raise LookupError(f"Project {job.project_id} no longer exists")
+    prompt_content, history = chat.load_context(project, job.message)
+    completion = chat.complete(project, job.message, prompt_content, history)
+    with transaction.atomic():
+        chat.save_turn(project, job.message, completion)
+        _finish(job, ChatJob.DONE, response=completion.content, model=completion.model or '',
+                latency_ms=completion.latency_ms, error='')
+
+
+def run_job(job, config=None):
+    config = config or get_config()
+    try:
+        process(job)
+    except Exception as e:
+        retry = job.attempts < config['MAX_ATTEMPTS'] and not isinstance(e, LookupError)
+        logger.warning("Chat job %s (attempt %d) failed: %s", job.pk, job.attempts, e, exc_info=True)
+        if retry:
+            ChatJob.objects.filter(pk=job.pk).update(status=ChatJob.QUEUED, error=str(e)[:1000])
+        else:
+            _finish(job, ChatJob.FAILED, error=str(e)[:1000])
+        return False
+    finally:
+        # Worker processes serve no requests, so nothing else flushes their metrics
+        metrics.maybe_flush()
+    return True
+
+
+def run_pending(limit=None, config=None):
+    """Run queued jobs in this thread until none is left; returns how many ran."""
+    return workqueue.run_pending(claim, run_job, config or get_config(), limit)
+
+
+def prune(config=None):
+    """Delete jobs finished more than `KEEP_HOURS` ago; returns how many."""
+    config = config or get_config()
+    cutoff = timezone.now() - timedelta(hours=config['KEEP_HOURS'])
+    deleted, _ = ChatJob.objects.filter(finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def run_worker(workers=None, poll_interval=None, stop_event=None):
+    """Poll for jobs forever with a pool of `workers` threads."""
+    config = get_config()
+    next_prune = 0.0
+
+    def prune_hourly():
+        nonlocal next_prune
+        if time.monotonic() >= next_prune:
+            prune(config)
+            next_prune = time.monotonic() + 3600
+
+    workqueue.run_worker(claim, run_job, config, 'chat-job', workers or config['WORKERS'],
+                         config['POLL_INTERVAL'] if poll_interval is None else poll_interval, stop_event,
+                         tick=prune_hourly)
+
+
+def kick():
+    """Run the queue in a background thread of this process (IN_PROCESS mode)."""
+    workqueue.kick(run_pending, 'chat-job-inline')
+
+
+async def await_job(job_id, user, wait):
+    """The user's job once finished, or as it stands after `wait` seconds; raises ChatJob.DoesNotExist."""
+    config = get_config()
+    deadline = time.monotonic() + min(wait, config['MAX_WAIT'])
+    jobs = ChatJob.objects.filter(project__user=user)
+    while True:
+        job = await jobs.aget(pk=job_id)
+        if job.status in (ChatJob.DONE, ChatJob.FAILED) or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(config['WAIT_POLL_INTERVAL'])
@@ -0,0 +1,253 @@
+import itertools
+import json
+import logging
+import time
+
+import httpx
+from django.conf import settings
+
+from . import fallback, metrics, upstream
+from .fallback import Completion, FallbackPolicy
+from .routing import router
+
+logger = logging.getLogger(__name__)
+
+AI_MODELS = [
+    # List of models to try in order of preference (Free/Cheaper -> capabilities)
+    "meta-llama/llama-3-8b-instruct",
+    "meta-llama/llama-3-70b-instruct",
+    "mistralai/mistral-7b-instruct",
+    "openai/gpt-3.5-turbo"
+]
+
+
+def _get_api_key():
+    api_key = settings.OPENROUTER_API_KEY
+    if api_key:
+        api_key = api_key.strip()
+
+    # Graceful fallback for missing or placeholder keys
+    if not api_key or "yourkeyhere" in api_key:
+        logger.debug("No usable OpenRouter API key, replying in sandbox mode")
+        return None
+    return api_key
+
+
+def sandbox_mode():
+    """True when no usable API key is configured and replies are simulated."""
+    api_key = (settings.OPENROUTER_API_KEY or '').strip()
+    return not api_key or "yourkeyhere" in api_key
+
+
+def _sandbox_response(message):
+    return f"Sandbox Mode: I received your message '{message}'. Since no valid API key is set, I'm simulating a response."
+
+
+def _build_headers(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+
+def _build_messages(message, system_prompt=None, history=None):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if history:
+        for msg in history:
+            if hasattr(msg, 'role'):
+                messages.append({"role": msg.role, "content": msg.content})
+            else:
+                messages.append({"role": msg['role'], "content": msg['content']})
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+def _elapsed_ms(started):
+    return int((time.monotonic() - started) * 1000)
+
+
+def _read_completion(response, last_error):
+    """Turn the outcome of the model fallback loop into the reply text.
+
+    Shared by the sync and async paths, which both hand over httpx responses.
+    """
+    # If we exhausted all models and still don't have a 200 response
+    if response is None or response.status_code != 200:
+        if response is None or last_error is not response:
+            # It was a connection error or similar
+            return f"Error: All models failed. Last error: {str(last_error)}"
+        logger.warning("API request failed: %s - %s", response.status_code, response.text)
+
+    try:
+        # Handle 401 Unauthorized (User not found / Invalid Key) gracefully
+        if response.status_code == 401:
+            try:
+                err_body = response.json()
+                msg = err_body.get('error', {}).get('message', 'Unknown Auth Error')
+            except ValueError:
+                msg = response.text
+            return f"Sandbox Mode (Auth Failed): {msg}"
+
+        response_json = response.json()
+        if "choices" not in response_json:
+            error_msg = response_json.get('error', {}).get('message', 'Unknown error')
+            if "User not found" in error_msg:
+                return f"Sandbox Mode (User not found): {error_msg}"
+            return f"AI Error: {error_msg}"
+        return response_json["choices"][0]["message"]["content"]
+    except Exception as e:
+        logger.warning("Could not read the completion: %s", e)
+        return f"AI Error: {str(e)}"
+
+
+async def aget_ai_completion(message, system_prompt=None, history=None, policy=None):
+    """Run a chat turn through the hedged fallback engine.
+
+    Returns a fallback.Completion carrying the reply text plus the model that
+    won and how long the turn took (model is None when every attempt failed).
+    """
+    api_key = _get_api_key()
+    if not api_key:
+        return Completion(_sandbox_response(message), None, None)
+
+    headers = _build_headers(api_key)
+    messages = _build_messages(message, system_prompt, history)
+    policy = policy or FallbackPolicy()
+    total_timeout = upstream.get_config()['TOTAL_TIMEOUT']
+    attempts = itertools.count(1)
+
+    async def attempt(model, time_left):
+        number = next(attempts)
+        logger.debug("Attempt %d with model %s", number, model)
+        data = {"model": model, "messages": messages}
+        started = time.monotonic()
+        try:
+            response = await upstream.apost(
+                settings.OPENROUTER_API_URL, headers=headers, json=data,
+                total_timeout=min(total_timeout, time_left),
+            )
+        except httpx.HTTPError:
+            await router.arecord(model, _elapsed_ms(started), ok=False)
+            metrics.observe_upstream(model, 'error', number, time.monotonic() - started)
+            raise
+        # Cancelled hedge losers never get here and are not counted against the model
+        await router.arecord(model, _elapsed_ms(started), ok=response.status_code == 200, status=response.status_code)
+        metrics.observe_upstream(model, response.status_code, number, time.monotonic() - started)
+        if response.status_code != 200:
+            logger.warning("Model %s failed: %s - %s", model, response.status_code, response.text)
+        return response
+
+    outcome = await fallback.race(await router.acandidates(AI_MODELS), attempt, policy)
+    if outcome.model:
+        logger.debug("Success with model %s in %d ms", outcome.model, outcome.latency_ms)
+    content = _read_completion(outcome.response, outcome.last_error)
+    return Completion(content, outcome.model, outcome.latency_ms)
+
+
+def get_ai_completion(message, system_prompt=None, history=None, policy=None):
+    return upstream.run_sync(aget_ai_completion(message, system_prompt, history, policy))
+
+
+def get_ai_response(message, system_prompt=None, history=None, policy=None):
+    return get_ai_completion(message, system_prompt, history, policy).content
+
+
+async def aget_ai_response(message, system_prompt=None, history=None, policy=None):
+    """Non-blocking twin of get_ai_response for async views.
+
+    Uses the pooled httpx.AsyncClient, so a single ASGI worker can keep many
+    upstream calls in flight while each one waits on OpenRouter.
+    """
+    return (await aget_ai_completion(message, system_prompt, history, policy)).content
+
+
+_DONE = object()
+
+
+def _sse_data(line):
+    """The decoded JSON payload of an SSE `data:` line, None for other lines, _DONE at the end."""
+    # Blank lines separate events, ':' lines are keep-alive comments
+    if not line or line.startswith(':') or not line.startswith('data:'):
+        return None
+    payload = line[len('data:'):].strip()
+    if payload == '[DONE]':
+        return _DONE
+    return json.loads(payload)
+
+
+async def _aiter_sse_data(response):
+    """Yield the decoded JSON payload of each `data:` line of an SSE body."""
+    async for line in upstream.aiter_lines(response):
+        data = _sse_data(line)
+        if data is _DONE:
+            return
+        if data is not None:
+            yield data
+
+
+def _delta(chunk):
+    """The content delta of a streamed chunk, or None; raises on an in-stream error."""
+    if 'error' in chunk:
+        raise RuntimeError(chunk['error'].get('message', 'Unknown error'))
+    choices = chunk.get('choices') or [{}]
+    return choices[0].get('delta', {}).get('content')
+
+
+async def astream_ai_response(message, system_prompt=None, history=None, policy=None):
+    """Async generator variant of get_ai_response that yields content deltas as they arrive.
+
+    Streams cannot be hedged once tokens are flowing, so models are tried in
+    order; the policy's deadline bounds how long we wait for one to start.
+    Closing or cancelling the generator closes the upstream response, so a
+    turn the client abandons stops generating (and billing) tokens.
+    """
+    api_key = _get_api_key()
+    if not api_key:
+        for word in _sandbox_response(message).split(' '):
+            yield word + ' '
+        return
+
+    headers = _build_headers(api_key)
+    messages = _build_messages(message, system_prompt, history)
+    last_error = None
+    started = False
+    policy = policy or FallbackPolicy()
+    deadline = time.monotonic() + policy.deadline
+
+    for number, model in enumerate(await router.acandidates(AI_MODELS), start=1):
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            last_error = "Request deadline exceeded."
+            break
+        data = {"model": model, "messages": messages, "stream": True}
+        logger.debug("Streaming with model %s", model)
+        attempt_started = time.monotonic()
+        try:
+            async with upstream.astream(settings.OPENROUTER_API_URL, headers=headers, json=data,
+                                        start_timeout=time_left) as response:
+                await router.arecord(model, _elapsed_ms(attempt_started), ok=response.status_code == 200,
+                                     status=response.status_code)
+                metrics.observe_upstream(model, response.status_code, number, time.monotonic() - attempt_started)
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.warning("Streaming with model %s failed: %s - %s", model, response.status_code,
+                                   response.text)
+                    last_error = f"{response.status_code} - {response.text}"
+                    continue
+                async for chunk in _aiter_sse_data(response):
+                    delta = _delta(chunk)
+                    if delta:
+                        started = True
+                        yield delta
+                return
+        except httpx.TransportError as e:
+            if started:
+                raise
+            await router.arecord(model, _elapsed_ms(attempt_started), ok=False)
+            metrics.observe_upstream(model, 'error', number, time.monotonic() - attempt_started)
+            logger.warning("Streaming with model %s raised %s", model, e)
+            last_error = str(e)
+
+    raise RuntimeError(f"All models failed. Last error: {last_error}")
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api import archive
+from api.models import Project
+
+
+def _size(n):
+    if abs(n) < 1024 * 1024:
+        return f"{n / 1024:.1f} KiB"
+    return f"{n / 1024 / 1024:.1f} MiB"
+
+
+class Command(BaseCommand):
+    help = "Move chat messages older than each project's horizon into compressed archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, action='append', dest='project_ids',
+                            help="Only compact this project id (repeatable).")
+        parser.add_argument('--max-segments', type=int,
+                            help="Stop after writing this many segments; the next run carries on.")
+        parser.add_argument('--vacuum', action='store_true',
+                            help="VACUUM the database afterwards to give the freed pages back to the filesystem.")
+
+    def handle(self, *args, **options):
+        config = archive.get_config()
+        projects = Project.objects.order_by('pk')
+        if options['project_ids']:
+            projects = projects.filter(pk__in=options['project_ids'])
+        budget = options['max_segments']
+        rows_before, size_before = archive.hot_table_size()
+        totals = [0, 0, 0, 0]
+        for project in projects.iterator():
+            if budget is not None and totals[0] >= budget:
+                self.stdout.write("Segment limit reached; run again to continue.")
+                break
+            done = archive.compact_project(project, config,
+                                           max_segments=None if budget is None else budget - totals[0])
+            if done[0]:
+                self.stdout.write(f"Project {project.pk}: {done[1]} message(s) in {done[0]} segment(s).")
+            totals = [total + n for total, n in zip(totals, done)]
+
+        segments, messages, raw_bytes, stored_bytes = totals
+        if options['vacuum']:
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {messages} message(s) in {segments} segment(s): {_size(raw_bytes)} of messages "
+            f"stored in {_size(stored_bytes)}, {_size(raw_bytes - stored_bytes)} saved."
+        ))
+        rows, size = archive.hot_table_size()
+        if size is not None and size_before is not None:
+            self.stdout.write(f"Hot table: {rows_before} -> {rows} message(s), "
+                              f"{_size(size_before)} -> {_size(size)} with indexes.")
+        else:
+            self.stdout.write(f"Hot table: {rows_before} -> {rows} message(s).")
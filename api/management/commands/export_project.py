@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import transfer
+from api.models import Project
+
+
+class Command(BaseCommand):
+    help = "Write a project's prompts, file list and messages as JSONL (see api/transfer.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id', type=int)
+        parser.add_argument('-o', '--output', default='-',
+                            help="File to write (default: stdout).")
+        parser.add_argument('--gzip', action='store_true',
+                            help="Compress the output with gzip.")
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=options['project_id'])
+        except Project.DoesNotExist:
+            raise CommandError(f"Project {options['project_id']} does not exist.")
+        if options['output'] == '-':
+            out = sys.stdout.buffer
+            for chunk in transfer.export_chunks(project, options['gzip']):
+                out.write(chunk)
+            out.flush()
+            return
+        with open(options['output'], 'wb') as out:
+            for chunk in transfer.export_chunks(project, options['gzip']):
+                out.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Exported project {project.pk} to {options['output']}."))
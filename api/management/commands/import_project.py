@@ -0,0 +1,39 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api import transfer
+
+
+class Command(BaseCommand):
+    help = "Create a project from a JSONL export, gzipped or not (see api/transfer.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Export file to read, or - for stdin.")
+        parser.add_argument('--user', required=True,
+                            help="Username of the owner of the new project.")
+        parser.add_argument('--name',
+                            help="Name of the new project (default: the exported name).")
+        parser.add_argument('--batch-size', type=int, default=transfer.BATCH_SIZE,
+                            help="Rows inserted per bulk INSERT.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']!r} does not exist.")
+        try:
+            if options['path'] == '-':
+                project, counts = transfer.import_stream(sys.stdin.buffer, user, options['name'],
+                                                         options['batch_size'])
+            else:
+                with open(options['path'], 'rb') as stream:
+                    project, counts = transfer.import_stream(stream, user, options['name'], options['batch_size'])
+        except (OSError, transfer.TransferError) as e:
+            raise CommandError(str(e))
+        skipped = f", {counts['skipped_files']} file(s) missing from storage skipped" if counts['skipped_files'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported project {project.pk} ({project.name}): {counts['messages']} message(s), "
+            f"{counts['prompts']} prompt(s), {counts['files']} file(s) queued for indexing{skipped}."
+        ))
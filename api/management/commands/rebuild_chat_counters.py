@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute per-project and per-user message counters from the ChatMessage table and the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help="Only rebuild counters for this user id (repeatable).")
+
+    def handle(self, *args, **options):
+        updated = counters.rebuild(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt counters for {updated} project(s)."))
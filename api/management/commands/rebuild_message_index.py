@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api import search
+
+
+class Command(BaseCommand):
+    help = "Create the full-text message index if it is missing and re-index every chat message."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--optimize', action='store_true',
+                            help="Merge the index afterwards for faster searches.")
+
+    def handle(self, *args, **options):
+        count = search.rebuild(options['optimize'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} message(s)."))
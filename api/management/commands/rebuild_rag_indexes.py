@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api import rag
+from api.models import ProjectFile
+
+
+class Command(BaseCommand):
+    help = "Rebuild the retrieval index of every project with ingested files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, action='append', help="Only this project (repeatable).")
+
+    def handle(self, *args, **options):
+        project_ids = options['project'] or sorted(set(
+            ProjectFile.objects.filter(status=ProjectFile.READY).values_list('project_id', flat=True)))
+        chunks = 0
+        for project_id in project_ids:
+            chunks += rag.build_index(project_id)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {chunks} chunk(s) in {len(project_ids)} project(s)."))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = "Answer chat turns queued through the job endpoint."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help="Turns answered in parallel (default: CHAT_JOBS['WORKERS']).")
+        parser.add_argument('--poll-interval', type=float,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the queue in this thread and exit.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            done = jobs.run_pending()
+            self.stdout.write(self.style.SUCCESS(f"Ran {done} job(s)."))
+            return
+        workers = options['workers'] or jobs.get_config()['WORKERS']
+        self.stdout.write(f"Chat worker started with {workers} thread(s).")
+        try:
+            jobs.run_worker(workers, options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from api import ingest
+
+
+class Command(BaseCommand):
+    help = "Chunk and index uploaded files queued by the web process."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help="Files processed in parallel (default: INGEST['WORKERS']).")
+        parser.add_argument('--poll-interval', type=float,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the queue in this thread and exit.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            done = ingest.run_pending()
+            self.stdout.write(self.style.SUCCESS(f"Processed {done} file(s)."))
+            return
+        workers = options['workers'] or ingest.get_config()['WORKERS']
+        self.stdout.write(f"Ingest worker started with {workers} thread(s).")
+        try:
+            ingest.run_worker(workers, options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,277 @@
+"""In-process request and upstream metrics, exposed in Prometheus text format.
+
+`RequestMetricsMiddleware` times every request and, through a wrapper put
+on each database connection, counts the queries it ran and the time
+spent in them. llm.py reports every upstream attempt with its model,
+status and attempt number. All of it is aggregated in a per-process
+`Registry` of counters and histograms.
+
+Each worker process writes a snapshot of its registry to the coordination
+cache (see api/coordination.py) at most every `FLUSH_INTERVAL` seconds, and `render()` merges the
+snapshots of every worker seen in the last `WORKER_TTL` seconds, so the
+/metrics endpoint reports the whole host whichever worker serves it.
+Figures from other workers can be up to `FLUSH_INTERVAL` seconds old.
+"""
+import contextvars
+import os
+import socket
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .coordination import cache
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TOKEN': '',
+    'FLUSH_INTERVAL': 5.0,
+    'WORKER_TTL': 3600,
+    'KEY_PREFIX': 'metrics',
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# name: (type, help, buckets)
+METRICS = {
+    'chat_http_requests_total': ('counter', 'HTTP requests by view, method and status.', None),
+    'chat_http_request_duration_seconds': ('histogram', 'Time to build the response, by view.', LATENCY_BUCKETS),
+    'chat_http_request_db_queries': ('histogram', 'Database queries per request, by view.', QUERY_COUNT_BUCKETS),
+    'chat_http_request_db_seconds': ('histogram', 'Time spent in database queries per request, by view.',
+                                     LATENCY_BUCKETS),
+    'chat_admission_rejections_total': ('counter', 'Chat turns refused with a 429, by reason.', None),
+    'chat_upstream_request_duration_seconds': (
+        'histogram', 'Upstream attempts by model, status and attempt number (streams: time to first byte).',
+        LATENCY_BUCKETS),
+    'chat_job_wait_seconds': ('histogram', 'Time chat jobs spent queued before a worker took them.',
+                              LATENCY_BUCKETS),
+    'chat_job_duration_seconds': ('histogram', 'Time from enqueueing a chat job to its result, by status.',
+                                  LATENCY_BUCKETS),
+}
+
+# name: (help, function returning {label pairs: value}), read when rendering
+GAUGES = {}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+
+class Registry:
+    """Thread-safe counters and histograms keyed by metric name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.values = {name: {} for name in METRICS}
+
+    def inc(self, name, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.values[name]
+            entry = series.get(key)
+            if entry is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                entry = series[key] = [[0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {key: [list(v[0]), v[1], v[2]] if isinstance(v, list) else v for key, v in series.items()}
+                for name, series in self.values.items()
+            }
+
+
+registry = Registry()
+_last_flush = 0.0
+
+# Per-request accumulator of [query count, seconds], see `record_query`
+_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper; installed on every connection by signals.py."""
+    totals = _queries.get()
+    if totals is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        totals[0] += 1
+        totals[1] += time.perf_counter() - started
+
+
+def start_request():
+    """Begin counting the current request's queries; returns a token for `finish_request`."""
+    totals = [0, 0.0]
+    return _queries.set(totals), totals
+
+
+def _record_request(token, totals, view, method, status, seconds):
+    _queries.reset(token)
+    registry.inc('chat_http_requests_total', {'view': view, 'method': method, 'status': str(status)})
+    registry.observe('chat_http_request_duration_seconds', {'view': view}, seconds)
+    registry.observe('chat_http_request_db_queries', {'view': view}, totals[0])
+    registry.observe('chat_http_request_db_seconds', {'view': view}, totals[1])
+
+
+def finish_request(token, totals, view, method, status, seconds):
+    _record_request(token, totals, view, method, status, seconds)
+    maybe_flush()
+
+
+async def afinish_request(token, totals, view, method, status, seconds):
+    """`finish_request` for async requests: a due flush writes the cache from a worker thread."""
+    _record_request(token, totals, view, method, status, seconds)
+    if _claim_flush():
+        await sync_to_async(flush, thread_sensitive=False)()
+
+
+def observe_upstream(model, status, attempt, seconds):
+    """Record one upstream attempt; `status` is the HTTP status or 'error'."""
+    if not get_config()['ENABLED']:
+        return
+    registry.observe('chat_upstream_request_duration_seconds',
+                     {'model': model, 'status': str(status), 'attempt': str(attempt)}, seconds)
+
+
+def register_gauge(name, help_text, read):
+    """Report `read()` at every scrape, for values kept outside the registry (e.g. queue depth)."""
+    GAUGES[name] = (help_text, read)
+
+
+def _worker_id():
+    # Not cached at import: gunicorn --preload forks workers after it
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _workers_key(config):
+    return f"{config['KEY_PREFIX']}:workers"
+
+
+def _worker_key(config, worker_id):
+    return f"{config['KEY_PREFIX']}:worker:{worker_id}"
+
+
+def flush():
+    """Publish this worker's snapshot for the other workers' /metrics."""
+    global _last_flush
+    config = get_config()
+    _last_flush = time.monotonic()
+    worker_id = _worker_id()
+    cache.set(_worker_key(config, worker_id), registry.snapshot(), config['WORKER_TTL'])
+    workers = cache.get(_workers_key(config)) or {}
+    now = time.time()
+    # Rewritten at most once a minute per worker; a registration lost to a
+    # concurrent write is repeated on a later flush
+    if now - workers.get(worker_id, 0) > 60:
+        workers = {w: seen for w, seen in workers.items() if now - seen < config['WORKER_TTL']}
+        workers[worker_id] = now
+        cache.set(_workers_key(config), workers, config['WORKER_TTL'])
+
+
+def _claim_flush():
+    """True for the one caller per `FLUSH_INTERVAL` that should flush."""
+    global _last_flush
+    now = time.monotonic()
+    if now - _last_flush < get_config()['FLUSH_INTERVAL']:
+        return False
+    # Claimed before the flush starts, so requests finishing meanwhile skip it
+    _last_flush = now
+    return True
+
+
+def maybe_flush():
+    if _claim_flush():
+        flush()
+
+
+def collect():
+    """Merge the snapshots of every live worker, this one up to date."""
+    config = get_config()
+    flush()
+    workers = cache.get(_workers_key(config)) or {}
+    snapshots = cache.get_many([_worker_key(config, w) for w in workers]).values()
+    merged = {name: {} for name in METRICS}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            if name not in merged:
+                continue
+            target = merged[name]
+            for key, value in series.items():
+                if not isinstance(value, list):
+                    target[key] = target.get(key, 0) + value
+                elif key not in target:
+                    target[key] = [list(value[0]), value[1], value[2]]
+                else:
+                    entry = target[key]
+                    entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                    entry[1] += value[1]
+                    entry[2] += value[2]
+    return merged, len(snapshots)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """The merged metrics in the Prometheus text exposition format."""
+    merged, workers = collect()
+    lines = [
+        '# HELP chat_metrics_workers Worker processes whose metrics are included.',
+        '# TYPE chat_metrics_workers gauge',
+        f'chat_metrics_workers {workers}',
+    ]
+    for name, (help_text, read) in GAUGES.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for key, value in sorted(read().items()):
+            lines.append(f'{name}{_labels(key)} {_number(value)}')
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(merged[name].items()):
+            if kind == 'counter':
+                lines.append(f'{name}{_labels(key)} {_number(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                le = _labels(key + (('le', _number(float(bound))),))
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            le = _labels(key + (('le', '+Inf'),))
+            lines.append(f'{name}_bucket{le} {count}')
+            lines.append(f'{name}_sum{_labels(key)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(key)} {count}')
+    return '\n'.join(lines) + '\n'
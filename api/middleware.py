@@ -0,0 +1,50 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class RequestMetricsMiddleware:
+    """Record latency and database work of every request (see api/metrics.py).
+
+    Goes first in MIDDLEWARE so the timing covers the rest of the stack.
+    For streamed responses the time is up to the first byte, not the end
+    of the stream.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = metrics.get_config()['ENABLED']
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        started = time.perf_counter()
+        token, totals = metrics.start_request()
+        response = self.get_response(request)
+        metrics.finish_request(token, totals, self.view_name(request), request.method, response.status_code,
+                               time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        started = time.perf_counter()
+        token, totals = metrics.start_request()
+        response = await self.get_response(request)
+        # Off the event loop when it writes this worker's snapshot to the cache
+        await metrics.afinish_request(token, totals, self.view_name(request), request.method,
+                                      response.status_code, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def view_name(request):
+        match = request.resolver_match
+        return match.view_name if match else 'unresolved'
@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_projectfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='latency_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='hedge_delay_ms',
+            field=models.PositiveIntegerField(default=4000, help_text='Start the next model once the current one has run this long.'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='max_parallel_attempts',
+            field=models.PositiveSmallIntegerField(default=2, help_text='Maximum number of models queried at the same time.'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='request_deadline_ms',
+            field=models.PositiveIntegerField(default=30000, help_text='Overall time limit for one chat turn.'),
+        ),
+    ]
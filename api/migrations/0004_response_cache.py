@@ -0,0 +1,23 @@
+# Generated by Django 6.0.1 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_fallback_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='response_cache_enabled',
+            field=models.BooleanField(default=False, help_text='Answer repeated identical turns from the cache.'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='response_cache_ttl',
+            field=models.PositiveIntegerField(default=3600, help_text='Seconds a cached reply stays valid.'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_active_prompt(apps, schema_editor):
+    Project = apps.get_model('api', 'Project')
+    Prompt = apps.get_model('api', 'Prompt')
+    latest = Prompt.objects.filter(project=OuterRef('pk')).order_by('-created_at', '-id').values('pk')[:1]
+    Project.objects.update(active_prompt=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_response_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='active_prompt',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.prompt'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['project', '-timestamp'], name='message_project_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prompt',
+            index=models.Index(fields=['project', '-created_at'], name='prompt_project_created_idx'),
+        ),
+        migrations.RunPython(backfill_active_prompt, migrations.RunPython.noop),
+    ]
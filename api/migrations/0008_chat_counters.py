@@ -0,0 +1,63 @@
+# Generated by Django 6.0.1 on 2026-10-18 16:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    Project = apps.get_model('api', 'Project')
+    ChatMessage = apps.get_model('api', 'ChatMessage')
+    UserStats = apps.get_model('api', 'UserStats')
+    messages = ChatMessage.objects.filter(project=OuterRef('pk')).order_by().values('project')
+    Project.objects.update(
+        message_count=Coalesce(Subquery(messages.annotate(n=Count('id')).values('n')), 0),
+        last_activity_at=Subquery(messages.annotate(latest=Max('timestamp')).values('latest')),
+    )
+    totals = {
+        row['user_id']: row
+        for row in Project.objects.order_by().values('user_id').annotate(
+            total=Count('messages'), latest=Max('messages__timestamp'))
+    }
+    UserStats.objects.bulk_create([
+        UserStats(user_id=user_id, message_count=totals.get(user_id, {}).get('total', 0),
+                  last_activity_at=totals.get(user_id, {}).get('latest'))
+        for user_id in User.objects.values_list('id', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('last_activity_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='chat_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'user stats',
+            },
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
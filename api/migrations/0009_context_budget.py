@@ -0,0 +1,30 @@
+# Generated by Django 6.0.1 on 2026-10-18 16:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_chat_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='context_token_budget',
+            field=models.PositiveIntegerField(default=3000, help_text='Approximate tokens of system prompt, summary and history sent per turn.'),
+        ),
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(blank=True)),
+                ('through_timestamp', models.DateTimeField()),
+                ('through_id', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('project', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summary', to='api.project')),
+            ],
+        ),
+    ]
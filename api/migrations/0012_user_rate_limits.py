@@ -0,0 +1,26 @@
+# Generated by Django 6.0.1 on 2026-10-18 17:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_file_ingestion_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRateLimit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requests_per_minute', models.PositiveIntegerField(blank=True, help_text='Sustained chat turns per minute. Empty for the site default.', null=True)),
+                ('burst', models.PositiveIntegerField(blank=True, help_text='Chat turns allowed back to back. Empty for the site default.', null=True)),
+                ('exempt', models.BooleanField(default=False, help_text='Skip the per-user and per-project limits; the global concurrency cap still applies.')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='chat_rate_limit', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 6.0.1 on 2026-10-18 17:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_user_rate_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField()),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', editable=False, max_length=10)),
+                ('response', models.TextField(blank=True, editable=False)),
+                ('model', models.CharField(blank=True, editable=False, max_length=100)),
+                ('latency_ms', models.PositiveIntegerField(blank=True, editable=False, null=True)),
+                ('error', models.TextField(blank=True, editable=False)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_jobs', to='api.project')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'claimed_at'], name='chatjob_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 6.0.1 on 2026-10-18 17:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_chat_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='archive_after_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Move messages older than this many days to compressed archive segments. Empty for the site default.', null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='archived_message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ChatArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('codec', models.CharField(choices=[('zlib', 'zlib'), ('zstd', 'Zstandard')], default='zlib', max_length=10)),
+                ('data', models.BinaryField()),
+                ('raw_bytes', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='api.project')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['project', '-last_timestamp', '-last_id'], name='archive_project_last_idx')],
+            },
+        ),
+    ]
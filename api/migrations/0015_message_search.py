@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# Kept in sync with api/search.py (INDEX_SQL), which can recreate them.
+# SQLite rebuilds a table to alter it, which drops its triggers: a migration
+# that alters ChatMessage must be followed by `manage.py rebuild_message_index`.
+CREATE = [
+    "CREATE VIRTUAL TABLE api_chatmessage_fts USING fts5("
+    "content, content='api_chatmessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER api_chatmessage_fts_insert AFTER INSERT ON api_chatmessage BEGIN "
+    "INSERT INTO api_chatmessage_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER api_chatmessage_fts_delete AFTER DELETE ON api_chatmessage BEGIN "
+    "INSERT INTO api_chatmessage_fts (api_chatmessage_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER api_chatmessage_fts_update AFTER UPDATE OF content ON api_chatmessage BEGIN "
+    "INSERT INTO api_chatmessage_fts (api_chatmessage_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO api_chatmessage_fts (rowid, content) VALUES (new.id, new.content); END",
+    # Index the messages already there
+    "INSERT INTO api_chatmessage_fts (api_chatmessage_fts) VALUES ('rebuild')",
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS api_chatmessage_fts_insert",
+    "DROP TRIGGER IF EXISTS api_chatmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS api_chatmessage_fts_update",
+    "DROP TABLE IF EXISTS api_chatmessage_fts",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_chat_archive'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE, DROP),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 class Project(models.Model):
@@ -6,6 +7,25 @@ class Project(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Model fallback tuning (see api/fallback.py)
+    hedge_delay_ms = models.PositiveIntegerField(default=4000, help_text="Start the next model once the current one has run this long.")
+    max_parallel_attempts = models.PositiveSmallIntegerField(default=2, help_text="Maximum number of models queried at the same time.")
+    request_deadline_ms = models.PositiveIntegerField(default=30000, help_text="Overall time limit for one chat turn.")
+    # Reply cache for FAQ-style projects (see api/response_cache.py)
+    response_cache_enabled = models.BooleanField(default=False, help_text="Answer repeated identical turns from the cache.")
+    response_cache_ttl = models.PositiveIntegerField(default=3600, help_text="Seconds a cached reply stays valid.")
+    # Latest prompt, kept up to date by signals so a chat turn does not have
+    # to sort the project's prompts to find it
+    active_prompt = models.ForeignKey('Prompt', null=True, blank=True, on_delete=models.SET_NULL,
+                                      related_name='+', editable=False)
+    # History sent per turn (see api/context.py)
+    context_token_budget = models.PositiveIntegerField(default=3000, help_text="Approximate tokens of system prompt, summary and history sent per turn.")
+    # Denormalised counters, maintained by api/counters.py
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    last_activity_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Cold storage of old messages (see api/archive.py)
+    archive_after_days = models.PositiveIntegerField(null=True, blank=True, help_text="Move messages older than this many days to compressed archive segments. Empty for the site default.")
+    archived_message_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -15,6 +35,11 @@ class Prompt(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', '-created_at'], name='prompt_project_created_idx'),
+        ]
+
     def __str__(self):
         return f"Prompt for {self.project.name} - {self.created_at}"
 
@@ -26,16 +51,158 @@ class ChatMessage(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set explicitly for batched/deferred writes, see chat.turn_rows
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Which model produced an assistant reply and how long the turn took
+    model = models.CharField(max_length=100, blank=True)
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', '-timestamp', '-id'], name='message_project_ts_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}"
 
+class ChatArchiveSegment(models.Model):
+    """A run of consecutive old messages of a project, compressed into one row (see api/archive.py)."""
+    ZLIB = 'zlib'
+    ZSTD = 'zstd'
+    CODEC_CHOICES = [
+        (ZLIB, 'zlib'),
+        (ZSTD, 'Zstandard'),
+    ]
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='archive_segments')
+    # Keyset positions of the oldest and newest message in the segment
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    codec = models.CharField(max_length=10, choices=CODEC_CHOICES, default=ZLIB)
+    data = models.BinaryField()
+    # Size of the uncompressed JSON, for reporting
+    raw_bytes = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', '-last_timestamp', '-last_id'], name='archive_project_last_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.project.name}: {self.message_count} messages up to {self.last_timestamp}"
+
 class ProjectFile(models.Model):
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='files')
     file = models.FileField(upload_to='project_files/')
     name = models.CharField(max_length=255)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Ingestion job state, driven by api/ingest.py
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, editable=False)
+    size_bytes = models.BigIntegerField(default=0, editable=False)
+    bytes_processed = models.BigIntegerField(default=0, editable=False)
+    chunk_count = models.PositiveIntegerField(default=0, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'claimed_at'], name='projectfile_queue_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+class DocumentChunk(models.Model):
+    """A slice of an uploaded file's text, the unit of retrieval (see api/rag.py)."""
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='chunks')
+    file = models.ForeignKey(ProjectFile, on_delete=models.CASCADE, related_name='chunks')
+    ordinal = models.PositiveIntegerField()
+    content = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'ordinal'], name='chunk_file_ordinal_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.file.name} #{self.ordinal}"
+
+class ConversationSummary(models.Model):
+    """Rolling summary of the messages that no longer fit a project's context window."""
+    project = models.OneToOneField(Project, on_delete=models.CASCADE, related_name='conversation_summary')
+    content = models.TextField(blank=True)
+    # Newest message folded in so far, as a (timestamp, id) keyset position
+    through_timestamp = models.DateTimeField()
+    through_id = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary for {self.project.name}"
+
+class UserStats(models.Model):
+    """Per-user message totals, maintained by api/counters.py."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='chat_stats')
+    message_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'user stats'
+
+    def __str__(self):
+        return f"Stats for {self.user}"
+
+class UserRateLimit(models.Model):
+    """Per-user overrides of the chat admission limits (see api/admission.py)."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='chat_rate_limit')
+    requests_per_minute = models.PositiveIntegerField(null=True, blank=True, help_text="Sustained chat turns per minute. Empty for the site default.")
+    burst = models.PositiveIntegerField(null=True, blank=True, help_text="Chat turns allowed back to back. Empty for the site default.")
+    exempt = models.BooleanField(default=False, help_text="Skip the per-user and per-project limits; the global concurrency cap still applies.")
+
+    def __str__(self):
+        return f"Rate limit for {self.user}"
+
+class ChatJob(models.Model):
+    """A chat turn answered in the background (see api/jobs.py); the row is the job."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='chat_jobs')
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, editable=False)
+    response = models.TextField(blank=True, editable=False)
+    model = models.CharField(max_length=100, blank=True, editable=False)
+    latency_ms = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'claimed_at'], name='chatjob_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"Job {self.pk} ({self.status})"
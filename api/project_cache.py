@@ -0,0 +1,117 @@
+"""Two-tier cache of the per-project configuration a chat turn needs.
+
+A turn needs the project's owner (for the permission check), its active
+prompt and its tuning fields; all of these change rarely. They are cached
+as one plain dict per project:
+
+* tier 1, an in-process LRU of `LOCAL_MAX_ENTRIES` entries, valid for
+  `LOCAL_TTL` seconds - no I/O at all;
+* tier 2, the Django cache (shared by every worker), valid for `TTL`.
+
+Signals (api/signals.py) drop both tiers when a Project or Prompt is
+saved or deleted. Other processes only lose their tier-1 copy when it
+expires, so they may use the previous prompt for up to `LOCAL_TTL`
+seconds; set it to 0 to rely on the shared cache alone.
+
+`get` builds a new Project instance on every call, so callers can set
+attributes on it without affecting other threads. It only carries the
+fields above: never save() it, and read counters (message_count,
+last_activity_at) from the database.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Project, Prompt
+
+DEFAULTS = {
+    'TTL': 3600,
+    'LOCAL_TTL': 5,
+    'LOCAL_MAX_ENTRIES': 1024,
+    'KEY_PREFIX': 'projcfg',
+}
+
+# Everything a chat turn reads off the project
+FIELDS = ('id', 'user_id', 'name', 'hedge_delay_ms', 'max_parallel_attempts', 'request_deadline_ms',
+          'response_cache_enabled', 'response_cache_ttl', 'context_token_budget', 'active_prompt_id')
+
+_lock = threading.Lock()
+_local = OrderedDict()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'PROJECT_CACHE', {})}
+
+
+def _key(project_id):
+    return f"{get_config()['KEY_PREFIX']}:{project_id}"
+
+
+def _load(project_id):
+    project = Project.objects.select_related('active_prompt').filter(pk=project_id).first()
+    if project is None:
+        return None
+    prompt = project.active_prompt
+    return {
+        'project': {field: getattr(project, field) for field in FIELDS},
+        'prompt': {'id': prompt.id, 'content': prompt.content} if prompt else None,
+    }
+
+
+def _build(entry):
+    project = Project(**entry['project'])
+    prompt = entry['prompt']
+    project.active_prompt = Prompt(project_id=project.id, **prompt) if prompt else None
+    return project
+
+
+def _local_get(project_id):
+    with _lock:
+        item = _local.get(project_id)
+        if item is None:
+            return None
+        expires, entry = item
+        if expires < time.monotonic():
+            del _local[project_id]
+            return None
+        _local.move_to_end(project_id)
+        return entry
+
+
+def _local_set(project_id, entry, config):
+    if config['LOCAL_TTL'] <= 0:
+        return
+    with _lock:
+        _local[project_id] = (time.monotonic() + config['LOCAL_TTL'], entry)
+        _local.move_to_end(project_id)
+        while len(_local) > config['LOCAL_MAX_ENTRIES']:
+            _local.popitem(last=False)
+
+
+def get(project_id):
+    """Return the chat configuration of a project as a Project instance, or None."""
+    entry = _local_get(project_id)
+    if entry is None:
+        config = get_config()
+        entry = cache.get(_key(project_id))
+        if entry is None:
+            entry = _load(project_id)
+            if entry is None:
+                return None
+            cache.set(_key(project_id), entry, config['TTL'])
+        _local_set(project_id, entry, config)
+    return _build(entry)
+
+
+def invalidate(project_id):
+    with _lock:
+        _local.pop(project_id, None)
+    cache.delete(_key(project_id))
+
+
+def clear_local():
+    with _lock:
+        _local.clear()
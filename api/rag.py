@@ -0,0 +1,303 @@
+"""Offline retrieval over a project's uploaded files.
+
+Uploaded text, markdown and PDF files are split into overlapping word
+chunks (DocumentChunk rows) by the ingestion worker (api/ingest.py), which
+rebuilds the index once a file is ready. Each chunk is embedded without any model:
+word unigrams and bigrams are hashed into `DIM` signed buckets, weighted
+by sublinear term frequency and the project's inverse document frequency,
+then L2-normalised. `DIM` is 2**32, so distinct terms practically never
+share a bucket: with a few hundred buckets a 200-word chunk fills most of
+them, and text sharing no word with the query still scores well above
+`MIN_SCORE`.
+
+The vectors are sparse, so a project's index is stored as postings
+lists: for every bucket that occurs in the project, the rows of the
+chunks that have it and their weights, in arrays saved as .npy and opened
+with mmap. A query only reads the postings of its own buckets and takes
+the top-k with argpartition.
+
+Index layout under `RAG['INDEX_ROOT']`::
+
+    <project_id>/CURRENT               name of the live build
+    <project_id>/<build>/buckets.npy   int64 [buckets], every bucket that occurs, ascending
+    <project_id>/<build>/indptr.npy    int64 [buckets + 1], start of each bucket's postings
+    <project_id>/<build>/rows.npy      int32 [postings], chunk row of each posting
+    <project_id>/<build>/weights.npy   float32 [postings]
+    <project_id>/<build>/chunk_ids.npy DocumentChunk id of every row
+
+A bucket's document frequency is the length of its postings list, so the
+query side needs no other statistics. A rebuild writes a new build
+directory and swaps CURRENT with os.replace, so readers never see a
+half-written index; rebuilds of one project take turns on
+<project_id>/build.lock. Chunks of a deleted file stay in the index until
+the next rebuild; `retrieve` skips them.
+"""
+import functools
+import hashlib
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.files import locks
+
+from .models import DocumentChunk, ProjectFile
+
+DEFAULTS = {
+    'INDEX_ROOT': Path(settings.BASE_DIR) / 'rag_index',
+    'DIM': 2 ** 32,
+    'TOP_K': 3,
+    'MIN_SCORE': 0.05,
+    'CHUNK_WORDS': 200,
+    'CHUNK_OVERLAP': 40,
+}
+
+# Chunks vectorised in memory before being written to the index
+BLOCK_ROWS = 8192
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'RAG', {})}
+
+
+# --- vectorising -------------------------------------------------------------
+
+@functools.lru_cache(maxsize=200_000)
+def _bucket(term, dim):
+    # Stable across processes, unlike hash(); the top bit gives the sign
+    h = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+    return h % dim, 1.0 if h >> 63 else -1.0
+
+
+def _stem(word):
+    # Just enough folding for "refund"/"refunds" to match
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def _terms(text):
+    words = [_stem(word) for word in _TOKEN_RE.findall(text.lower())]
+    return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+
+def term_frequencies(text, dim):
+    """Sublinear (1 + log tf) hashed term frequencies, as (buckets ascending, weights)."""
+    weights = {}
+    for term, tf in Counter(_terms(text)).items():
+        bucket, sign = _bucket(term, dim)
+        weights[bucket] = weights.get(bucket, 0.0) + sign * (1.0 + math.log(tf))
+    # Colliding terms of opposite sign may cancel out
+    buckets = sorted(bucket for bucket, weight in weights.items() if weight)
+    return (np.array(buckets, dtype=np.int64),
+            np.array([weights[bucket] for bucket in buckets], dtype=np.float32))
+
+
+def _idf(df, rows):
+    return (np.log((1 + rows) / (1 + df)) + 1.0).astype(np.float32)
+
+
+# --- index files -------------------------------------------------------------
+
+def _project_dir(project_id):
+    return Path(get_config()['INDEX_ROOT']) / str(project_id)
+
+
+def _spill(build_dir, number, buckets, weights, lengths):
+    path = build_dir / f'block{number}.npz'
+    np.savez(path, buckets=np.concatenate(buckets), weights=np.concatenate(weights),
+             lengths=np.array(lengths, dtype=np.int64))
+    return path
+
+
+def build_index(project_id):
+    """Embed every chunk of a project into a fresh memory-mapped index.
+
+    Builds of one project take turns, across threads and processes: each
+    one deletes the builds it replaces, so two at once would delete each
+    other's.
+    """
+    project_dir = _project_dir(project_id)
+    project_dir.mkdir(parents=True, exist_ok=True)
+    with open(project_dir / 'build.lock', 'a') as lock_file:
+        locks.lock(lock_file, locks.LOCK_EX)
+        try:
+            return _build(project_id, project_dir)
+        finally:
+            locks.unlock(lock_file)
+
+
+def _build(project_id, project_dir):
+    dim = get_config()['DIM']
+    build = uuid.uuid4().hex
+    build_dir = project_dir / build
+    build_dir.mkdir(parents=True)
+
+    # A file being re-ingested keeps its old chunks out until it is ready again
+    chunks = DocumentChunk.objects.filter(project_id=project_id, file__status=ProjectFile.READY).order_by('id')
+    total = chunks.count()
+    ids = np.zeros(total, dtype=np.int64)
+    blocks = []
+    seen = []
+    buckets, weights, lengths = [], [], []
+    rows = 0
+
+    # First pass: raw term frequencies are spilled to disk one block of
+    # chunks at a time, so memory stays bounded whatever the size of the
+    # project, and the buckets of each block are counted
+    for chunk_id, content in chunks.values_list('id', 'content')[:total].iterator(chunk_size=2000):
+        chunk_buckets, chunk_weights = term_frequencies(content, dim)
+        ids[rows] = chunk_id
+        buckets.append(chunk_buckets)
+        weights.append(chunk_weights)
+        lengths.append(len(chunk_buckets))
+        rows += 1
+        if rows % BLOCK_ROWS == 0:
+            blocks.append(_spill(build_dir, len(blocks), buckets, weights, lengths))
+            seen.append(np.unique(np.concatenate(buckets), return_counts=True))
+            buckets, weights, lengths = [], [], []
+    if lengths:
+        blocks.append(_spill(build_dir, len(blocks), buckets, weights, lengths))
+        seen.append(np.unique(np.concatenate(buckets), return_counts=True))
+
+    # A chunk has each of its buckets once, so counts are document frequencies
+    keys, inverse = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + [b for b, _ in seen]),
+                              return_inverse=True)
+    df = np.bincount(inverse, weights=np.concatenate([np.zeros(0)] + [c for _, c in seen]),
+                     minlength=len(keys)).astype(np.int64)
+    indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(df, out=indptr[1:])
+    idf = _idf(df, rows)
+
+    # Second pass: weight by idf, normalise each chunk and scatter its
+    # postings into place. Rows are visited in order, so every postings
+    # list ends up sorted by row. (numpy cannot map an empty array.)
+    postings = int(indptr[-1])
+    posting_rows = np.lib.format.open_memmap(build_dir / 'rows.npy', mode='w+', dtype=np.int32,
+                                             shape=(max(postings, 1),))
+    posting_weights = np.lib.format.open_memmap(build_dir / 'weights.npy', mode='w+', dtype=np.float32,
+                                                shape=(max(postings, 1),))
+    cursor = indptr[:-1].copy()
+    first_row = 0
+    for path in blocks:
+        with np.load(path) as block:
+            block_keys = np.searchsorted(keys, block['buckets'])
+            block_weights, block_lengths = block['weights'], block['lengths']
+        local_rows = np.repeat(np.arange(len(block_lengths)), block_lengths)
+        block_weights = block_weights * idf[block_keys]
+        norms = np.sqrt(np.bincount(local_rows, weights=block_weights ** 2, minlength=len(block_lengths)))
+        norms[norms == 0] = 1.0
+        block_weights /= norms[local_rows].astype(np.float32)
+        order = np.argsort(block_keys, kind='stable')
+        sorted_keys = block_keys[order]
+        # Position of each posting after those of its bucket already written
+        rank = np.arange(len(order)) - np.searchsorted(sorted_keys, sorted_keys)
+        positions = cursor[sorted_keys] + rank
+        posting_rows[positions] = local_rows[order] + first_row
+        posting_weights[positions] = block_weights[order]
+        hit, counts = np.unique(sorted_keys, return_counts=True)
+        cursor[hit] += counts
+        first_row += len(block_lengths)
+        path.unlink()
+    posting_rows.flush()
+    posting_weights.flush()
+    del posting_rows, posting_weights
+    # Rows past `rows` belong to chunks deleted while building and are ignored
+    np.save(build_dir / 'chunk_ids.npy', ids[:rows])
+    np.save(build_dir / 'buckets.npy', keys.astype(np.int64))
+    np.save(build_dir / 'indptr.npy', indptr)
+
+    tmp = project_dir / f'CURRENT.{build}'
+    tmp.write_text(build)
+    os.replace(tmp, project_dir / 'CURRENT')
+    for old in project_dir.iterdir():
+        # Readers holding the old memmap keep their open file on POSIX
+        if old.is_dir() and old.name != build:
+            shutil.rmtree(old, ignore_errors=True)
+    return rows
+
+
+def drop_index(project_id):
+    shutil.rmtree(_project_dir(project_id), ignore_errors=True)
+
+
+class _Index:
+    def __init__(self, path):
+        self.chunk_ids = np.load(path / 'chunk_ids.npy')
+        self.buckets = np.load(path / 'buckets.npy', mmap_mode='r')
+        self.indptr = np.load(path / 'indptr.npy', mmap_mode='r')
+        self.rows = np.load(path / 'rows.npy', mmap_mode='r')
+        self.weights = np.load(path / 'weights.npy', mmap_mode='r')
+
+    def postings(self, buckets):
+        """(start, stop) of the postings of each bucket; empty for buckets not in the index."""
+        keys = np.minimum(np.searchsorted(self.buckets, buckets), max(len(self.buckets) - 1, 0))
+        found = self.buckets[keys] == buckets if len(self.buckets) else np.zeros(len(buckets), dtype=bool)
+        starts = np.where(found, self.indptr[keys], 0)
+        return starts, np.where(found, self.indptr[keys + 1], 0)
+
+
+_lock = threading.Lock()
+_open_indexes = {}
+
+
+def load_index(project_id):
+    """Return the live index of a project (cached per process), or None."""
+    try:
+        build = (_project_dir(project_id) / 'CURRENT').read_text()
+    except FileNotFoundError:
+        return None
+    key = (str(get_config()['INDEX_ROOT']), project_id, build)
+    index = _open_indexes.get(key)
+    if index is None:
+        with _lock:
+            for stale in [k for k in _open_indexes if k[:2] == key[:2]]:
+                del _open_indexes[stale]
+            try:
+                index = _open_indexes[key] = _Index(_project_dir(project_id) / build)
+            except FileNotFoundError:
+                # Replaced between reading CURRENT and opening the build
+                return None
+    return index
+
+
+def search(project_id, query, k=None):
+    """Return [(chunk id, score)] of the best matching chunks, best first."""
+    config = get_config()
+    k = k or config['TOP_K']
+    index = load_index(project_id)
+    if index is None or not len(index.chunk_ids):
+        return []
+    buckets, weights = term_frequencies(query, config['DIM'])
+    if not len(buckets):
+        return []
+    starts, stops = index.postings(buckets)
+    weights = weights * _idf(stops - starts, len(index.chunk_ids))
+    weights /= np.linalg.norm(weights)
+    hit = [(start, stop, weight) for start, stop, weight in zip(starts, stops, weights) if stop > start]
+    if not hit:
+        return []
+    rows = np.concatenate([index.rows[start:stop] for start, stop, _ in hit])
+    products = np.concatenate([index.weights[start:stop] * weight for start, stop, weight in hit])
+    scores = np.bincount(rows, weights=products, minlength=len(index.chunk_ids))
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(index.chunk_ids[i]), float(scores[i])) for i in top if scores[i] >= config['MIN_SCORE']]
+
+
+def retrieve(project_id, query, k=None):
+    """Top-k DocumentChunks (with their file) for a query, best first."""
+    hits = search(project_id, query, k)
+    if not hits:
+        return []
+    chunks = DocumentChunk.objects.select_related('file').in_bulk([chunk_id for chunk_id, _ in hits])
+    return [chunks[chunk_id] for chunk_id, _ in hits if chunk_id in chunks]
@@ -0,0 +1,116 @@
+"""Opt-in per-project cache of chat replies.
+
+FAQ-style projects see the same system prompt and opening question over
+and over. When `Project.response_cache_enabled` is set, a reply is stored
+under a hash of (candidate models, system prompt, history window,
+message) and identical turns are answered from the cache instead of
+making an upstream call.
+
+Each project keeps a generation number in the cache. Saving a new
+`Prompt` bumps it (see api/signals.py), which orphans every entry of the
+old generation at once. Entries per project are bounded: a recency list is
+kept next to the entries and the least recently used ones are evicted
+past `MAX_ENTRIES_PER_PROJECT`. Hit/miss counters are kept per project.
+
+Entries and recency lists are bulk data in the default cache. Generations
+and counters are in the coordination cache, where they are not culled: a
+generation number lost to culling would restart at 0 and bring back the
+replies of an old prompt.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import coordination
+
+DEFAULTS = {
+    'MAX_ENTRIES_PER_PROJECT': 500,
+    'KEY_PREFIX': 'respcache',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'RESPONSE_CACHE', {})}
+
+
+def _prefix(project_id):
+    return f"{get_config()['KEY_PREFIX']}:{project_id}"
+
+
+def _generation(project_id):
+    return coordination.cache.get_or_set(f'{_prefix(project_id)}:gen', 0, None)
+
+
+def make_key(models, system_prompt, history, message):
+    history = [
+        (msg.role, msg.content) if hasattr(msg, 'role') else (msg['role'], msg['content'])
+        for msg in history or []
+    ]
+    payload = json.dumps([list(models), system_prompt, history, message], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _incr(key):
+    try:
+        coordination.cache.incr(key)
+    except ValueError:
+        # Counter expired or never existed
+        coordination.cache.add(key, 0, None)
+        coordination.cache.incr(key)
+
+
+def _touch(lru_key, digest, ttl, max_entries):
+    """Move `digest` to the most-recent end and evict past `max_entries`."""
+    order = [d for d in cache.get(lru_key, []) if d != digest]
+    order.append(digest)
+    evicted = order[:-max_entries] if len(order) > max_entries else []
+    order = order[-max_entries:]
+    cache.set(lru_key, order, ttl)
+    return evicted
+
+
+def lookup(project, digest):
+    """Return the cached entry dict for `digest`, or None."""
+    prefix = f'{_prefix(project.id)}:{_generation(project.id)}'
+    entry = cache.get(f'{prefix}:{digest}')
+    if entry is None:
+        _incr(f'{_prefix(project.id)}:misses')
+        return None
+    _incr(f'{_prefix(project.id)}:hits')
+    _touch(f'{prefix}:lru', digest, project.response_cache_ttl, get_config()['MAX_ENTRIES_PER_PROJECT'])
+    return entry
+
+
+def store(project, digest, content, model):
+    prefix = f'{_prefix(project.id)}:{_generation(project.id)}'
+    ttl = project.response_cache_ttl
+    cache.set(f'{prefix}:{digest}', {'content': content, 'model': model}, ttl)
+    evicted = _touch(f'{prefix}:lru', digest, ttl, get_config()['MAX_ENTRIES_PER_PROJECT'])
+    if evicted:
+        cache.delete_many([f'{prefix}:{d}' for d in evicted])
+
+
+def invalidate_project(project_id):
+    """Drop every cached reply of a project, e.g. after its prompt changed."""
+    key = f'{_prefix(project_id)}:gen'
+    coordination.cache.add(key, 0, None)
+    try:
+        coordination.cache.incr(key)
+    except ValueError:
+        coordination.cache.set(key, 1, None)
+
+
+def stats(project_id):
+    prefix = _prefix(project_id)
+    values = coordination.cache.get_many([f'{prefix}:hits', f'{prefix}:misses'])
+    hits = values.get(f'{prefix}:hits', 0)
+    misses = values.get(f'{prefix}:misses', 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else 0.0,
+        'entries': len(cache.get(f'{prefix}:{_generation(project_id)}:lru', [])),
+    }
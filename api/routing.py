@@ -0,0 +1,185 @@
+"""Adaptive model routing backed by the Django cache.
+
+Every upstream attempt feeds `ModelRouter.record` with its latency and
+outcome. Per model we keep an EWMA of latency and of the error rate plus
+raw 429/5xx counters. A model whose error rate (or run of consecutive
+failures) crosses the threshold has its circuit breaker opened and is
+skipped; once the cool-down has passed, one request is let through as a
+half-open probe, and its outcome closes or re-opens the breaker. Healthy
+models are tried in order of expected latency.
+
+State lives in the coordination cache (see api/coordination.py) so every
+worker sees the same picture.
+Updates are read-modify-write without locking; an occasional lost sample
+under contention is acceptable for routing statistics.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .coordination import cache
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULTS = {
+    'EWMA_ALPHA': 0.3,
+    'FAILURE_THRESHOLD': 0.5,
+    'MIN_SAMPLES': 5,
+    'CONSECUTIVE_FAILURES': 3,
+    'OPEN_SECONDS': 30,
+    'STATE_TTL': 24 * 60 * 60,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'MODEL_ROUTER', {})}
+
+
+def _empty_state():
+    return {
+        'ewma_latency_ms': None,
+        'error_rate': 0.0,
+        'samples': 0,
+        'successes': 0,
+        'failures': 0,
+        'status_429': 0,
+        'status_5xx': 0,
+        'consecutive_failures': 0,
+        'breaker': CLOSED,
+        'opened_at': None,
+        'last_status': None,
+        'updated_at': None,
+    }
+
+
+class ModelRouter:
+    key_prefix = 'router:model:'
+
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or cache
+
+    @property
+    def config(self):
+        return get_config()
+
+    def _key(self, model):
+        return self.key_prefix + model
+
+    def _probe_key(self, model):
+        return self.key_prefix + model + ':probe'
+
+    def get_state(self, model):
+        return self.cache.get(self._key(model)) or _empty_state()
+
+    def _save(self, model, state):
+        state['updated_at'] = time.time()
+        self.cache.set(self._key(model), state, self.config['STATE_TTL'])
+
+    def record(self, model, latency_ms, ok, status=None):
+        """Fold the outcome of one attempt into the model's statistics."""
+        config = self.config
+        alpha = config['EWMA_ALPHA']
+        state = self.get_state(model)
+
+        state['samples'] += 1
+        state['last_status'] = status
+        if status == 429:
+            state['status_429'] += 1
+        elif status is not None and status >= 500:
+            state['status_5xx'] += 1
+        state['error_rate'] = alpha * (0.0 if ok else 1.0) + (1 - alpha) * state['error_rate']
+
+        if ok:
+            state['successes'] += 1
+            state['consecutive_failures'] = 0
+            if state['ewma_latency_ms'] is None:
+                state['ewma_latency_ms'] = float(latency_ms)
+            else:
+                state['ewma_latency_ms'] = alpha * latency_ms + (1 - alpha) * state['ewma_latency_ms']
+            if state['breaker'] != CLOSED:
+                # Successful half-open probe
+                state['breaker'] = CLOSED
+                state['opened_at'] = None
+                state['error_rate'] = 0.0
+        else:
+            state['failures'] += 1
+            state['consecutive_failures'] += 1
+            tripped = (
+                state['consecutive_failures'] >= config['CONSECUTIVE_FAILURES']
+                or (state['samples'] >= config['MIN_SAMPLES'] and state['error_rate'] >= config['FAILURE_THRESHOLD'])
+            )
+            if state['breaker'] != CLOSED or tripped:
+                state['breaker'] = OPEN
+                state['opened_at'] = time.time()
+
+        if state['breaker'] != HALF_OPEN:
+            self.cache.delete(self._probe_key(model))
+        self._save(model, state)
+
+    async def arecord(self, model, latency_ms, ok, status=None):
+        """`record` for coroutines: the cache I/O runs in a worker thread, off the event loop."""
+        await sync_to_async(self.record, thread_sensitive=False)(model, latency_ms, ok, status)
+
+    def _admit(self, model, state, now, claim_probe):
+        if state['breaker'] == CLOSED:
+            return True
+        if now - (state['opened_at'] or 0) < self.config['OPEN_SECONDS']:
+            return False
+        if not claim_probe:
+            return True
+        # Cool-down over: exactly one worker wins the probe slot
+        if self.cache.add(self._probe_key(model), True, self.config['OPEN_SECONDS']):
+            state['breaker'] = HALF_OPEN
+            self._save(model, state)
+            return True
+        return False
+
+    def candidates(self, models, claim_probes=True):
+        """Return `models` minus open breakers, fastest expected first.
+
+        With `claim_probes=False` the order is computed without taking a
+        half-open probe slot, for display purposes.
+
+        Models without measurements keep their configured position ahead of
+        measured ones so they get sampled; models that have never succeeded
+        go last. If every breaker is open the
+        configured order is returned unchanged rather than failing the turn.
+        """
+        now = time.time()
+        states = self.cache.get_many([self._key(m) for m in models])
+        admitted = []
+        for index, model in enumerate(models):
+            state = states.get(self._key(model)) or _empty_state()
+            if self._admit(model, state, now, claim_probes):
+                admitted.append((index, model, state))
+        if not admitted:
+            return list(models)
+
+        def expected_latency(item):
+            index, model, state = item
+            if not state['samples']:
+                return (0, index)
+            if state['ewma_latency_ms'] is None:
+                # Has only ever failed
+                return (2, index)
+            # Failed attempts cost a retry, so weight latency by reliability
+            return (1, state['ewma_latency_ms'] / max(1.0 - state['error_rate'], 0.05))
+
+        return [model for index, model, state in sorted(admitted, key=expected_latency)]
+
+    async def acandidates(self, models, claim_probes=True):
+        """`candidates` for coroutines; claiming a probe may wait on the cache's lock."""
+        return await sync_to_async(self.candidates, thread_sensitive=False)(models, claim_probes)
+
+    def snapshot(self, models):
+        states = self.cache.get_many([self._key(m) for m in models])
+        return [{'model': m, **(states.get(self._key(m)) or _empty_state())} for m in models]
+
+    def reset(self, models):
+        self.cache.delete_many([self._key(m) for m in models] + [self._probe_key(m) for m in models])
+
+
+router = ModelRouter()
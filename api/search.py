@@ -0,0 +1,133 @@
+"""Full-text search over chat messages, backed by an SQLite FTS5 index.
+
+`api_chatmessage_fts` is an external-content FTS5 table over
+ChatMessage.content: it holds the index only, not a second copy of the
+text. Triggers on api_chatmessage (migration 0015) keep it in step with
+every INSERT, UPDATE and DELETE, bulk_create and raw SQL included, so
+messages moved to cold storage (see api/archive.py) leave the index too.
+`python manage.py rebuild_message_index` recreates the table and triggers
+if they are missing and re-indexes every message.
+
+User input never reaches FTS5 query syntax: `match_query` keeps its
+words, quotes each one and matches the last one as a prefix, so results
+show up while typing. The newest `MAX_CANDIDATES` matches are ranked with
+bm25, which keeps searches for very common words fast; results come with
+an HTML snippet in which the matched words are wrapped in <mark>.
+"""
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from .models import ChatMessage
+
+TABLE = 'api_chatmessage_fts'
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+# Words of a query that are used; the rest is ignored
+MAX_TERMS = 10
+# Words of context in a snippet
+SNIPPET_TOKENS = 16
+# Matches ranked per search, newest first; scoring every message that has
+# a very common word would take seconds on millions of messages
+MAX_CANDIDATES = 2000
+# Shorter last words are matched whole rather than as a prefix
+MIN_PREFIX = 3
+
+# Same as migration 0015, for databases that lost them (a table rebuild
+# drops triggers)
+INDEX_SQL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+    "content, content='api_chatmessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_insert AFTER INSERT ON api_chatmessage BEGIN "
+    f"INSERT INTO {TABLE} (rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_delete AFTER DELETE ON api_chatmessage BEGIN "
+    f"INSERT INTO {TABLE} ({TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_update AFTER UPDATE OF content ON api_chatmessage BEGIN "
+    f"INSERT INTO {TABLE} ({TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+    f"INSERT INTO {TABLE} (rowid, content) VALUES (new.id, new.content); END",
+]
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+# Snippet match markers, replaced by <mark> once the text is escaped
+_START, _END = '\x02', '\x03'
+
+
+def match_query(text):
+    """An FTS5 MATCH expression for free text, or None if it has no words."""
+    words = _WORD_RE.findall(text or '')[:MAX_TERMS]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if not text[-1:].isspace() and len(words[-1]) >= MIN_PREFIX:
+        # Still being typed
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def matching_ids(query):
+    """Subquery of the ids of messages matching an FTS5 expression, for `id__in`."""
+    return RawSQL(f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s", (query,))
+
+
+def _snippet(text):
+    return escape(text).replace(_START, '<mark>').replace(_END, '</mark>')
+
+
+def search(user, text, project_id=None, limit=PAGE_SIZE, offset=0):
+    """Best matches for `text` among `user`'s messages; returns (results, next offset or None)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    query = match_query(text)
+    if query is None:
+        return [], None
+    scope = "p.user_id = %s"
+    params = [query, user.id]
+    if project_id is not None:
+        scope += " AND m.project_id = %s"
+        params.append(project_id)
+    # Rank the newest MAX_CANDIDATES matches only: FTS5 walks them in rowid
+    # order without scoring the rest. One extra row tells whether there is a
+    # next page.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM ("
+            f"SELECT {TABLE}.rowid AS id, {TABLE}.rank AS score FROM {TABLE} "
+            f"JOIN api_chatmessage m ON m.id = {TABLE}.rowid JOIN api_project p ON p.id = m.project_id "
+            f"WHERE {TABLE} MATCH %s AND {scope} ORDER BY {TABLE}.rowid DESC LIMIT %s"
+            f") ORDER BY score LIMIT %s OFFSET %s",
+            params + [MAX_CANDIDATES, limit + 1, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return [], None
+    page = ids[:limit]
+    # Snippets need the match, but only for this page's rows
+    rows = ChatMessage.objects.raw(
+        f"SELECT m.*, p.name AS project_name, "
+        f"snippet({TABLE}, 0, %s, %s, '…', {SNIPPET_TOKENS}) AS snippet "
+        f"FROM {TABLE} JOIN api_chatmessage m ON m.id = {TABLE}.rowid JOIN api_project p ON p.id = m.project_id "
+        f"WHERE {TABLE} MATCH %s AND {TABLE}.rowid IN ({', '.join(['%s'] * len(page))})",
+        [_START, _END, query] + page,
+    )
+    by_id = {msg.id: msg for msg in rows}
+    results = [
+        {'id': msg.id, 'project_id': msg.project_id, 'project_name': msg.project_name, 'role': msg.role,
+         'timestamp': msg.timestamp.isoformat(), 'snippet': _snippet(msg.snippet)}
+        for msg in (by_id[pk] for pk in page if pk in by_id)
+    ]
+    return results, offset + limit if len(ids) > limit else None
+
+
+def rebuild(optimize=False):
+    """Recreate the index if missing and re-index every message; returns the number of messages."""
+    with connection.cursor() as cursor:
+        for statement in INDEX_SQL:
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('rebuild')")
+        if optimize:
+            # Merge the index into one b-tree: faster queries after bulk loads
+            cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+        cursor.execute("SELECT COUNT(*) FROM api_chatmessage")
+        return cursor.fetchone()[0]
@@ -0,0 +1,87 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import admission, context, counters, ingest, metrics, project_cache, rag, response_cache
+from .models import Project, ProjectFile, Prompt, UserRateLimit, UserStats
+
+
+@receiver(post_save, sender=Prompt)
+@receiver(post_delete, sender=Prompt)
+def invalidate_cached_replies(sender, instance, **kwargs):
+    # Cached replies were produced under the previous system prompt
+    response_cache.invalidate_project(instance.project_id)
+
+
+def forget_project_config(project_id):
+    project_cache.invalidate(project_id)
+    # Again once committed, in case a concurrent turn cached the old state
+    transaction.on_commit(lambda: project_cache.invalidate(project_id))
+
+
+def refresh_active_prompt(project_id):
+    latest = Prompt.objects.filter(project_id=project_id).order_by('-created_at', '-id').first()
+    Project.objects.filter(pk=project_id).update(active_prompt=latest)
+    forget_project_config(project_id)
+
+
+@receiver(post_save, sender=Prompt)
+def track_active_prompt(sender, instance, created, **kwargs):
+    if created:
+        # A new prompt is always the latest one
+        Project.objects.filter(pk=instance.project_id).update(active_prompt=instance)
+    forget_project_config(instance.project_id)
+
+
+@receiver(post_delete, sender=Prompt)
+def replace_active_prompt(sender, instance, **kwargs):
+    # Deferred so a project deleted together with its prompts is already gone
+    transaction.on_commit(lambda: refresh_active_prompt(instance.project_id))
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def invalidate_project_config(sender, instance, **kwargs):
+    forget_project_config(instance.pk)
+    if kwargs.get('created', True):
+        # Created or deleted: ids can be reused (SQLite), so never let a
+        # project inherit the history window cached for an older one
+        context.forget_window(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, **kwargs):
+    if created:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=UserRateLimit)
+@receiver(post_delete, sender=UserRateLimit)
+def invalidate_user_limits(sender, instance, **kwargs):
+    admission.forget_user_limits(instance.user_id)
+
+
+@receiver(pre_delete, sender=Project)
+def forget_project_messages(sender, instance, **kwargs):
+    counters.forget_project(instance)
+
+
+@receiver(post_save, sender=ProjectFile)
+def queue_uploaded_file(sender, instance, created, **kwargs):
+    # The row is the job; only nudge a worker when running in-process
+    if created and ingest.get_config()['IN_PROCESS']:
+        transaction.on_commit(ingest.kick)
+
+
+@receiver(post_delete, sender=Project)
+def drop_project_index(sender, instance, **kwargs):
+    transaction.on_commit(lambda: rag.drop_index(instance.pk))
+
+
+@receiver(connection_created)
+def count_request_queries(sender, connection, **kwargs):
+    # Fired again when a closed connection reconnects; wrap it only once
+    if metrics.record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.record_query)
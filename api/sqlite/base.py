@@ -0,0 +1,73 @@
+"""SQLite backend for several worker processes writing at once.
+
+Use it as `DATABASES['default']['ENGINE'] = 'api.sqlite'` together with
+the pragmas in `OPTIONS['init_command']` (WAL journal, see settings.py).
+In WAL mode readers never wait for the writer; what is left to contend is
+the single write lock:
+
+* `OPTIONS['transaction_mode'] = 'IMMEDIATE'` takes it when a transaction
+  begins. A deferred transaction that reads first and writes later cannot
+  wait for it and fails with "database is locked" instead;
+* across processes, `OPTIONS['timeout']` is how long SQLite waits for it;
+* within a process, transactions queue on a lock per database file, so
+  threads take turns as soon as the lock is free instead of polling
+  with SQLite's sleeping busy handler. A thread waits at most `timeout`
+  seconds before going on to SQLite's own wait.
+
+In-memory databases (the test database) skip the process lock.
+"""
+import threading
+
+from django.db.backends.sqlite3 import base
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def writer_lock(name):
+    """The process-wide lock serialising write transactions on database file `name`."""
+    with _locks_lock:
+        return _locks.setdefault(str(name), threading.Lock())
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._holds_writer_lock = False
+
+    def _acquire_writer_lock(self):
+        if self.is_in_memory_db():
+            return
+        timeout = self.settings_dict['OPTIONS'].get('timeout', 5)
+        self._holds_writer_lock = writer_lock(self.settings_dict['NAME']).acquire(timeout=timeout)
+
+    def _release_writer_lock(self):
+        if self._holds_writer_lock:
+            self._holds_writer_lock = False
+            writer_lock(self.settings_dict['NAME']).release()
+
+    def _start_transaction_under_autocommit(self):
+        self._acquire_writer_lock()
+        try:
+            super()._start_transaction_under_autocommit()
+        except BaseException:
+            self._release_writer_lock()
+            raise
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self._release_writer_lock()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self._release_writer_lock()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self._release_writer_lock()
@@ -1,8 +1,56 @@
-from django.test import TestCase, Client
+import asyncio
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import warnings
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import httpx
+
+from asgiref.sync import SyncToAsync, async_to_sync, sync_to_async
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, Client, AsyncClient, override_settings
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.http import Http404
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.contrib.messages import get_messages
 
+from chatbot_platform.settings import CACHES as DEPLOYED_CACHES
+
+from .models import (Project, Prompt, ChatArchiveSegment, ChatMessage, ChatJob, ConversationSummary, DocumentChunk, ProjectFile, UserRateLimit,
+                     UserStats)
+from . import (admission, archive, chat, coalesce, context, fallback, history, ingest, jobs, metrics, project_cache, rag, response_cache, search,
+               transfer, upstream, websocket, workqueue, writebehind)
+from .checks import check_atomic_cache
+from .filecache import LockingFileBasedCache
+from .routing import ModelRouter, CLOSED, OPEN, HALF_OPEN
+
+# Keep router/cache state out of the shared file cache used in development.
+# Both aliases share one store, so cache.clear() resets the coordination state too.
+LOCMEM_CACHES = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}
+                 for alias in ('default', 'coordination')}
+
+
+def file_caches(root, default_max_entries=50):
+    """The deployed cache aliases on the real file backend under `root`, with a small default cache."""
+    caches = {alias: {**config, 'LOCATION': f'{root}/{alias}'} for alias, config in DEPLOYED_CACHES.items()}
+    caches['default']['OPTIONS'] = {**caches['default']['OPTIONS'], 'MAX_ENTRIES': default_max_entries}
+    return caches
+
 class SuccessMessageTest(TestCase):
     def setUp(self):
         self.client = Client()
@@ -35,3 +83,1662 @@ class SuccessMessageTest(TestCase):
         messages = list(response.context['messages'])
         self.assertEqual(len(messages), 1)
         self.assertEqual(str(messages[0]), "Login successful! Welcome back.")
+
+
+async def consume(response):
+    """The body of a streamed response, read through __aiter__ as the ASGI handler does."""
+    with warnings.catch_warnings():
+        # Django warns, then buffers everything, when it gets a sync iterator
+        warnings.simplefilter('error')
+        return b''.join([chunk async for chunk in response])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatStreamTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='streamer', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Streaming')
+        self.url = reverse('chat_stream_api', args=[self.project.id])
+
+    async def post(self, message):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        return await client.post(self.url, json.dumps({'message': message}), content_type='application/json')
+
+    def parse_events(self, body):
+        events = []
+        for raw in body.decode().strip().split('\n\n'):
+            name, data = raw.split('\n')
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    @override_settings(OPENROUTER_API_KEY='')
+    async def test_sandbox_stream_saves_turn(self):
+        response = await self.post('hello')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.is_async)
+        events = self.parse_events(await consume(response))
+        self.assertEqual(events[-1][0], 'done')
+        tokens = ''.join(data['token'] for name, data in events if name == 'token')
+        self.assertEqual(tokens, events[-1][1]['response'])
+        roles = [role async for role in self.project.messages.order_by('id').values_list('role', flat=True)]
+        self.assertEqual(roles, ['user', 'assistant'])
+
+    @override_settings(OPENROUTER_API_KEY='sk-or-v1-test')
+    async def test_forwards_upstream_deltas(self):
+        lines = [
+            ': OPENROUTER PROCESSING',
+            'data: ' + json.dumps({'choices': [{'delta': {'content': 'Hel'}}]}),
+            '',
+            'data: ' + json.dumps({'choices': [{'delta': {'content': 'lo!'}}]}),
+            'data: [DONE]',
+        ]
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(json.loads(request.content))
+            return httpx.Response(200, text='\n'.join(lines) + '\n')
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch('api.upstream.get_async_client', return_value=client):
+            events = self.parse_events(await consume(await self.post('hi')))
+        self.assertTrue(requests_seen[0]['stream'])
+        self.assertEqual([data['token'] for name, data in events if name == 'token'], ['Hel', 'lo!'])
+        self.assertEqual((await ChatMessage.objects.aget(role='assistant')).content, 'Hello!')
+
+    async def test_tokens_are_sent_as_they_arrive(self):
+        more = asyncio.Event()
+
+        async def upstream(*args, **kwargs):
+            yield 'first '
+            # Only released once the client has seen the first token
+            await more.wait()
+            yield 'second'
+
+        with mock.patch('api.views.astream_ai_response', upstream):
+            stream = aiter(await self.post('hi'))
+            first = await asyncio.wait_for(anext(stream), 5)
+            more.set()
+            rest = b''.join([chunk async for chunk in stream])
+        self.assertIn(b'first', first)
+        self.assertEqual(self.parse_events(rest)[-1], ('done', {'response': 'first second'}))
+        self.assertEqual(await self.project.messages.acount(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncChatApiTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='asyncuser', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Async')
+        self.url = reverse('chat_api_async', args=[self.project.id])
+
+    @override_settings(OPENROUTER_API_KEY='sk-or-v1-test')
+    async def test_async_chat_turn(self):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        upstream = mock.AsyncMock(return_value=mock.Mock(
+            status_code=200, json=lambda: {'choices': [{'message': {'content': 'Async hello'}}]}))
+        with mock.patch('api.llm.httpx.AsyncClient.post', upstream):
+            response = await client.post(self.url, json.dumps({'message': 'hi'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'response': 'Async hello'})
+        self.assertEqual(await ChatMessage.objects.filter(project=self.project).acount(), 2)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'choices': [{'message': {'content': 'pooled'}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UpstreamPoolTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/v1/chat/completions'
+        upstream.reset_clients()
+        upstream.stats.reset()
+
+    def tearDown(self):
+        upstream.reset_clients()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        with override_settings(OPENROUTER_API_KEY='sk-or-v1-test', OPENROUTER_API_URL=self.url):
+            from .llm import get_ai_response
+            replies = [get_ai_response(f'turn {i}') for i in range(5)]
+        self.assertEqual(replies, ['pooled'] * 5)
+        stats = upstream.pool_stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['reused_connections'], 4)
+        self.assertGreater(stats['handshake_seconds_total'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, METRICS={'TOKEN': 'scrape-me', 'FLUSH_INTERVAL': 0})
+class MetricsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.user = User.objects.create_user(username='observed', password='testpassword123')
+        self.client.login(username='observed', password='testpassword123')
+
+    def test_requests_are_timed_with_their_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        merged, workers = metrics.collect()
+        self.assertEqual(workers, 1)
+        self.assertEqual(merged['chat_http_requests_total'][
+            (('method', 'GET'), ('status', '200'), ('view', 'dashboard'))], 1)
+        buckets, db_seconds, count = merged['chat_http_request_db_seconds'][(('view', 'dashboard'),)]
+        self.assertEqual(count, 1)
+        self.assertGreater(db_seconds, 0)
+        # One request, with every query it ran in a single bucket
+        buckets, total, count = merged['chat_http_request_db_queries'][(('view', 'dashboard'),)]
+        self.assertEqual((total, count), (len(ctx.captured_queries), 1))
+
+    def test_endpoint_needs_staff_or_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_http_request_duration_seconds histogram', body)
+        # The two refused scrapes were counted before this one
+        self.assertIn('chat_http_requests_total{method="GET",status="403",view="metrics"} 2', body)
+        self.assertIn('chat_http_request_duration_seconds_bucket{view="metrics",le="+Inf"} 2', body)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_snapshots_of_all_workers_are_merged(self):
+        self.client.get(reverse('dashboard'))
+        other = {'chat_http_requests_total': {(('method', 'GET'), ('status', '200'), ('view', 'dashboard')): 4}}
+        cache.set('metrics:worker:elsewhere:1', other)
+        metrics.flush()
+        cache.set('metrics:workers', {**cache.get('metrics:workers'), 'elsewhere:1': time.time()})
+        body = metrics.render()
+        self.assertIn('chat_metrics_workers 2', body)
+        self.assertIn('chat_http_requests_total{method="GET",status="200",view="dashboard"} 5', body)
+
+    def scrape(self):
+        body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me').content.decode()
+        line = 'chat_http_requests_total{method="GET",status="200",view="dashboard"} '
+        return int(next(row for row in body.splitlines() if row.startswith(line))[len(line):])
+
+    def test_scrapes_add_up_across_flushes_on_the_file_cache(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with override_settings(CACHES=file_caches(tmp.name)):
+            for _ in range(3):
+                self.client.get(reverse('dashboard'))
+            self.assertEqual(self.scrape(), 3)
+            # Enough bulk entries to make the default cache cull
+            cache.set_many({f'bulk:{n}': n for n in range(200)})
+            self.client.get(reverse('dashboard'))
+            self.assertEqual(self.scrape(), 4)
+
+    async def test_async_requests_flush_off_the_event_loop(self):
+        flush, threads = metrics.flush, []
+
+        def spy():
+            threads.append(threading.current_thread())
+            flush()
+
+        await self.async_client.aforce_login(self.user)
+        with mock.patch('api.metrics.flush', spy):
+            self.assertEqual((await self.async_client.get(reverse('dashboard'))).status_code, 200)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        merged, workers = await sync_to_async(metrics.collect)()
+        self.assertEqual(merged['chat_http_requests_total'][
+            (('method', 'GET'), ('status', '200'), ('view', 'dashboard'))], 1)
+
+    def test_upstream_attempts_by_model_status_and_attempt(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(upstream.reset_clients)
+        url = f'http://127.0.0.1:{server.server_port}/api/v1/chat/completions'
+        with override_settings(OPENROUTER_API_KEY='sk-or-v1-test', OPENROUTER_API_URL=url):
+            from .llm import AI_MODELS, get_ai_response
+            self.assertEqual(get_ai_response('hi'), 'pooled')
+        series = metrics.registry.snapshot()['chat_upstream_request_duration_seconds']
+        self.assertEqual(list(series), [(('attempt', '1'), ('model', AI_MODELS[0]), ('status', '200'))])
+
+
+# Coalescing off: these tests send the same message over and over
+@override_settings(CACHES=LOCMEM_CACHES, COALESCE={'ENABLED': False}, CHAT_ADMISSION={
+    'USER_RATE_PER_MINUTE': 1, 'USER_BURST': 2, 'PROJECT_RATE_PER_MINUTE': 1, 'PROJECT_BURST': 3,
+    'MAX_CONCURRENT': 1, 'MAX_QUEUE': 1, 'MAX_WAIT': 0.3, 'POLL_INTERVAL': 0.01,
+})
+class AdmissionControlTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='eager', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Busy')
+        self.client.force_login(self.user)
+        patcher = mock.patch('api.chat.get_ai_completion', return_value=fallback.Completion('ok', 'model-a', 5))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, project=None, name='chat_api'):
+        return self.client.post(reverse(name, args=[(project or self.project).id]), json.dumps({'message': 'hi'}),
+                                content_type='application/json')
+
+    def test_user_and_project_buckets(self):
+        self.assertEqual([self.post().status_code for _ in range(2)], [200, 200])
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['reason'], 'user')
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(ChatMessage.objects.count(), 4)
+
+        # A generous user still hits the project's own bucket
+        UserRateLimit.objects.create(user=self.user, requests_per_minute=600, burst=50)
+        self.assertEqual(self.post().status_code, 200)
+        response = self.post()
+        self.assertEqual((response.status_code, response.json()['reason']), (429, 'project'))
+
+        # Exempt users skip both buckets
+        UserRateLimit.objects.filter(user=self.user).update(exempt=True)
+        admission.forget_user_limits(self.user.id)
+        self.assertEqual(self.post().status_code, 200)
+
+    def test_other_users_projects_are_not_charged(self):
+        owner = User.objects.create_user(username='owner', password='testpassword123')
+        theirs = Project.objects.create(user=owner, name='Theirs')
+        for _ in range(5):
+            self.assertEqual(self.post(theirs).status_code, 404)
+        self.client.force_login(owner)
+        self.assertEqual(self.post(theirs).status_code, 200)
+
+    def test_saturated_slots_queue_then_refuse(self):
+        UserRateLimit.objects.create(user=self.user, exempt=True)
+        config = admission.get_config()
+        slot = admission.lease_slot(config)
+        # Freed while the request waits in the queue
+        threading.Timer(0.1, admission.release, [slot]).start()
+        self.assertEqual(self.post().status_code, 200)
+
+        slot = admission.lease_slot(config)
+        place = admission.join_queue(config)
+        response = self.post()
+        self.assertEqual((response.status_code, response.json()['reason']), (429, 'busy'))
+        admission.release(place)
+        started = time.monotonic()
+        self.assertEqual(self.post().status_code, 429)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        admission.release(slot)
+
+    def test_waiting_for_a_full_house_only_reads(self):
+        config = admission.get_config()
+        slot = admission.lease_slot(config)
+        with mock.patch.object(admission.cache, 'get_many', wraps=admission.cache.get_many) as get_many, \
+                mock.patch.object(admission.cache, 'incr', wraps=admission.cache.incr) as incr:
+            self.assertIsNone(admission.lease_slot(config))
+        self.assertEqual(len(get_many.call_args.args[0]), 2)
+        incr.assert_not_called()
+        admission.release(slot)
+
+    def test_slots_last_while_renewed(self):
+        config = admission.get_config()
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            slot = admission.lease_slot(config)
+        with mock.patch('time.time', return_value=now + config['SLOT_TTL']):
+            admission.renew(slot)
+        with mock.patch('time.time', return_value=now + 2 * config['SLOT_TTL']):
+            self.assertIsNone(admission.lease_slot(config))
+            admission.release(slot)
+            # Taken and never renewed, like the slot of a killed worker
+            self.assertIsNotNone(admission.lease_slot(config))
+        with mock.patch('time.time', return_value=now + 4 * config['SLOT_TTL']):
+            self.assertIsNotNone(admission.lease_slot(config))
+
+    def test_waiters_back_off(self):
+        config = {**admission.get_config(), 'MAX_WAIT': 60, 'POLL_INTERVAL': 0.05, 'MAX_POLL_INTERVAL': 0.5}
+        delays = [delay for _, delay in zip(range(8), admission._poll_delays(config))]
+        self.assertLessEqual(delays[0], 0.05)
+        self.assertGreaterEqual(delays[-1], 0.25)
+        self.assertLessEqual(max(delays), 0.5)
+
+    @override_settings(OPENROUTER_API_KEY='')
+    def test_stream_holds_its_slot_until_done(self):
+        response = self.post(name='chat_stream_api')
+        self.assertIsNone(admission.lease_slot(admission.get_config()))
+        async_to_sync(consume)(response)
+        response.close()
+        self.assertIsNotNone(admission.lease_slot(admission.get_config()))
+
+
+class LockingFileCacheTest(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.location = tmp.name
+        self.cache = LockingFileBasedCache(tmp.name, {})
+
+    def race(self, method, call, threads=8):
+        """Run `call` in several threads with FileBasedCache.`method` slowed down."""
+        original = getattr(FileBasedCache, method)
+
+        def slow(*args, **kwargs):
+            result = original(*args, **kwargs)
+            time.sleep(0.01)
+            return result
+
+        results = []
+        with mock.patch.object(FileBasedCache, method, slow):
+            workers = [threading.Thread(target=lambda: results.append(call())) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        return results
+
+    def test_one_of_racing_adds_wins(self):
+        results = self.race('has_key', lambda: self.cache.add('lock', True, 60))
+        self.assertEqual(results.count(True), 1)
+
+    def test_racing_increments_add_up(self):
+        self.cache.set('count', 0, 60)
+        self.race('get', lambda: self.cache.incr('count'))
+        self.assertEqual(self.cache.get('count'), 8)
+        self.cache.decr('count', 8)
+        self.assertEqual(self.cache.get('count'), 0)
+
+    def test_increments_keep_the_expiry(self):
+        self.cache.set('count', 0, 60)
+        self.cache.incr('count')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('count'))
+
+    def test_check_flags_a_non_atomic_cache(self):
+        def caches(backend):
+            return {alias: {'BACKEND': backend, 'LOCATION': f'{self.location}/{alias}'}
+                    for alias in ('default', 'coordination')}
+
+        with override_settings(CACHES=caches('django.core.cache.backends.filebased.FileBasedCache')):
+            self.assertEqual([warning.id for warning in check_atomic_cache(None)], ['api.W001'])
+        with override_settings(CACHES=caches('api.filecache.LockingFileBasedCache')):
+            self.assertEqual(check_atomic_cache(None), [])
+
+    def test_a_full_cache_drops_expired_entries_first(self):
+        full = LockingFileBasedCache(self.location, {'OPTIONS': {'MAX_ENTRIES': 10}})
+        full.set_many({f'live{n}': n for n in range(5)}, 60)
+        full.set_many({f'old{n}': n for n in range(5)}, 1)
+        with mock.patch('time.time', return_value=time.time() + 2):
+            full.set('new', 'value', 60)
+            self.assertEqual(full.get_many([f'live{n}' for n in range(5)] + ['new']),
+                             {**{f'live{n}': n for n in range(5)}, 'new': 'value'})
+
+
+class SharedStateCullingTest(TestCase):
+    """The deployed cache layout, on the real file backend, with a small default cache."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        caches = file_caches(tmp.name)
+        self.assertEqual(caches['coordination']['BACKEND'], 'api.filecache.LockingFileBasedCache')
+        overrides = override_settings(CACHES=caches, CHAT_ADMISSION={'MAX_CONCURRENT': 1})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.project = Project.objects.create(user=User.objects.create_user(username='busy'), name='Busy',
+                                              response_cache_enabled=True)
+
+    def test_bulk_entries_do_not_evict_coordination_state(self):
+        response_cache.invalidate_project(self.project.id)
+        router = ModelRouter()
+        router.record('model-a', 100, ok=True)
+        slot = admission.lease_slot(admission.get_config())
+        flight = coalesce.start('turn', 30)
+
+        for n in range(400):
+            response_cache.store(self.project, f'digest{n}', f'reply {n}', 'model-a')
+        self.assertLess(len(os.listdir(settings.CACHES['default']['LOCATION'])), 60)
+
+        self.assertEqual(response_cache._generation(self.project.id), 1)
+        self.assertEqual(router.get_state('model-a')['samples'], 1)
+        self.assertIsNone(admission.lease_slot(admission.get_config()))
+        self.assertFalse(coalesce.start('turn', 30).leader)
+        admission.release(slot)
+        flight.finish(None, ok=False)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHAT_ADMISSION={'ENABLED': False})
+class CoalesceTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='clicker', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Twice')
+        self.client.force_login(self.user)
+        self.calls = []
+        patcher = mock.patch('api.chat.get_ai_completion', side_effect=self.slow_completion)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def slow_completion(self, *args, **kwargs):
+        self.calls.append(args[0])
+        time.sleep(0.3)
+        return fallback.Completion(f'answer {len(self.calls)}', 'model-a', 300)
+
+    def post(self, message='hi', name='chat_api', **headers):
+        return self.client.post(reverse(name, args=[self.project.id]), json.dumps({'message': message}),
+                                content_type='application/json', headers=headers)
+
+    def test_concurrent_duplicates_share_one_turn(self):
+        replies = []
+        with mock.patch('api.chat.save_turn') as save_turn:
+            threads = [threading.Thread(target=lambda: replies.append(chat.turn(self.project, 'hi', None, [])))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([reply.content for reply in replies], ['answer 1'] * 3)
+        self.assertEqual(self.calls, ['hi'])
+        self.assertEqual(save_turn.call_count, 1)
+
+        # Another worker's flight is seen through the cache
+        flight = coalesce.start(coalesce.flight_key(self.project, 'again', []), 5)
+        coalesce._flights.clear()
+        threading.Timer(0.1, flight.finish, [fallback.Completion('theirs', 'model-b', 5), True]).start()
+        with mock.patch('api.chat.save_turn') as save_turn:
+            self.assertEqual(chat.turn(self.project, 'again', None, []).content, 'theirs')
+        save_turn.assert_not_called()
+
+    def test_replay_returns_stored_answer(self):
+        self.assertEqual(self.post().json(), {'response': 'answer 1'})
+        # A retry sees the finished turn in its history and still matches
+        self.assertEqual(self.post().json(), {'response': 'answer 1'})
+        body = async_to_sync(consume)(self.post(name='chat_stream_api')).decode()
+        self.assertTrue(body.startswith('event: token\ndata: {"token": "answer 1"}\n\n'))
+        self.assertEqual(ChatMessage.objects.filter(project=self.project).count(), 2)
+
+        # Past the replay window the same message is a new turn
+        cache.delete_many([f'flight:result:{coalesce.replay_key(self.project, "hi", "answer 1")}'])
+        self.assertEqual(self.post().json(), {'response': 'answer 2'})
+        self.assertEqual(ChatMessage.objects.filter(project=self.project).count(), 4)
+
+    def test_idempotency_key(self):
+        self.assertEqual(self.post(**{'Idempotency-Key': 'abc'}).json(), {'response': 'answer 1'})
+        self.assertEqual(self.post(**{'Idempotency-Key': 'abc'}).json(), {'response': 'answer 1'})
+        self.assertEqual(self.post(**{'Idempotency-Key': 'def'}).json(), {'response': 'answer 2'})
+        self.assertEqual(self.calls, ['hi', 'hi'])
+
+    def test_failed_turn_is_retried(self):
+        self.client.raise_request_exception = False
+        with mock.patch('api.chat.get_ai_completion', side_effect=RuntimeError('down')), \
+                self.assertLogs('django.request', 'ERROR'):
+            self.assertEqual(self.post().status_code, 500)
+        self.assertEqual(self.post().json(), {'response': 'answer 1'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BatchChatTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='evaluator', password='testpassword123')
+        self.first = Project.objects.create(user=self.user, name='First')
+        self.second = Project.objects.create(user=self.user, name='Second')
+        self.client.force_login(self.user)
+        self.histories = {}
+        patcher = mock.patch('api.chat.get_ai_completion', side_effect=self.slow_echo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def slow_echo(self, message, system_prompt=None, history=None, policy=None):
+        self.histories[message] = [msg['content'] for msg in history]
+        time.sleep(0.2)
+        return fallback.Completion(f'echo {message}', 'model-a', 200)
+
+    def post(self, payload):
+        return self.client.post(reverse('chat_batch'), json.dumps(payload), content_type='application/json')
+
+    def test_isolated_items_run_concurrently_and_save_in_bulk(self):
+        items = [{'project_id': project.id, 'message': f'q{i}'}
+                 for i, project in enumerate([self.first, self.second] * 3)]
+        started = time.monotonic()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'items': items, 'concurrency': 6})
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual([result['response'] for result in response.json()['results']],
+                         [f'echo q{i}' for i in range(6)])
+        self.assertEqual(self.histories['q4'], [])
+        self.assertEqual(ChatMessage.objects.filter(project=self.first).count(), 6)
+        inserts = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "api_chatmessage"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_shared_history_chains_each_project(self):
+        items = [{'project_id': self.first.id, 'message': 'a1'}, {'project_id': self.second.id, 'message': 'b1'},
+                 {'project_id': self.first.id, 'message': 'a2'}]
+        results = self.post({'items': items, 'history': 'shared'}).json()['results']
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        self.assertEqual(self.histories['a2'], ['a1', 'echo a1'])
+        self.assertEqual(self.histories['b1'], [])
+        self.assertEqual(list(self.first.messages.order_by('timestamp', 'id').values_list('content', flat=True)),
+                         ['a1', 'echo a1', 'a2', 'echo a2'])
+
+    def test_stream_and_item_errors(self):
+        theirs = Project.objects.create(user=User.objects.create_user(username='other', password='x'), name='X')
+        items = [{'project_id': self.first.id, 'message': 'a'}, {'project_id': theirs.id, 'message': 'b'}]
+        response = self.post({'items': items, 'stream': True})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in async_to_sync(consume)(response).decode().splitlines()]
+        self.assertEqual(sorted(lines, key=lambda line: line['index']), [
+            {'index': 0, 'project_id': self.first.id, 'response': 'echo a', 'model': 'model-a', 'latency_ms': 200,
+             'cached': False},
+            {'index': 1, 'project_id': theirs.id, 'error': 'Project not found.'},
+        ])
+        self.assertFalse(theirs.messages.exists())
+
+        self.assertEqual(self.post({'items': [{'message': 'no project'}]}).status_code, 400)
+        self.assertEqual(self.post({'items': items, 'history': 'mixed'}).status_code, 400)
+
+
+    def test_stream_sends_results_as_they_complete(self):
+        def echo(message, system_prompt=None, history=None, policy=None):
+            time.sleep(1 if message == 'slow' else 0)
+            return fallback.Completion(f'echo {message}', 'model-a', 5)
+
+        async def read_first_line_then_leave(response):
+            lines = asyncio.Queue()
+
+            async def read():
+                async for chunk in response:
+                    await lines.put(chunk)
+
+            reader = asyncio.create_task(read())
+            started = time.monotonic()
+            first = json.loads(await lines.get())
+            elapsed = time.monotonic() - started
+            # The ASGI handler cancels the response when the client disconnects
+            reader.cancel()
+            for _ in range(60):
+                if await ChatMessage.objects.acount() == 4:
+                    break
+                await asyncio.sleep(0.05)
+            return first, elapsed
+
+        items = [{'project_id': self.first.id, 'message': 'slow'}, {'project_id': self.second.id, 'message': 'fast'}]
+        with mock.patch('api.chat.get_ai_completion', side_effect=echo):
+            response = self.post({'items': items, 'stream': True})
+            self.assertTrue(response.is_async)
+            first, elapsed = async_to_sync(read_first_line_then_leave)(response)
+        self.assertEqual(first['response'], 'echo fast')
+        self.assertLess(elapsed, 0.5)
+        # The item still running when the client left is saved as well
+        self.assertEqual(sorted(ChatMessage.objects.values_list('content', flat=True)),
+                         ['echo fast', 'echo slow', 'fast', 'slow'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, METRICS={'TOKEN': 'scrape-me', 'FLUSH_INTERVAL': 0},
+                   CHAT_JOBS={'MAX_ATTEMPTS': 2, 'WAIT_POLL_INTERVAL': 0.05})
+class ChatJobTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.user = User.objects.create_user(username='patient', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Slow')
+        self.client.force_login(self.user)
+
+    def enqueue(self, message='hi'):
+        response = self.client.post(reverse('chat_job_create', args=[self.project.id]), json.dumps({'message': message}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        return response
+
+    def test_job_runs_in_background_and_keeps_result(self):
+        response = self.enqueue()
+        self.assertEqual(response.json()['status'], 'queued')
+        status_url = response['Location']
+        self.assertEqual(self.client.get(status_url).json()['status'], 'queued')
+
+        # Long-polling an unfinished job answers once `wait` runs out
+        started = time.monotonic()
+        self.assertEqual(self.client.get(status_url, {'wait': 0.2}).json()['status'], 'queued')
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+        with mock.patch('api.chat.get_ai_completion', return_value=fallback.Completion('Slow answer', 'model-a', 4200)):
+            self.assertEqual(jobs.run_pending(), 1)
+        data = self.client.get(status_url, {'wait': 10}).json()
+        self.assertEqual((data['status'], data['response'], data['model'], data['latency_ms']),
+                         ('done', 'Slow answer', 'model-a', 4200))
+        self.assertEqual(list(self.project.messages.order_by('id').values_list('content', flat=True)),
+                         ['hi', 'Slow answer'])
+
+        body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me').content.decode()
+        self.assertIn('chat_job_wait_seconds_count 1', body)
+        self.assertIn('chat_job_duration_seconds_count{status="done"} 1', body)
+        self.assertIn('chat_jobs{status="queued"} 0', body)
+
+    def test_failed_job_is_retried_then_reported(self):
+        status_url = self.enqueue()['Location']
+        self.enqueue('second')
+        body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me').content.decode()
+        self.assertIn('chat_jobs{status="queued"} 2', body)
+
+        with mock.patch('api.chat.get_ai_completion', side_effect=RuntimeError('upstream down')):
+            job = jobs.claim()
+            self.assertFalse(jobs.run_job(job))
+            self.assertEqual(ChatJob.objects.get(pk=job.pk).status, 'queued')
+            self.assertFalse(jobs.run_job(jobs.claim()))
+        data = self.client.get(status_url).json()
+        self.assertEqual((data['status'], data['error']), ('failed', 'upstream down'))
+        self.assertFalse(self.project.messages.exists())
+
+    def test_jobs_are_private(self):
+        status_url = self.enqueue()['Location']
+        self.client.force_login(User.objects.create_user(username='nosy', password='testpassword123'))
+        self.assertEqual(self.client.get(status_url).status_code, 404)
+        response = self.client.post(reverse('chat_job_create', args=[self.project.id]), json.dumps({'message': 'x'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+class WebSocketClient:
+    """Drives api.websocket.application the way an ASGI server would."""
+
+    def __init__(self, path, headers):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': path,
+                 'headers': [(name.encode(), value.encode()) for name, value in headers.items()]}
+        self.task = asyncio.create_task(websocket.application(scope, self.incoming.get, self.outgoing.put))
+
+    async def connect(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await self.event()
+
+    async def event(self):
+        return await asyncio.wait_for(self.outgoing.get(), 5)
+
+    async def receive(self):
+        return json.loads((await self.event())['text'])
+
+    async def send(self, frame):
+        await self.incoming.put({'type': 'websocket.receive', 'text': json.dumps(frame)})
+
+    async def close(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, OPENROUTER_API_KEY='')
+class WebSocketChatTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='socketeer', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Live')
+        self.client.force_login(self.user)
+        self.path = f'/ws/project/{self.project.id}/chat/'
+        self.headers = {'host': 'localhost:8000', 'origin': 'http://localhost:8000',
+                        'cookie': f"sessionid={self.client.cookies['sessionid'].value}"}
+
+    async def test_refuses_foreign_origins_and_anonymous_users(self):
+        closed = await WebSocketClient(self.path, {**self.headers, 'origin': 'https://evil.example'}).connect()
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': websocket.FORBIDDEN})
+        closed = await WebSocketClient(self.path, {**self.headers, 'cookie': ''}).connect()
+        self.assertEqual(closed['code'], websocket.UNAUTHORIZED)
+        other = await Project.objects.acreate(user=await User.objects.acreate(username='other'), name='Theirs')
+        closed = await WebSocketClient(f'/ws/project/{other.id}/chat/', self.headers).connect()
+        self.assertEqual(closed['code'], websocket.NOT_FOUND)
+
+    async def test_streams_turns_over_one_connection(self):
+        socket = WebSocketClient(self.path, self.headers)
+        self.assertEqual(await socket.connect(), {'type': 'websocket.accept'})
+        self.assertEqual(await socket.receive(), {'type': 'ready', 'project_id': self.project.id})
+        for message in ('hello', 'again'):
+            await socket.send({'type': 'message', 'message': message})
+            tokens = []
+            frame = await socket.receive()
+            while frame['type'] == 'token':
+                tokens.append(frame['token'])
+                frame = await socket.receive()
+            self.assertEqual(frame['type'], 'done')
+            self.assertEqual(''.join(tokens), frame['response'])
+        await socket.close()
+        contents = [msg async for msg in self.project.messages.order_by('id').values_list('content', flat=True)]
+        self.assertEqual(contents[::2], ['hello', 'again'])
+
+    async def test_each_connection_gets_its_own_sync_thread(self):
+        # Under a server (no outer async_to_sync, unlike this test) each
+        # context is served by a thread of its own
+        contexts = []
+
+        def record():
+            contexts.append(SyncToAsync.thread_sensitive_context.get(None))
+
+        sockets = [WebSocketClient(self.path, self.headers) for _ in range(2)]
+        with mock.patch('api.websocket.close_old_connections', record):
+            for socket in sockets:
+                await socket.connect()
+        for socket in sockets:
+            await socket.close()
+        self.assertEqual(len(contexts), 2)
+        self.assertIsNotNone(contexts[0])
+        self.assertIsNot(contexts[0], contexts[1])
+
+    async def test_cancel_stops_the_upstream(self):
+        closed = asyncio.Event()
+
+        async def endless(*args, **kwargs):
+            try:
+                yield 'Partial '
+                await asyncio.sleep(30)
+                yield 'never sent'
+            finally:
+                closed.set()
+
+        socket = WebSocketClient(self.path, self.headers)
+        await socket.connect()
+        await socket.receive()
+        with mock.patch('api.websocket.astream_ai_response', endless):
+            await socket.send({'type': 'message', 'message': 'go on forever'})
+            self.assertEqual(await socket.receive(), {'type': 'token', 'token': 'Partial '})
+            await socket.send({'type': 'message', 'message': 'meanwhile'})
+            self.assertEqual((await socket.receive())['error'], 'A reply is still being generated.')
+            await socket.send({'type': 'cancel'})
+            self.assertEqual(await socket.receive(), {'type': 'cancelled', 'response': 'Partial '})
+        await asyncio.wait_for(closed.wait(), 5)
+        await socket.send({'type': 'ping'})
+        self.assertEqual(await socket.receive(), {'type': 'pong'})
+        await socket.close()
+        saved = [msg async for msg in self.project.messages.order_by('id').values_list('content', flat=True)]
+        self.assertEqual(saved, ['go on forever', 'Partial '])
+
+
+class HedgedFallbackTest(SimpleTestCase):
+    def make_attempt(self, plan, log):
+        async def attempt(model, time_left):
+            delay, status = plan[model]
+            log.append(('start', model))
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                log.append(('cancelled', model))
+                raise
+            return httpx.Response(status, json={'choices': [{'message': {'content': model}}]})
+        return attempt
+
+    def test_hedge_wins_and_cancels_slow_model(self):
+        log = []
+        plan = {'slow': (5, 200), 'fast': (0.01, 200)}
+        policy = fallback.FallbackPolicy(hedge_delay=0.05, max_parallel=2, deadline=2)
+        outcome = asyncio.run(fallback.race(['slow', 'fast'], self.make_attempt(plan, log), policy))
+        self.assertEqual(outcome.model, 'fast')
+        self.assertLess(outcome.latency_ms, 1000)
+        self.assertIn(('cancelled', 'slow'), log)
+
+    def test_failure_starts_next_model_without_waiting(self):
+        log = []
+        plan = {'broken': (0, 503), 'ok': (0, 200)}
+        policy = fallback.FallbackPolicy(hedge_delay=10, max_parallel=1, deadline=2)
+        outcome = asyncio.run(fallback.race(['broken', 'ok'], self.make_attempt(plan, log), policy))
+        self.assertEqual(outcome.model, 'ok')
+        self.assertLess(outcome.latency_ms, 1000)
+
+    def test_overall_deadline(self):
+        log = []
+        plan = {'a': (5, 200), 'b': (5, 200), 'c': (5, 200)}
+        policy = fallback.FallbackPolicy(hedge_delay=0.05, max_parallel=2, deadline=0.2)
+        outcome = asyncio.run(fallback.race(['a', 'b', 'c'], self.make_attempt(plan, log), policy))
+        self.assertIsNone(outcome.model)
+        self.assertEqual(outcome.last_error, "Request deadline exceeded.")
+        self.assertNotIn(('start', 'c'), log)
+        self.assertEqual(sorted(m for e, m in log if e == 'cancelled'), ['a', 'b'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MODEL_ROUTER={'CONSECUTIVE_FAILURES': 2, 'OPEN_SECONDS': 30})
+class ModelRouterTest(SimpleTestCase):
+    models = ['a', 'b', 'c']
+
+    def setUp(self):
+        cache.clear()
+        self.router = ModelRouter()
+
+    def test_orders_by_expected_latency(self):
+        self.router.record('a', 900, ok=True)
+        self.router.record('b', 100, ok=True)
+        self.router.record('c', 300, ok=True)
+        self.assertEqual(self.router.candidates(self.models), ['b', 'c', 'a'])
+
+    def test_breaker_opens_then_half_open_probe(self):
+        self.router.record('a', 100, ok=False, status=503)
+        self.router.record('a', 100, ok=False, status=429)
+        state = self.router.get_state('a')
+        self.assertEqual(state['breaker'], OPEN)
+        self.assertEqual((state['status_5xx'], state['status_429']), (1, 1))
+        self.assertNotIn('a', self.router.candidates(self.models))
+
+        with mock.patch('api.routing.time.time', return_value=state['opened_at'] + 31):
+            self.assertIn('a', self.router.candidates(self.models))
+            self.assertEqual(self.router.get_state('a')['breaker'], HALF_OPEN)
+            # Only one request gets the probe slot
+            self.assertNotIn('a', self.router.candidates(self.models))
+            self.router.record('a', 120, ok=True, status=200)
+        self.assertEqual(self.router.get_state('a')['breaker'], CLOSED)
+        self.assertIn('a', self.router.candidates(self.models))
+
+
+    def test_coroutines_use_the_cache_off_the_event_loop(self):
+        shared, threads = self.router.cache, set()
+
+        class Spy:
+            def __getattr__(self, name):
+                threads.add(threading.current_thread())
+                return getattr(shared, name)
+
+        async def route():
+            self.router.cache = Spy()
+            await self.router.arecord('b', 100, ok=True)
+            return threading.current_thread(), await self.router.acandidates(self.models)
+
+        loop_thread, order = asyncio.run(route())
+        self.assertEqual(order[-1], 'b')
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
+
+@override_settings(CACHES=LOCMEM_CACHES, OPENROUTER_API_KEY='sk-or-v1-test')
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='faq', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='FAQ', response_cache_enabled=True)
+        Prompt.objects.create(project=self.project, content='Answer FAQs.')
+        self.completion = fallback.Completion('We open at 9.', 'openai/gpt-3.5-turbo', 800)
+
+    def ask(self, message='When do you open?'):
+        project = chat.projects().get(pk=self.project.pk)
+        prompt, history = chat.load_context(project)
+        return chat.complete(project, message, prompt, history)
+
+    def test_repeated_turn_is_served_from_cache(self):
+        with mock.patch('api.chat.get_ai_completion', return_value=self.completion) as upstream_call:
+            first = self.ask()
+            second = self.ask()
+        self.assertEqual(upstream_call.call_count, 1)
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual(second.content, 'We open at 9.')
+        self.assertEqual(response_cache.stats(self.project.id)['hits'], 1)
+
+    def test_new_prompt_invalidates(self):
+        with mock.patch('api.chat.get_ai_completion', return_value=self.completion) as upstream_call:
+            self.ask()
+            Prompt.objects.create(project=self.project, content='Answer FAQs politely.')
+            self.ask()
+        self.assertEqual(upstream_call.call_count, 2)
+
+    @override_settings(RESPONSE_CACHE={'MAX_ENTRIES_PER_PROJECT': 2})
+    def test_least_recently_used_entry_is_evicted(self):
+        with mock.patch('api.chat.get_ai_completion', return_value=self.completion) as upstream_call:
+            self.ask('a')
+            self.ask('b')
+            self.ask('a')  # hit, 'b' is now least recently used
+            self.ask('c')  # evicts 'b'
+            self.ask('a')
+            self.ask('b')
+        self.assertEqual(upstream_call.call_count, 4)
+
+
+class ActivePromptTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='indexed', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='Indexed')
+
+    def reload(self):
+        return chat.projects().get(pk=self.project.pk)
+
+    def test_tracks_latest_prompt(self):
+        Prompt.objects.create(project=self.project, content='First.')
+        second = Prompt.objects.create(project=self.project, content='Second.')
+        self.assertEqual(self.reload().active_prompt, second)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.reload().active_prompt.content, 'First.')
+
+    def test_context_is_one_query_per_table(self):
+        Prompt.objects.create(project=self.project, content='Be brief.')
+        ChatMessage.objects.create(project=self.project, role='user', content='Hi')
+        context.forget_window(self.project.pk)
+        # Project with its prompt, summary, messages
+        with self.assertNumQueries(3):
+            project = self.reload()
+            prompt, history = chat.load_context(project)
+        self.assertEqual(prompt, 'Be brief.')
+        self.assertEqual(history, [{'role': 'user', 'content': 'Hi'}])
+
+
+class HistoryPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='scroller', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Long chat')
+        for n in range(7):
+            ChatMessage.objects.create(project=self.project, role='user', content=f'm{n}')
+        # Ties on timestamp are broken by id
+        tied = ChatMessage.objects.filter(content__in=['m2', 'm3', 'm4'])
+        tied.update(timestamp=tied.first().timestamp)
+
+    def test_pages_walk_back_without_gaps(self):
+        seen = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page, cursor = history.history_page(self.project, before=cursor, limit=3)
+            seen = [msg.content for msg in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f'm{n}' for n in range(7)])
+
+    def test_history_endpoint(self):
+        self.client.login(username='scroller', password='testpassword123')
+        url = reverse('chat_history', args=[self.project.id])
+        first = self.client.get(url, {'limit': 4}).json()
+        self.assertEqual([m['content'] for m in first['messages']], ['m3', 'm4', 'm5', 'm6'])
+        older = self.client.get(url, {'limit': 4, 'before': first['next_cursor']}).json()
+        self.assertEqual([m['content'] for m in older['messages']], ['m0', 'm1', 'm2'])
+        self.assertIsNone(older['next_cursor'])
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 400)
+
+
+class TurnPersistenceTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='writer', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='Busy')
+
+    def test_turn_is_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            chat.save_turn(self.project, 'Hi', fallback.Completion('Hello!', 'openai/gpt-3.5-turbo', 120))
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        page, _ = history.history_page(self.project)
+        self.assertEqual([(m.role, m.content) for m in page], [('user', 'Hi'), ('assistant', 'Hello!')])
+
+    def test_write_behind_batches_and_flushes_on_close(self):
+        batches = []
+        buffer = writebehind.WriteBehindBuffer(writer=batches.append, max_delay=0.2, batch_size=4)
+        for n in range(3):
+            buffer.submit(chat.turn_rows(self.project, f'm{n}', fallback.Completion('ok', None, 1)))
+        buffer.close()
+        self.assertEqual([len(batch) for batch in batches], [4, 2])
+        self.assertEqual(ChatMessage.objects.count(), 0)
+
+    def test_full_queue_writes_inline(self):
+        written = []
+        entered = threading.Event()
+        gate = threading.Event()
+
+        def writer(rows):
+            if threading.current_thread() is not threading.main_thread():
+                entered.set()
+                gate.wait(5)
+            written.append((threading.current_thread().name, rows))
+
+        buffer = writebehind.WriteBehindBuffer(writer=writer, max_queue=1, max_delay=0)
+        buffer.submit(['a'])  # picked up by the writer thread, which then blocks
+        entered.wait(5)
+        buffer.submit(['b'])  # fills the queue
+        buffer.submit(['c'])  # queue full: written by the caller
+        gate.set()
+        buffer.close()
+        self.assertIn(('MainThread', ['c']), written)
+        self.assertEqual(len(written), 3)
+
+    def test_full_queue_writes_off_the_event_loop(self):
+        entered = threading.Event()
+        gate = threading.Event()
+        on_loop = []
+
+        def writer(rows):
+            if rows == ['a']:
+                entered.set()
+                gate.wait(5)
+                return
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(rows)
+            except RuntimeError:
+                pass
+
+        buffer = writebehind.WriteBehindBuffer(writer=writer, max_queue=1, max_delay=0)
+        buffer.submit(['a'])
+        entered.wait(5)
+        buffer.submit(['b'])
+        async_to_sync(buffer.asubmit)(['c'])  # queue full
+        gate.set()
+        buffer.close()
+        self.assertEqual(on_loop, [])
+
+
+class ChatCountersTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='counted', password='testpassword123')
+        self.alpha = Project.objects.create(user=self.user, name='Alpha')
+        self.beta = Project.objects.create(user=self.user, name='Beta')
+
+    def test_turns_update_counters(self):
+        completion = fallback.Completion('ok', None, 1)
+        chat.save_turn(self.alpha, 'one', completion)
+        chat.save_turn(self.alpha, 'two', completion)
+        chat.save_turn(self.beta, 'three')
+        self.alpha.refresh_from_db()
+        self.assertEqual(self.alpha.message_count, 4)
+        self.assertIsNotNone(self.alpha.last_activity_at)
+        self.assertEqual(UserStats.objects.get(user=self.user).message_count, 5)
+
+        self.beta.delete()
+        self.assertEqual(UserStats.objects.get(user=self.user).message_count, 4)
+
+    def test_dashboard_and_rebuild(self):
+        ChatMessage.objects.create(project=self.alpha, role='user', content='untracked')
+        call_command('rebuild_chat_counters', stdout=io.StringIO())
+        self.assertEqual(UserStats.objects.get(user=self.user).message_count, 1)
+
+        self.client.login(username='counted', password='testpassword123')
+        self.client.get(reverse('dashboard'))  # warm up the session
+        # session, user, projects summary, user stats
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['total_messages'], 1)
+        self.assertEqual([p.name for p in response.context['projects']], ['Alpha', 'Beta'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ContextBudgetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        project_cache.clear_local()
+        user = User.objects.create_user(username='chatty', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='Chatty', context_token_budget=200)
+
+    def turn(self, n, words=10):
+        # A whole turn, so summaries folded while loading get saved
+        project = self.project_config()
+        chat.load_context(project)
+        chat.save_turn(project, f'question {n} ' + 'word ' * words, fallback.Completion(f'answer {n}', None, 1))
+
+    def project_config(self):
+        return chat.get_project(self.project.pk, self.project.user)
+
+    def load(self):
+        return chat.load_context(self.project_config())
+
+    def test_concurrent_folds_keep_the_furthest(self):
+        for n in range(20):
+            self.turn(n)
+        ConversationSummary.objects.all().delete()
+        context.forget_window(self.project.pk)
+        # Two turns fold from the same window before either saves
+        first, second = self.project_config(), self.project_config()
+        chat.load_context(first)
+        chat.load_context(second)
+        self.assertIsNotNone(first.folded_summary)
+        chat.save_turn(first, 'first')
+        chat.save_turn(second, 'second')
+        summary = ConversationSummary.objects.get(project=self.project)
+        through = (summary.through_timestamp, summary.through_id)
+
+        # A stale fold does not move the summary back
+        stale = self.project_config()
+        context.fold(stale, None, list(self.project.messages.order_by('timestamp', 'id')[:2]), 100)
+        context.save_folded(stale)
+        summary.refresh_from_db()
+        self.assertEqual((summary.through_timestamp, summary.through_id), through)
+
+    def test_history_fits_budget_and_rolls_into_summary(self):
+        for n in range(20):
+            self.turn(n)
+        prompt, history = self.load()
+        total = context.count_tokens(prompt) + sum(
+            context.count_tokens(m['content']) + context.MESSAGE_OVERHEAD for m in history)
+        self.assertLessEqual(total, 200)
+        self.assertEqual(history[-1]['content'], 'answer 19')
+        self.assertIn('Summary of the earlier conversation', prompt)
+        summary = ConversationSummary.objects.get(project=self.project)
+        folded_through = summary.through_id
+
+        # Steady state: configuration and window come from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.load(), (prompt, history))
+
+        self.turn(20)
+        self.turn(21)
+        prompt, history = self.load()
+        summary.refresh_from_db()
+        self.assertGreater(summary.through_id, folded_through)
+        self.assertEqual(history[-1]['content'], 'answer 21')
+        # The cached window matches what the database would give
+        cache.clear()
+        self.assertEqual(self.load(), (prompt, history))
+
+    def test_messages_older_than_the_window_are_folded_first(self):
+        ChatMessage.objects.bulk_create(ChatMessage(project=self.project, role='user', content=f'old {n} ' + 'word ' * 50)
+                                        for n in range(12))
+        old = list(self.project.messages.order_by('timestamp', 'id').values_list('id', flat=True))
+        with mock.patch.object(context, 'MAX_WINDOW_MESSAGES', 5):
+            self.turn(12)
+            # The window holds old 7-11; the five oldest are folded, not skipped
+            self.assertEqual(ConversationSummary.objects.get(project=self.project).through_id, old[4])
+            self.turn(13)
+            project = self.project_config()
+            _, history = chat.load_context(project)
+        # Every message is either summarised or sent
+        summary = getattr(project, 'folded_summary', None) or ConversationSummary.objects.get(project=self.project)
+        self.assertGreaterEqual(summary.through_id, old[8])
+        after = self.project.messages.filter(id__gt=summary.through_id).values_list('content', flat=True)
+        self.assertEqual([msg['content'] for msg in history], list(after))
+
+    def test_long_messages_are_summarised_or_truncated(self):
+        self.turn(0, words=2000)
+        prompt, history = self.load()
+        # The paste does not fit next to the reply and is summarised instead
+        self.assertEqual(history, [{'role': 'assistant', 'content': 'answer 0'}])
+        self.assertIn('- User: question 0 word', prompt)
+        self.assertLess(context.count_tokens(prompt), 200)
+
+        chat.save_turn(self.project_config(), 'Paste it back', fallback.Completion('word ' * 2000, None, 1))
+        prompt, history = self.load()
+        # The latest message is always kept, shortened to the budget
+        self.assertEqual(len(history), 1)
+        self.assertTrue(history[0]['content'].endswith('…'))
+        self.assertLessEqual(context.count_tokens(prompt) + context.count_tokens(history[0]['content']), 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProjectConfigCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        project_cache.clear_local()
+        self.user = User.objects.create_user(username='steady', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Steady')
+        Prompt.objects.create(project=self.project, content='Be brief.')
+        self.client.login(username='steady', password='testpassword123')
+
+    def post_turn(self, message):
+        return self.client.post(reverse('chat_api', args=[self.project.id]), json.dumps({'message': message}),
+                                content_type='application/json')
+
+    def test_steady_state_turn_queries_nothing_before_upstream(self):
+        queries_before_upstream = []
+
+        def upstream_call(message, **kwargs):
+            queries_before_upstream.append(len(ctx.captured_queries))
+            return fallback.Completion(f're: {message}', 'model-a', 5)
+
+        with mock.patch('api.chat.get_ai_completion', return_value=fallback.Completion('hi', 'model-a', 5)):
+            self.post_turn('warm up')
+        with mock.patch('api.chat.get_ai_completion', side_effect=upstream_call):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.post_turn('hello again')
+        self.assertEqual(response.json(), {'response': 're: hello again'})
+        # Only the session and the user, both loaded by the auth middleware
+        self.assertEqual(queries_before_upstream, [2])
+        self.assertEqual(ChatMessage.objects.filter(project=self.project).count(), 4)
+
+    def test_prompt_and_settings_changes_invalidate(self):
+        self.assertEqual(chat.get_project(self.project.id, self.user).active_prompt.content, 'Be brief.')
+        with self.assertNumQueries(0):
+            chat.get_project(self.project.id, self.user)
+
+        newer = Prompt.objects.create(project=self.project, content='Be thorough.')
+        self.assertEqual(chat.get_project(self.project.id, self.user).active_prompt.content, 'Be thorough.')
+        with self.captureOnCommitCallbacks(execute=True):
+            newer.delete()
+        self.assertEqual(chat.get_project(self.project.id, self.user).active_prompt.content, 'Be brief.')
+
+        self.project.context_token_budget = 1234
+        self.project.save()
+        self.assertEqual(chat.get_project(self.project.id, self.user).context_token_budget, 1234)
+
+    def test_other_users_projects_are_not_found(self):
+        intruder = User.objects.create_user(username='intruder', password='testpassword123')
+        chat.get_project(self.project.id, self.user)  # cached
+        with self.assertRaises(Http404):
+            chat.get_project(self.project.id, intruder)
+        with self.assertRaises(Http404):
+            chat.get_project(self.project.id + 1000, self.user)
+
+
+class RetrievalTest(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings = override_settings(MEDIA_ROOT=tmp.name, RAG={'INDEX_ROOT': f'{tmp.name}/index', 'TOP_K': 2})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        user = User.objects.create_user(username='librarian', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='Docs')
+
+    def upload(self, name, text):
+        project_file = ProjectFile.objects.create(project=self.project, name=name, size_bytes=len(text.encode()),
+                                                  file=SimpleUploadedFile(name, text.encode()))
+        ingest.run_pending()
+        project_file.refresh_from_db()
+        return project_file
+
+    def test_relevant_chunks_reach_the_system_prompt(self):
+        self.upload('refunds.md', 'Refunds are issued within 14 days of purchase to the original card.')
+        self.upload('shipping.txt', 'Parcels ship from Berlin and arrive within three working days.')
+        hits = rag.search(self.project.id, 'how many days until my refund arrives on my card')
+        self.assertEqual(len(hits), 2)
+        best = DocumentChunk.objects.get(pk=hits[0][0])
+        self.assertEqual(best.file.name, 'refunds.md')
+
+        prompt, _ = chat.load_context(chat.projects().get(pk=self.project.pk), 'refund to my card?')
+        self.assertIn('[refunds.md] Refunds are issued within 14 days', prompt)
+
+    def test_builds_of_a_project_take_turns(self):
+        running, overlapped = [], []
+
+        def build(project_id, project_dir):
+            running.append(project_id)
+            overlapped.append(len(running) > 1)
+            time.sleep(0.1)
+            running.remove(project_id)
+            return 0
+
+        with mock.patch('api.rag._build', side_effect=build):
+            threads = [threading.Thread(target=rag.build_index, args=(self.project.id,)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(overlapped, [False, False, False])
+
+    def test_unrelated_queries_retrieve_nothing(self):
+        rng = random.Random(0)
+        vocabulary = [''.join(rng.choice('bcdfghjklmnpqrstvwxz') for _ in range(7)) for _ in range(3000)]
+        words = [rng.choice(vocabulary) for _ in range(100 * 160)]
+        self.upload('corpus.txt', ' '.join(words))
+        for query in ('hello can you help me today', 'thanks!', 'what is the weather like'):
+            self.assertEqual(rag.search(self.project.id, query), [], query)
+
+        # A handful of a chunk's words find that chunk
+        chunks = rng.sample(list(DocumentChunk.objects.filter(project=self.project).order_by('id')), 20)
+        found = sum(chunk.id in [chunk_id for chunk_id, _ in rag.search(
+            self.project.id, ' '.join(rng.sample(chunk.content.split(), 6)))] for chunk in chunks)
+        self.assertGreaterEqual(found, 19)
+
+    def test_deleting_a_file_removes_it_from_results(self):
+        doc = self.upload('refunds.md', 'Refunds are issued within 14 days.')
+        self.assertEqual(len(rag.retrieve(self.project.id, 'refunds')), 1)
+        doc.delete()
+        self.assertEqual(rag.retrieve(self.project.id, 'refunds'), [])
+
+    def test_chunking_overlaps(self):
+        words = [f'w{n}' for n in range(10)]
+        chunks = ingest.chunk_text(' '.join(words), size=4, overlap=1)
+        self.assertEqual(chunks, ['w0 w1 w2 w3', 'w3 w4 w5 w6', 'w6 w7 w8 w9'])
+
+
+class WorkQueueTest(SimpleTestCase):
+    def test_worker_runs_claimed_jobs_in_its_pool(self):
+        pending, done, ticks = [1, 2, 3], [], []
+        stop = threading.Event()
+
+        def run_job(job, config):
+            done.append((job, threading.current_thread().name))
+            if len(done) == 3:
+                stop.set()
+
+        workqueue.run_worker(lambda config: pending.pop(0) if pending else None, run_job, {}, 'test-pool',
+                             workers=2, poll_interval=0.01, stop_event=stop, tick=lambda: ticks.append(1))
+        self.assertEqual(sorted(job for job, _ in done), [1, 2, 3])
+        self.assertTrue(all(name.startswith('test-pool') for _, name in done))
+        self.assertTrue(ticks)
+
+
+class IngestionQueueTest(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings = override_settings(MEDIA_ROOT=tmp.name, RAG={'INDEX_ROOT': f'{tmp.name}/index', 'CHUNK_WORDS': 50},
+                                     INGEST={'READ_BLOCK_BYTES': 7, 'INSERT_BATCH': 3, 'RETRY_DELAY': 0})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        user = User.objects.create_user(username='uploader', password='testpassword123')
+        self.project = Project.objects.create(user=user, name='Docs')
+        self.client.login(username='uploader', password='testpassword123')
+
+    def test_upload_is_queued_then_streamed_into_chunks(self):
+        # Multi-byte characters and words straddle the tiny read blocks
+        text = ' '.join(f'café{n}' for n in range(500))
+        response = self.client.post(reverse('project_detail', args=[self.project.id]), {
+            'upload_file': '1', 'name': 'menu.txt', 'file': SimpleUploadedFile('menu.txt', text.encode()),
+        })
+        self.assertEqual(response.status_code, 302)
+        project_file = ProjectFile.objects.get(project=self.project)
+        self.assertEqual(project_file.status, ProjectFile.QUEUED)
+        self.assertFalse(DocumentChunk.objects.exists())
+
+        self.assertEqual(ingest.run_pending(), 1)
+        project_file.refresh_from_db()
+        self.assertEqual(project_file.status, ProjectFile.READY)
+        self.assertEqual(project_file.bytes_processed, len(text.encode()))
+        self.assertEqual(project_file.chunk_count, project_file.chunks.count())
+        words = ' '.join(project_file.chunks.order_by('ordinal').values_list('content', flat=True)).split()
+        self.assertEqual(set(words), set(text.split()))
+        self.assertEqual(rag.retrieve(self.project.id, 'café499')[0].file, project_file)
+
+    def test_a_claimed_job_is_not_handed_out_twice(self):
+        ProjectFile.objects.create(project=self.project, name='a.txt', file=SimpleUploadedFile('a.txt', b'alpha'))
+        claimed = ingest.claim()
+        self.assertEqual(claimed.status, ProjectFile.PROCESSING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(ingest.claim())
+
+    def test_failed_attempts_retry_idempotently_then_give_up(self):
+        project_file = ProjectFile.objects.create(project=self.project, name='a.txt',
+                                                  file=SimpleUploadedFile('a.txt', b'alpha beta gamma'))
+        def flaky(pf):
+            # Leave half-written chunks behind, then fail
+            DocumentChunk.objects.create(project=self.project, file=pf, ordinal=0, content='partial')
+            raise OSError('disk hiccup')
+
+        with mock.patch.object(ingest, 'process', side_effect=flaky):
+            ingest.run_pending(limit=1)
+        project_file.refresh_from_db()
+        self.assertEqual((project_file.status, project_file.error), (ProjectFile.QUEUED, 'disk hiccup'))
+
+        ingest.run_pending()
+        project_file.refresh_from_db()
+        self.assertEqual(project_file.status, ProjectFile.READY)
+        self.assertEqual(list(project_file.chunks.values_list('content', flat=True)), ['alpha beta gamma'])
+
+        with mock.patch.object(ingest, 'process', side_effect=OSError('gone')):
+            ProjectFile.objects.filter(pk=project_file.pk).update(status=ProjectFile.QUEUED, attempts=2)
+            ingest.run_pending()
+        project_file.refresh_from_db()
+        self.assertEqual((project_file.status, project_file.attempts), (ProjectFile.FAILED, 3))
+
+    def test_unsupported_files_fail_without_retrying(self):
+        ProjectFile.objects.create(project=self.project, name='photo.png', file=SimpleUploadedFile('photo.png', b'\x89PNG'))
+        ingest.run_pending()
+        project_file = ProjectFile.objects.get()
+        self.assertEqual((project_file.status, project_file.attempts), (ProjectFile.FAILED, 1))
+        self.assertIn('Unsupported file type', project_file.error)
+
+
+class SqliteProfileTest(SimpleTestCase):
+    def setUp(self):
+        from .sqlite.base import DatabaseWrapper
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.path = f'{workdir.name}/chat.sqlite3'
+        settings_dict = {**connection.settings_dict, 'NAME': self.path,
+                         'OPTIONS': {'timeout': 0.2, 'transaction_mode': 'IMMEDIATE',
+                                     'init_command': 'PRAGMA journal_mode = WAL'}}
+        self.first = DatabaseWrapper(settings_dict, alias='stress-first')
+        self.second = DatabaseWrapper(settings_dict, alias='stress-second')
+        self.addCleanup(self.second.close)
+        self.addCleanup(self.first.close)
+
+    def test_write_transactions_hold_the_process_writer_lock_until_they_end(self):
+        from .sqlite.base import writer_lock
+        lock = writer_lock(self.path)
+        with self.first.cursor() as cursor:
+            cursor.execute('CREATE TABLE turn (id INTEGER PRIMARY KEY)')
+            self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+
+        self.first.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.assertTrue(lock.locked())
+        self.first.cursor().execute('INSERT INTO turn DEFAULT VALUES')
+        # Readers are not held up by the writer
+        with self.second.cursor() as cursor:
+            self.assertEqual(cursor.execute('SELECT COUNT(*) FROM turn').fetchone(), (0,))
+        self.first.commit()
+        self.first.set_autocommit(True)
+        self.assertFalse(lock.locked())
+
+        self.second.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.assertTrue(lock.locked())
+        self.second.rollback()
+        self.second.set_autocommit(True)
+        self.assertFalse(lock.locked())
+
+        # A connection closed mid-transaction gives the lock back too
+        self.first.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.first.close()
+        self.assertFalse(lock.locked())
+
+
+@override_settings(CHAT_ARCHIVE={'HORIZON_DAYS': 30, 'SEGMENT_MESSAGES': 40, 'MIN_SEGMENT_MESSAGES': 10})
+class ChatArchiveTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='archivist', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Old chat')
+        old = timezone.now() - timedelta(days=100)
+        ChatMessage.objects.bulk_create(
+            ChatMessage(project=self.project, role='user' if n % 2 == 0 else 'assistant', content=f'm{n}',
+                        timestamp=old + timedelta(minutes=n // 3))  # ties broken by id
+            for n in range(200)
+        )
+        call_command('rebuild_chat_counters', stdout=io.StringIO())
+
+    def walk(self, limit):
+        seen, cursor = [], None
+        while True:
+            page, cursor = history.history_page(self.project, before=cursor, limit=limit)
+            seen = [msg.content for msg in page] + seen
+            if cursor is None:
+                return seen
+
+    def test_old_messages_move_to_segments_and_stay_readable(self):
+        before = self.walk(limit=17)
+        out = io.StringIO()
+        call_command('compact_chat_history', stdout=out)
+        self.assertIn('Archived 150 message(s) in 4 segment(s)', out.getvalue())
+        self.assertIn('Hot table: 200 -> 50 message(s)', out.getvalue())
+
+        # The newest messages stay hot for the context window, whatever their age
+        self.assertEqual(ChatMessage.objects.count(), 50)
+        self.assertEqual(ChatArchiveSegment.objects.count(), 4)
+        self.assertTrue(all(len(s.data) < s.raw_bytes for s in ChatArchiveSegment.objects.all()))
+        self.project.refresh_from_db()
+        self.assertEqual(self.walk(limit=17), before)
+        self.assertEqual([m.content for m in history.history_page(self.project)[0]], before[-50:])
+
+        self.client.login(username='archivist', password='testpassword123')
+        url = reverse('chat_history', args=[self.project.id])
+        page = self.client.get(url, {'limit': 100}).json()
+        page = self.client.get(url, {'limit': 100, 'before': page['next_cursor']}).json()
+        self.assertEqual([m['content'] for m in page['messages']], before[:100])
+        self.assertIsNone(page['next_cursor'])
+
+        # Counters keep counting archived messages, also when rebuilt
+        self.assertEqual((self.project.message_count, self.project.archived_message_count), (200, 150))
+        call_command('rebuild_chat_counters', stdout=io.StringIO())
+        self.project.refresh_from_db()
+        self.assertEqual((self.project.message_count, self.project.archived_message_count), (200, 150))
+        self.assertEqual(UserStats.objects.get(user=self.user).message_count, 200)
+
+    def test_compaction_is_incremental_and_follows_the_project_horizon(self):
+        self.project.archive_after_days = 365
+        self.project.save()
+        self.assertEqual(archive.compact_project(self.project), (0, 0, 0, 0))
+
+        self.project.archive_after_days = None
+        self.assertEqual(archive.compact_project(self.project, max_segments=1)[:2], (1, 40))
+        self.assertEqual(archive.compact_project(self.project)[:2], (3, 110))
+        self.assertEqual(archive.compact_project(self.project)[:2], (0, 0))
+        archived = [msg.content for segment in ChatArchiveSegment.objects.order_by('last_timestamp', 'last_id')
+                    for msg in archive.unpack(segment)]
+        self.assertEqual(archived, [f'm{n}' for n in range(150)])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHAT_ARCHIVE={'HORIZON_DAYS': 30, 'SEGMENT_MESSAGES': 20, 'MIN_SEGMENT_MESSAGES': 10})
+class ProjectTransferTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mover', password='testpassword123')
+        self.project = Project.objects.create(user=self.user, name='Moving', description='Going places',
+                                              context_token_budget=5000)
+        Prompt.objects.create(project=self.project, content='Be brief.')
+        Prompt.objects.create(project=self.project, content='Be very brief.')
+        old = timezone.now() - timedelta(days=100)
+        ChatMessage.objects.bulk_create(
+            ChatMessage(project=self.project, role='user' if n % 2 == 0 else 'assistant', content=f'm{n} ünï',
+                        timestamp=old + timedelta(minutes=n), model='' if n % 2 == 0 else 'm/x', latency_ms=n)
+            for n in range(90)
+        )
+        archive.compact_project(self.project)
+        call_command('rebuild_chat_counters', stdout=io.StringIO())
+        self.expected = [(f'm{n} ünï', old + timedelta(minutes=n)) for n in range(90)]
+
+    def test_export_endpoint_streams_jsonl_including_archived_messages(self):
+        self.assertEqual(ChatArchiveSegment.objects.count(), 2)
+        self.client.login(username='mover', password='testpassword123')
+        response = self.client.get(reverse('project_export', args=[self.project.id]))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertTrue(response.is_async)
+        records = [json.loads(line) for line in async_to_sync(consume)(response).splitlines()]
+        self.assertEqual(records[0]['type'], 'project')
+        self.assertEqual((records[0]['name'], records[0]['context_token_budget']), ('Moving', 5000))
+        self.assertEqual([r['content'] for r in records if r['type'] == 'prompt'], ['Be brief.', 'Be very brief.'])
+        self.assertEqual([r['content'] for r in records if r['type'] == 'message'], [c for c, _ in self.expected])
+
+        gzipped = self.client.get(reverse('project_export', args=[self.project.id]), {'format': 'gzip'})
+        self.assertEqual(gzip.decompress(async_to_sync(consume)(gzipped)).splitlines(),
+                         async_to_sync(consume)(self.client.get(reverse('project_export', args=[self.project.id])))
+                         .splitlines())
+
+        User.objects.create_user(username='stranger', password='testpassword123')
+        self.client.login(username='stranger', password='testpassword123')
+        self.assertEqual(self.client.get(reverse('project_export', args=[self.project.id])).status_code, 404)
+
+    def test_export_and_import_round_trip(self):
+        owner = User.objects.create_user(username='restorer')
+        with tempfile.TemporaryDirectory() as workdir:
+            path = f'{workdir}/export.jsonl.gz'
+            call_command('export_project', self.project.id, output=path, gzip=True, stderr=io.StringIO())
+            out = io.StringIO()
+            call_command('import_project', path, user='restorer', batch_size=7, stdout=out)
+        self.assertIn('90 message(s), 2 prompt(s)', out.getvalue())
+
+        copy = Project.objects.get(user=owner)
+        self.assertEqual((copy.name, copy.description, copy.context_token_budget),
+                         ('Moving', 'Going places', 5000))
+        self.assertEqual(list(copy.messages.order_by('timestamp', 'id').values_list('content', 'timestamp')),
+                         self.expected)
+        self.assertEqual(copy.messages.filter(model='m/x', latency_ms=1).count(), 1)
+        self.assertEqual(copy.active_prompt.content, 'Be very brief.')
+        self.assertEqual(copy.message_count, 90)
+        self.assertEqual(UserStats.objects.get(user=owner).message_count, 90)
+        # The copy pages like the original
+        self.assertEqual([m.content for m in history.history_page(copy, limit=3)[0]], ['m87 ünï', 'm88 ünï', 'm89 ünï'])
+
+    def test_imported_files_are_copies(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with override_settings(MEDIA_ROOT=tmp.name):
+            original = ProjectFile.objects.create(project=self.project, name='notes.txt', size_bytes=5,
+                                                  file=SimpleUploadedFile('notes.txt', b'notes'))
+            export = b''.join(transfer.export_chunks(self.project))
+            copy, counts = transfer.import_stream(io.BytesIO(export), self.user)
+            imported = copy.files.get()
+            self.assertEqual(counts['files'], 1)
+            self.assertNotEqual(imported.file.name, original.file.name)
+            original.file.delete()
+            with imported.file.open() as f:
+                self.assertEqual(f.read(), b'notes')
+
+            # A failed import removes its copies too
+            broken = b''.join(transfer.export_chunks(copy)) + json.dumps({'type': 'prompt'}).encode()
+            with self.assertRaises(transfer.TransferError):
+                transfer.import_stream(io.BytesIO(broken), self.user)
+            self.assertEqual(os.listdir(f'{tmp.name}/project_files'), [os.path.basename(imported.file.name)])
+
+    def test_malformed_import_leaves_nothing_behind(self):
+        lines = [json.dumps({'type': 'project', 'version': 1, 'name': 'Broken'}),
+                 json.dumps({'type': 'message', 'role': 'user', 'content': 'hi', 'timestamp': timezone.now().isoformat()}),
+                 json.dumps({'type': 'message', 'role': 'robot', 'content': 'beep'})]
+        with self.assertRaisesMessage(transfer.TransferError, 'Line 3'):
+            transfer.import_stream(io.BytesIO('\n'.join(lines).encode()), self.user, batch_size=1)
+        self.assertFalse(Project.objects.filter(name='Broken').exists())
+        self.assertEqual(UserStats.objects.get(user=self.user).message_count, 90)
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='seeker', password='testpassword123')
+        self.alpha = Project.objects.create(user=self.user, name='Alpha')
+        self.beta = Project.objects.create(user=self.user, name='Beta')
+        stranger = User.objects.create_user(username='stranger')
+        self.hidden = Project.objects.create(user=stranger, name='Hidden')
+        ChatMessage.objects.bulk_create([
+            ChatMessage(project=self.alpha, role='user', content='How do I reset my password?'),
+            ChatMessage(project=self.alpha, role='assistant', content='Open settings, then <b>Reset password</b>.'),
+            ChatMessage(project=self.beta, role='user', content='Passwords and pass phrases: what is the résumé rule?'),
+            ChatMessage(project=self.hidden, role='user', content='My password is hunter2'),
+        ])
+
+    def test_search_is_ranked_scoped_and_highlighted(self):
+        self.client.login(username='seeker', password='testpassword123')
+        url = reverse('message_search')
+        results = self.client.get(url, {'q': 'reset password '}).json()['results']
+        self.assertEqual({r['project_name'] for r in results}, {'Alpha'})
+        self.assertEqual(len(results), 2)
+        assistant = next(r for r in results if r['role'] == 'assistant')
+        # Message text is escaped, matches are marked
+        self.assertIn('&lt;b&gt;<mark>Reset</mark> <mark>password</mark>&lt;/b&gt;', assistant['snippet'])
+
+        # Prefix match on the word being typed, diacritics folded, other users' projects excluded
+        results = self.client.get(url, {'q': 'passw'}).json()['results']
+        self.assertEqual(sorted(r['project_name'] for r in results), ['Alpha', 'Alpha', 'Beta'])
+        results = self.client.get(url, {'q': 'resume', 'project': self.beta.id}).json()['results']
+        self.assertEqual([r['project_name'] for r in results], ['Beta'])
+        self.assertEqual(self.client.get(url, {'q': 'hunter2'}).json()['results'], [])
+
+        page = self.client.get(url, {'q': 'password', 'limit': 1}).json()
+        self.assertEqual((len(page['results']), page['next_offset']), (1, 1))
+        # Query syntax is taken as plain words
+        self.assertEqual(len(self.client.get(url, {'q': '"reset" -password:('}).json()['results']), 2)
+        self.assertEqual(self.client.get(url, {'q': '***'}).json(), {'results': [], 'next_offset': None})
+
+    def test_index_follows_updates_deletes_and_rebuilds(self):
+        message = ChatMessage.objects.get(content__startswith='How do I')
+        message.content = 'How do I rotate my API key?'
+        message.save()
+        self.assertEqual(search.search(self.user, 'rotate')[0][0]['id'], message.id)
+        self.assertEqual(len(search.search(self.user, 'password')[0]), 2)
+        message.delete()
+        self.assertEqual(search.search(self.user, 'rotate'), ([], None))
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {search.TABLE}")
+        out = io.StringIO()
+        call_command('rebuild_message_index', optimize=True, stdout=out)
+        self.assertIn('Indexed 3 message(s)', out.getvalue())
+        self.assertEqual(len(search.search(self.user, 'password')[0]), 2)
+
+    def test_admin_search_uses_the_index(self):
+        User.objects.create_superuser(username='root', password='testpassword123')
+        self.client.login(username='root', password='testpassword123')
+        url = reverse('admin:api_chatmessage_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'q': 'password'})
+        self.assertEqual(response.context['cl'].result_count, 4)
+        self.assertTrue(any(search.TABLE in q['sql'] for q in queries.captured_queries))
+        self.assertFalse(any('LIKE' in q['sql'] for q in queries.captured_queries))
@@ -0,0 +1,267 @@
+"""Streaming export and import of a project's conversation as JSONL.
+
+An export is one JSON object per line, optionally gzip-compressed:
+
+    {"type": "project", "version": 1, "name": "...", ...}   always first
+    {"type": "prompt", "content": "...", "created_at": "..."}
+    {"type": "file", "name": "...", "file": "project_files/...", ...}
+    {"type": "message", "role": "user", "content": "...", "timestamp": "...", ...}
+
+Messages come oldest first, archived ones (see api/archive.py) included.
+Files are exported as metadata only. If the stored file is there, the
+import saves a copy of it for the new project, whose text is then indexed
+again; the two projects never share a stored file. The rolling summary
+and caches are not exported, they rebuild themselves.
+
+Both directions stream: the export reads rows with
+`QuerySet.iterator(chunk_size=CHUNK_SIZE)` and yields ~64 KiB chunks
+(`aexport_chunks` serves them to the download view under ASGI), the
+import reads one line at a time and inserts `BATCH_SIZE` rows per
+`bulk_create`, each batch in its own transaction so other writers are not
+held up by a large import. Memory stays flat whatever the project size.
+A failed import deletes the partly imported project and its file copies.
+"""
+import json
+import zlib
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from . import archive, counters, project_cache
+from .models import ChatArchiveSegment, ChatMessage, Project, ProjectFile, Prompt
+
+FORMAT_VERSION = 1
+CHUNK_SIZE = 2000
+BATCH_SIZE = 1000
+# Bytes of JSONL gathered before a chunk is handed to the response
+BUFFER_BYTES = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Project settings carried over, besides name and description
+PROJECT_FIELDS = ('hedge_delay_ms', 'max_parallel_attempts', 'request_deadline_ms', 'response_cache_enabled',
+                  'response_cache_ttl', 'context_token_budget', 'archive_after_days')
+
+
+class TransferError(ValueError):
+    """The import is malformed; the message says where."""
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _message(msg):
+    return {'type': 'message', 'role': msg.role, 'content': msg.content, 'timestamp': _iso(msg.timestamp),
+            'model': msg.model, 'latency_ms': msg.latency_ms}
+
+
+def export_records(project):
+    """Yield the export of `project` as dicts, in file order."""
+    header = {'type': 'project', 'version': FORMAT_VERSION, 'name': project.name,
+              'description': project.description, 'created_at': _iso(project.created_at)}
+    header.update((field, getattr(project, field)) for field in PROJECT_FIELDS)
+    yield header
+    for prompt in project.prompts.order_by('created_at', 'id').iterator(chunk_size=CHUNK_SIZE):
+        yield {'type': 'prompt', 'content': prompt.content, 'created_at': _iso(prompt.created_at)}
+    for project_file in project.files.order_by('uploaded_at', 'id').iterator(chunk_size=CHUNK_SIZE):
+        yield {'type': 'file', 'name': project_file.name, 'file': project_file.file.name,
+               'size_bytes': project_file.size_bytes, 'uploaded_at': _iso(project_file.uploaded_at)}
+    # Archived messages are older than the hot ones
+    segments = ChatArchiveSegment.objects.filter(project=project).order_by('last_timestamp', 'last_id')
+    for segment in segments.iterator(chunk_size=10):
+        for msg in archive.unpack(segment):
+            yield _message(msg)
+    for msg in project.messages.order_by('timestamp', 'id').iterator(chunk_size=CHUNK_SIZE):
+        yield _message(msg)
+
+
+def export_chunks(project, compress=False):
+    """Yield the JSONL export of `project` as byte chunks, gzip-compressed if `compress`."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    size = 0
+    for record in export_records(project):
+        line = json.dumps(record, ensure_ascii=False).encode() + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_BYTES:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+async def aexport_chunks(project, compress=False):
+    """`export_chunks` for async responses, so ASGI streams the export
+    instead of buffering it. Chunks are read by thread-sensitive
+    sync_to_async calls, all in the same thread as the database cursors."""
+    chunks = export_chunks(project, compress)
+    try:
+        while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Closes the cursors of a download cut short
+        await sync_to_async(chunks.close)()
+
+def _blocks(stream):
+    """Raw blocks of at most ~BUFFER_BYTES from a binary stream, gunzipped if it is gzip."""
+    data = stream.read(2)
+    if data != GZIP_MAGIC:
+        while data:
+            yield data
+            data = stream.read(BUFFER_BYTES)
+        return
+    decompressor = zlib.decompressobj(31)
+    while data:
+        # Bounded output: chat history compresses very well
+        while data:
+            yield decompressor.decompress(data, BUFFER_BYTES)
+            data = decompressor.unconsumed_tail
+        data = stream.read(BUFFER_BYTES)
+    yield decompressor.flush()
+
+
+def open_lines(stream):
+    """Decoded lines of a binary JSONL stream, gzip-compressed or not."""
+    pending = b''
+    for block in _blocks(stream):
+        pending += block
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode()
+    if pending:
+        yield pending.decode()
+
+
+def _parse_time(value, line_number):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        raise TransferError(f"Line {line_number}: invalid timestamp {value!r}")
+
+
+def _records(lines):
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise TransferError(f"Line {line_number}: invalid JSON ({e.msg})")
+        if not isinstance(record, dict):
+            raise TransferError(f"Line {line_number}: expected a JSON object")
+        yield line_number, record
+
+
+class _Importer:
+    def __init__(self, project, batch_size):
+        self.project = project
+        self.batch_size = batch_size
+        self.pending = {Prompt: [], ProjectFile: [], ChatMessage: []}
+        self.counts = {'prompts': 0, 'files': 0, 'messages': 0, 'skipped_files': 0}
+        self.copied = []
+
+    def add(self, line_number, record):
+        kind = record.get('type')
+        if kind == 'message':
+            if record.get('role') not in ('user', 'assistant') or not isinstance(record.get('content'), str):
+                raise TransferError(f"Line {line_number}: a message needs a 'role' and 'content'")
+            row = ChatMessage(project=self.project, role=record['role'], content=record['content'],
+                              timestamp=_parse_time(record.get('timestamp'), line_number),
+                              model=record.get('model') or '', latency_ms=record.get('latency_ms'))
+            if row.timestamp is None:
+                raise TransferError(f"Line {line_number}: a message needs a 'timestamp'")
+            self.queue(ChatMessage, row)
+        elif kind == 'prompt':
+            if not isinstance(record.get('content'), str):
+                raise TransferError(f"Line {line_number}: a prompt needs 'content'")
+            self.queue(Prompt, Prompt(project=self.project, content=record['content']),
+                       created_at=_parse_time(record.get('created_at'), line_number))
+        elif kind == 'file':
+            path = record.get('file')
+            if not path or not default_storage.exists(path):
+                # Metadata alone cannot be searched; the file did not come along
+                self.counts['skipped_files'] += 1
+                return
+            # A copy of its own, so deleting either project's file leaves the other's alone
+            with default_storage.open(path) as source:
+                copy = default_storage.save(path, source)
+            self.copied.append(copy)
+            self.queue(ProjectFile, ProjectFile(project=self.project, file=copy, name=record.get('name') or path,
+                                                size_bytes=record.get('size_bytes') or 0))
+        elif kind == 'project':
+            raise TransferError(f"Line {line_number}: more than one project header")
+        else:
+            raise TransferError(f"Line {line_number}: unknown record type {kind!r}")
+
+    def queue(self, model, row, created_at=None):
+        self.pending[model].append((row, created_at))
+        if len(self.pending[model]) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model):
+        pending = self.pending[model]
+        if not pending:
+            return
+        self.pending[model] = []
+        with transaction.atomic():
+            created = model.objects.bulk_create([row for row, _ in pending])
+            if model is ChatMessage:
+                counters.record_messages(created)
+                self.counts['messages'] += len(created)
+            elif model is Prompt:
+                # auto_now_add overrode the exported creation times; few rows
+                for prompt, (_, created_at) in zip(created, pending):
+                    if created_at is not None:
+                        Prompt.objects.filter(pk=prompt.pk).update(created_at=created_at)
+                self.counts['prompts'] += len(created)
+            else:
+                # Queued: the ingest workers index the files again (api/ingest.py)
+                self.counts['files'] += len(created)
+
+    def finish(self):
+        for model in self.pending:
+            self.flush(model)
+        latest = Prompt.objects.filter(project=self.project).order_by('-created_at', '-id').first()
+        Project.objects.filter(pk=self.project.pk).update(active_prompt=latest)
+        project_cache.invalidate(self.project.pk)
+
+    def discard(self):
+        for path in self.copied:
+            default_storage.delete(path)
+
+
+def import_stream(stream, user, name=None, batch_size=BATCH_SIZE):
+    """Create a project for `user` from a JSONL (or gzip) export; returns (project, counts).
+
+    Raises TransferError for malformed input, after deleting what was imported.
+    """
+    records = _records(open_lines(stream))
+    first = next(records, None)
+    if first is None or first[1].get('type') != 'project':
+        raise TransferError("Line 1: the export must start with a project header")
+    header = first[1]
+    if header.get('version') != FORMAT_VERSION:
+        raise TransferError(f"Unsupported export version {header.get('version')!r}")
+    fields = {field: header[field] for field in PROJECT_FIELDS if header.get(field) is not None}
+    project = Project.objects.create(user=user, name=name or header.get('name') or 'Imported project',
+                                     description=header.get('description'), **fields)
+    importer = _Importer(project, batch_size)
+    try:
+        for line_number, record in records:
+            importer.add(line_number, record)
+        importer.finish()
+    except BaseException:
+        project.delete()
+        importer.discard()
+        raise
+    return project, importer.counts
@@ -0,0 +1,269 @@
+"""Process-wide pooled HTTP clients for every call to the LLM upstream.
+
+All code paths that talk to OpenRouter go through `apost` or `astream`
+(sync callers through `run_sync`), so they share keep-alive connections
+instead of paying a TCP+TLS handshake per attempt. Pool sizes, HTTP/2 and
+per-phase timeouts come from `settings.UPSTREAM_HTTP`; `pool_stats()`
+reports how often connections are reused and how much time is still spent
+on handshakes.
+"""
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import ssl
+import threading
+import time
+import weakref
+
+import certifi
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_CONNECTIONS': 500,
+    'MAX_KEEPALIVE_CONNECTIONS': 100,
+    'KEEPALIVE_EXPIRY': 60.0,
+    'HTTP2': False,
+    'CONNECT_TIMEOUT': 5.0,
+    'READ_TIMEOUT': 30.0,
+    'WRITE_TIMEOUT': 10.0,
+    'POOL_TIMEOUT': 5.0,
+    'TOTAL_TIMEOUT': 45.0,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def ssl_context():
+    # Loading the CA bundle costs tens of milliseconds of CPU; do it once per
+    # process instead of once per client.
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'UPSTREAM_HTTP', {})}
+
+
+class PoolStats:
+    """Thread-safe counters fed by httpcore trace events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.new_connections = 0
+            self.failed_connections = 0
+            self.handshake_seconds = 0.0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connection(self, handshake_seconds):
+        with self._lock:
+            self.new_connections += 1
+            self.handshake_seconds += handshake_seconds
+
+    def record_failed_connection(self):
+        with self._lock:
+            self.failed_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': reused,
+                'reuse_rate': reused / self.requests if self.requests else 0.0,
+                'failed_connections': self.failed_connections,
+                'handshake_seconds_total': round(self.handshake_seconds, 6),
+                'handshake_seconds_avg': (
+                    round(self.handshake_seconds / self.new_connections, 6) if self.new_connections else 0.0
+                ),
+            }
+
+
+stats = PoolStats()
+
+
+class _Trace:
+    """Per-request httpcore trace hook measuring connect + TLS time.
+
+    httpcore only emits connect_tcp/start_tls events when it has to open a
+    new connection, so a request without them rode on a pooled one.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.connected = False
+
+    def __call__(self, event, info):
+        if event.endswith('connect_tcp.started'):
+            self.started = time.perf_counter()
+        elif event.endswith('connect_tcp.failed'):
+            stats.record_failed_connection()
+        elif event.endswith('connect_tcp.complete'):
+            self.connected = True
+        elif event.endswith(('send_request_headers.started', 'start_tls.failed')) and self.connected:
+            # First event after the handshake (plain HTTP or TLS) finished
+            stats.record_connection(time.perf_counter() - self.started)
+            self.connected = False
+
+    async def atrace(self, event, info):
+        self(event, info)
+
+
+def _timeout(config, remaining=None):
+    def cap(value):
+        return value if remaining is None else max(min(value, remaining), 0.001)
+
+    return httpx.Timeout(
+        connect=cap(config['CONNECT_TIMEOUT']),
+        read=cap(config['READ_TIMEOUT']),
+        write=cap(config['WRITE_TIMEOUT']),
+        pool=cap(config['POOL_TIMEOUT']),
+    )
+
+
+def _client_kwargs():
+    config = get_config()
+    http2 = config['HTTP2']
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("UPSTREAM_HTTP['HTTP2'] is set but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+    return {
+        'http2': http2,
+        'verify': ssl_context(),
+        'timeout': _timeout(config),
+        'limits': httpx.Limits(
+            max_connections=config['MAX_CONNECTIONS'],
+            max_keepalive_connections=config['MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=config['KEEPALIVE_EXPIRY'],
+        ),
+    }
+
+
+_lock = threading.Lock()
+# httpx.AsyncClient is bound to the event loop it first ran on
+_async_clients = weakref.WeakKeyDictionary()
+_loop = None
+_loop_pid = None
+
+
+def get_async_client():
+    """Return the shared async client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(**_client_kwargs())
+    return client
+
+
+def _background_loop():
+    global _loop, _loop_pid
+    if _loop is None or _loop_pid != os.getpid():
+        with _lock:
+            if _loop is None or _loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True).start()
+                _loop, _loop_pid = loop, os.getpid()
+    return _loop
+
+
+def run_sync(coro):
+    """Run an upstream coroutine from sync code and wait for its result.
+
+    Coroutines run on one long-lived event loop per process, so sync callers
+    share its pooled AsyncClient and get real task cancellation (e.g. for
+    hedged attempts) instead of abandoned blocking threads.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
+
+
+def reset_clients():
+    """Drop pooled clients so the next call picks up new settings."""
+    # Clients are left to be garbage collected with their loops; closing
+    # them here would have to happen on their own loop.
+    _async_clients.clear()
+
+
+def pool_stats():
+    config = get_config()
+    return {
+        **stats.snapshot(),
+        'max_connections': config['MAX_CONNECTIONS'],
+        'max_keepalive_connections': config['MAX_KEEPALIVE_CONNECTIONS'],
+        'http2': config['HTTP2'],
+    }
+
+
+def _deadline(total=None):
+    total = get_config()['TOTAL_TIMEOUT'] if total is None else total
+    return time.monotonic() + total
+
+
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise httpx.TimeoutException('Total upstream timeout exceeded')
+    return remaining
+
+
+async def apost(url, headers=None, json=None, total_timeout=None):
+    """POST through the shared async client, bounded by the total timeout."""
+    deadline = _deadline(total_timeout)
+    trace = _Trace()
+    stats.record_request()
+    remaining = _remaining(deadline)
+    try:
+        async with asyncio.timeout(remaining):
+            return await get_async_client().post(
+                url, headers=headers, json=json,
+                timeout=_timeout(get_config(), remaining),
+                extensions={'trace': trace.atrace},
+            )
+    except TimeoutError:
+        raise httpx.TimeoutException('Total upstream timeout exceeded')
+
+
+@contextlib.asynccontextmanager
+async def astream(url, headers=None, json=None, total_timeout=None, start_timeout=None):
+    """Open a streaming POST; iterate it with `aiter_lines(response)`.
+
+    `start_timeout` additionally caps the wait for the response to start,
+    so a caller's deadline can bound time-to-first-byte without cutting off
+    a long generation that is already streaming. Cancelling the task reading it closes the response, which drops the
+    connection so the upstream stops generating.
+    """
+    deadline = _deadline(total_timeout)
+    remaining = _remaining(deadline)
+    if start_timeout is not None:
+        remaining = min(remaining, start_timeout)
+    trace = _Trace()
+    stats.record_request()
+    async with get_async_client().stream(
+        'POST', url, headers=headers, json=json,
+        timeout=_timeout(get_config(), remaining),
+        extensions={'trace': trace.atrace},
+    ) as response:
+        response.deadline = deadline
+        yield response
+
+
+async def aiter_lines(response):
+    """Iterate a streamed response line by line, enforcing its total deadline."""
+    deadline = getattr(response, 'deadline', None)
+    async for line in response.aiter_lines():
+        if deadline is not None:
+            _remaining(deadline)
+        yield line
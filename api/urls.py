@@ -9,6 +9,18 @@ urlpatterns = [
     path('dashboard/', views.dashboard_view, name='dashboard'),
     path('project/<int:project_id>/', views.project_detail_view, name='project_detail'),
     path('project/<int:project_id>/chat/', views.chat_api_view, name='chat_api'),
+    path('project/<int:project_id>/chat/stream/', views.chat_stream_api_view, name='chat_stream_api'),
+    path('project/<int:project_id>/chat/async/', views.achat_api_view, name='chat_api_async'),
+    path('project/<int:project_id>/chat/jobs/', views.chat_job_create_view, name='chat_job_create'),
+    path('chat/jobs/<int:job_id>/', views.chat_job_view, name='chat_job'),
+    path('chat/batch/', views.chat_batch_api_view, name='chat_batch'),
+    path('project/<int:project_id>/history/', views.chat_history_api_view, name='chat_history'),
+    path('project/<int:project_id>/export/', views.project_export_view, name='project_export'),
     path('project/<int:project_id>/chat_page/', views.chat_view, name='chat'),
+    path('search/', views.message_search_api_view, name='message_search'),
+    path('ops/upstream/', views.upstream_stats_view, name='upstream_stats'),
+    path('ops/models/', views.model_health_view, name='model_health'),
+    # No trailing slash: the path Prometheus scrapes by default
+    path('metrics', views.metrics_view, name='metrics'),
     path('', views.home_view, name='home'),
 ]
@@ -1,16 +1,28 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
+from django.db.models import Count
 from django.contrib import messages
 from django.contrib.messages.views import SuccessMessageMixin
 from .forms import RegistrationForm, ProjectForm, PromptForm, ProjectFileForm
-from .models import Project, Prompt, ChatMessage, ProjectFile
+from .models import Project, Prompt, ChatMessage, ChatJob, ProjectFile, UserStats
+from .llm import AI_MODELS, astream_ai_response, sandbox_mode
+from .fallback import Completion, FallbackPolicy
+from .history import PAGE_SIZE, history_page
+from . import admission, batch, chat, jobs, metrics, response_cache, search, transfer, upstream
+from .routing import router
+from .admission import admission_control
 from django.contrib.auth.views import LoginView
-import requests
-from django.conf import settings
+from django.urls import reverse
+from asgiref.sync import sync_to_async
+import asyncio
+import hmac
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -47,9 +59,15 @@ def register_view(request):
 
 @login_required
 def dashboard_view(request):
-    projects = request.user.projects.all()
-    total_projects = projects.count()
-    total_messages = ChatMessage.objects.filter(project__user=request.user).count()
+    # One query for the per-project summary; totals come from the counters
+    projects = list(
+        request.user.projects.select_related('active_prompt')
+        .annotate(file_count=Count('files'))
+        .order_by('-last_activity_at', '-created_at')
+    )
+    total_projects = len(projects)
+    stats = UserStats.objects.filter(user=request.user).first()
+    total_messages = stats.message_count if stats else 0
     if request.method == 'POST':
         form = ProjectForm(request.POST)
         if form.is_valid():
@@ -68,8 +86,8 @@ def dashboard_view(request):
 
 @login_required
 def project_detail_view(request, project_id):
-    project = get_object_or_404(Project, id=project_id, user=request.user)
-    prompts = project.prompts.all()
+    project = get_object_or_404(chat.projects(), id=project_id, user=request.user)
+    prompts = project.prompts.order_by('-created_at')
     files = project.files.all()
     prompt_form = PromptForm()
     file_form = ProjectFileForm()
@@ -88,123 +106,34 @@ def project_detail_view(request, project_id):
                 p_file.project = project
                 if not p_file.name:
                     p_file.name = request.FILES['file'].name
+                p_file.size_bytes = request.FILES['file'].size
+                # Queued: a worker chunks and indexes it (api/ingest.py)
                 p_file.save()
                 return redirect('project_detail', project_id=project.id)
-    mock_mode = not settings.OPENROUTER_API_KEY or "yourkeyhere" in settings.OPENROUTER_API_KEY
+    mock_mode = sandbox_mode()
+    history, history_cursor = history_page(project)
     return render(request, 'project_detail.html', {
         'project': project,
+        'history': history,
+        'history_cursor': history_cursor,
         'prompts': prompts,
         'files': files,
         'prompt_form': prompt_form,
         'file_form': file_form,
         'mock_mode': mock_mode,
+        'cache_stats': response_cache.stats(project.id) if project.response_cache_enabled else None,
     })
 
-def get_ai_response(message, system_prompt=None, history=None):
-    # DEBUG LOGGING FOR RENDER
-    api_key = settings.OPENROUTER_API_KEY
-    if api_key:
-        api_key = api_key.strip()
-    
-    is_valid_format = api_key and api_key.startswith("sk-or-v1-")
-    
-    print(f"DEBUG: Checking API Key...")
-    if not api_key:
-        print("DEBUG: API Key is None or Empty")
-    else:
-        masked_key = f"{api_key[:10]}...{api_key[-5:]}" if len(api_key) > 15 else "SHORT_KEY"
-        print(f"DEBUG: API Key Present (Stripped). Length: {len(api_key)}. Preview: {masked_key}")
-    
-    # Graceful fallback for missing or placeholder keys
-    if not api_key or "yourkeyhere" in api_key:
-        return f"Sandbox Mode: I received your message '{message}'. Since no valid API key is set, I'm simulating a response."
-
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    if history:
-        for msg in history:
-            if hasattr(msg, 'role'):
-                messages.append({"role": msg.role, "content": msg.content})
-            else:
-                messages.append({"role": msg['role'], "content": msg['content']})
-    messages.append({"role": "user", "content": message})
-    # List of models to try in order of preference (Free/Cheaper -> capabilities)
-    models = [
-        "meta-llama/llama-3-8b-instruct",
-        "meta-llama/llama-3-70b-instruct",
-        "mistralai/mistral-7b-instruct",
-        "openai/gpt-3.5-turbo"
-    ]
-
-    response = None
-    last_error = None
-
-    for model in models:
-        try:
-            print(f"DEBUG: Attempting with model: {model}")
-            data = {"model": model, "messages": messages}
-            response = requests.post(url, headers=headers, json=data, timeout=30)
-            
-            # If successful, break the loop
-            if response.status_code == 200:
-                print(f"DEBUG: Success with model: {model}")
-                break
-            else:
-                print(f"DEBUG: Failed with model {model}: {response.status_code} - {response.text}")
-                last_error = response
-        except Exception as e:
-            print(f"DEBUG: Exception with model {model}: {str(e)}")
-            last_error = e
-            continue
-
-    # If we exhausted all models and still don't have a 200 response
-    if not response or response.status_code != 200:
-        if isinstance(last_error, requests.Response):
-             # Re-raise the last failure so the existing error handling below catches it
-             response = last_error
-        else:
-             # It was a connection error or similar
-             return f"Error: All models failed. Last error: {str(last_error)}"
-        
-        # DEBUG RESPONSE
-        if response.status_code != 200:
-            print(f"DEBUG: API Request Failed. Status: {response.status_code}")
-            print(f"DEBUG: Response Body: {response.text}")
-
-        # Handle 401 Unauthorized (User not found / Invalid Key) gracefully
-        if response.status_code == 401:
-            try:
-                err_body = response.json()
-                msg = err_body.get('error', {}).get('message', 'Unknown Auth Error')
-            except:
-                msg = response.text
-            return f"Sandbox Mode (Auth Failed): {msg}"
-
-        response_json = response.json()
-        if "choices" not in response_json:
-            error_msg = response_json.get('error', {}).get('message', 'Unknown error')
-            if "User not found" in error_msg:
-                 return f"Sandbox Mode (User not found): {error_msg}"
-            return f"AI Error: {error_msg}"
-        return response_json["choices"][0]["message"]["content"]
-    except requests.Timeout:
-        return "AI Error: Request timed out. Try again."
-    except Exception as e:
-        print(f"DEBUG: Exception during request: {e}")
-        return f"AI Error: {str(e)}"
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 @login_required
+@admission_control
 def chat_api_view(request, project_id):
     if request.method != 'POST':
         return JsonResponse({'error': 'Invalid request method. Please use POST.'}, status=405)
     try:
-        project = get_object_or_404(Project, id=project_id, user=request.user)
+        project = chat.get_project(project_id, request.user)
         try:
             data = json.loads(request.body)
         except json.JSONDecodeError:
@@ -212,41 +141,262 @@ def chat_api_view(request, project_id):
         user_message = data.get('message')
         if not user_message:
             return JsonResponse({'error': 'Message content cannot be empty.'}, status=400)
-        system_prompt = project.prompts.order_by('-created_at').first()
-        prompt_content = system_prompt.content if system_prompt else "You are a helpful assistant."
-        history_msgs = project.messages.order_by('-timestamp')[:10]
-        chat_history = []
-        for msg in reversed(history_msgs):
-            chat_history.append({'role': msg.role, 'content': msg.content})
-        ai_response = get_ai_response(user_message, system_prompt=prompt_content, history=chat_history)
-        ChatMessage.objects.create(project=project, role='user', content=user_message)
-        ChatMessage.objects.create(project=project, role='assistant', content=ai_response)
-        return JsonResponse({'response': ai_response})
+        prompt_content, chat_history = chat.load_context(project, user_message)
+        completion = chat.turn(project, user_message, prompt_content, chat_history,
+                               request.headers.get('Idempotency-Key'))
+        return JsonResponse({'response': completion.content})
     except Exception as e:
         logger.exception("Chat API Error")
         return JsonResponse({'error': 'A server-side error occurred.', 'details': str(e)}, status=500)
 
 @login_required
+@admission_control
+async def achat_api_view(request, project_id):
+    """Async twin of chat_api_view for ASGI deployments.
+
+    The upstream call and the ORM queries are awaited, so the worker's event
+    loop keeps serving other chats while this one waits on the model.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method. Please use POST.'}, status=405)
+    try:
+        user = await request.auser()
+        project = await chat.aget_project(project_id, user)
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'The server received invalid data format. Expected JSON.'}, status=400)
+        user_message = data.get('message')
+        if not user_message:
+            return JsonResponse({'error': 'Message content cannot be empty.'}, status=400)
+        prompt_content, chat_history = await chat.aload_context(project, user_message)
+        completion = await chat.aturn(project, user_message, prompt_content, chat_history,
+                                      request.headers.get('Idempotency-Key'))
+        return JsonResponse({'response': completion.content})
+    except Http404:
+        raise
+    except Exception as e:
+        logger.exception("Async Chat API Error")
+        return JsonResponse({'error': 'A server-side error occurred.', 'details': str(e)}, status=500)
+
+@login_required
+@admission_control
+async def chat_stream_api_view(request, project_id):
+    """Stream a reply as Server-Sent Events.
+
+    Async so that under ASGI each token is sent as it arrives: Django can
+    only relay a sync generator by reading it to the end first.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method. Please use POST.'}, status=405)
+    project = await chat.aget_project(project_id, await request.auser())
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'The server received invalid data format. Expected JSON.'}, status=400)
+    user_message = data.get('message')
+    if not user_message:
+        return JsonResponse({'error': 'Message content cannot be empty.'}, status=400)
+    prompt_content, chat_history = await chat.aload_context(project, user_message)
+    # A duplicate of a turn in flight or just answered replays its reply and saves nothing
+    reused, flight = await chat.ajoin_flight(project, user_message, chat_history,
+                                             request.headers.get('Idempotency-Key'))
+    cache_key, cached = (None, None) if reused else await sync_to_async(chat.cache_lookup)(
+        project, user_message, prompt_content, chat_history)
+
+    async def event_stream():
+        chunks = []
+        failed = False
+        finished = False
+        started = time.monotonic()
+        try:
+            if reused or cached:
+                chunks.append((reused or cached).content)
+                yield _sse_event('token', {'token': chunks[-1]})
+            else:
+                async for token in astream_ai_response(user_message, system_prompt=prompt_content,
+                                                       history=chat_history,
+                                                       policy=FallbackPolicy.for_project(project)):
+                    chunks.append(token)
+                    yield _sse_event('token', {'token': token})
+            finished = True
+            yield _sse_event('done', {'response': ''.join(chunks)})
+        except Exception as e:
+            logger.exception("Chat Stream Error")
+            failed = True
+            if not chunks:
+                chunks.append(f"AI Error: {str(e)}")
+            yield _sse_event('error', {'error': 'A server-side error occurred.', 'details': str(e)})
+        finally:
+            if not reused:
+                # Runs on completion, on error and when the client disconnects
+                # mid-stream, so whatever was generated is kept in history.
+                completion = None
+                if chunks:
+                    content = ''.join(chunks)
+                    completion = Completion(content, cached.model if cached else None,
+                                            int((time.monotonic() - started) * 1000))
+                    if not cached and not failed:
+                        await sync_to_async(chat.cache_store)(project, cache_key, content, None)
+                try:
+                    await asyncio.shield(chat.asave_turn(project, user_message, completion))
+                finally:
+                    # A reply cut short by a disconnect is saved but not replayed
+                    await sync_to_async(chat.land_flight)(flight, project, user_message, completion,
+                                                          ok=finished and not failed)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies (nginx, Render) from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+@admission_control
+def chat_job_create_view(request, project_id):
+    """Queue a turn for a background worker (see api/jobs.py) and answer 202 with its id."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method. Please use POST.'}, status=405)
+    project = chat.get_project(project_id, request.user)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'The server received invalid data format. Expected JSON.'}, status=400)
+    user_message = data.get('message')
+    if not user_message:
+        return JsonResponse({'error': 'Message content cannot be empty.'}, status=400)
+    job = jobs.enqueue(project, user_message)
+    response = JsonResponse({**jobs.as_dict(job), 'status_url': reverse('chat_job', args=[job.pk])}, status=202)
+    response['Location'] = reverse('chat_job', args=[job.pk])
+    return response
+
+@login_required
+async def chat_job_view(request, job_id):
+    """A queued turn's status and, once done, its answer; `?wait=<seconds>` long-polls until it finishes."""
+    try:
+        wait = max(0.0, float(request.GET.get('wait', 0)))
+    except ValueError:
+        return JsonResponse({'error': "'wait' must be a number of seconds."}, status=400)
+    try:
+        job = await jobs.await_job(job_id, await request.auser(), wait)
+    except ChatJob.DoesNotExist:
+        raise Http404("No job matches the given query.")
+    return JsonResponse(jobs.as_dict(job))
+
+@login_required
+async def chat_batch_api_view(request):
+    """Answer many {project_id, message} items at once (see api/batch.py).
+
+    Results come back in input order, or with `"stream": true` as NDJSON
+    lines in the order they complete. Async, like chat_stream_api_view, so
+    that under ASGI each line is sent as soon as its item is answered.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method. Please use POST.'}, status=405)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'The server received invalid data format. Expected JSON.'}, status=400)
+    try:
+        items, mode, concurrency, stream = batch.parse(data)
+    except batch.BatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    user = await request.auser()
+    await sync_to_async(batch.prepare)(items, user)
+    try:
+        await sync_to_async(batch.admit)(user, items)
+    except admission.Rejected as e:
+        return e.response()
+    if stream:
+        lines = (json.dumps(result) + '\n' async for result in batch.arun(items, mode, concurrency))
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    results = [result async for result in batch.arun(items, mode, concurrency)]
+    return JsonResponse({'results': sorted(results, key=lambda result: result['index'])})
+
+@login_required
+@admission_control
 def chat_view(request, project_id):
-    project = get_object_or_404(Project, id=project_id, user=request.user)
-    prompts = project.prompts.all()
-    system_prompt = None
-    if prompts.exists():
-        system_prompt = prompts.order_by('-created_at').first().content
+    project = get_object_or_404(chat.projects(), id=project_id, user=request.user)
+    prompts = project.prompts.order_by('-created_at')
     if request.method == "POST":
         user_message = request.POST.get("message")
-        history_msgs = project.messages.order_by('-timestamp')[:10]
-        chat_history = list(reversed(history_msgs))
-        bot_response = get_ai_response(user_message, system_prompt, history=chat_history)
-        ChatMessage.objects.create(project=project, role='user', content=user_message)
-        ChatMessage.objects.create(project=project, role='assistant', content=bot_response)
-    history = project.messages.all()
+        prompt_content, chat_history = chat.load_context(project, user_message)
+        completion = chat.complete(project, user_message, prompt_content, chat_history)
+        chat.save_turn(project, user_message, completion)
+    history, history_cursor = history_page(project)
     return render(request, "chat.html", {
         "project": project,
         "prompts": prompts,
         "history": history,
+        "history_cursor": history_cursor,
+    })
+
+@login_required
+def chat_history_api_view(request, project_id):
+    """Older chat messages for infinite scroll, one keyset page per call."""
+    project = get_object_or_404(Project, id=project_id, user=request.user)
+    try:
+        limit = int(request.GET.get('limit', PAGE_SIZE))
+        history, next_cursor = history_page(project, before=request.GET.get('before'), limit=limit)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor or limit.'}, status=400)
+    return JsonResponse({
+        'messages': [
+            {'id': msg.id, 'role': msg.role, 'content': msg.content, 'timestamp': msg.timestamp.isoformat()}
+            for msg in history
+        ],
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+def message_search_api_view(request):
+    """Ranked full-text search over the user's messages, `?q=...&project=<id>` (see api/search.py)."""
+    try:
+        limit = int(request.GET.get('limit', search.PAGE_SIZE))
+        offset = int(request.GET.get('offset', 0))
+        project_id = int(request.GET['project']) if request.GET.get('project') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit, offset or project.'}, status=400)
+    results, next_offset = search.search(request.user, request.GET.get('q', ''), project_id, limit, offset)
+    return JsonResponse({'results': results, 'next_offset': next_offset})
+
+@login_required
+def project_export_view(request, project_id):
+    """Download the project's conversation as JSONL, or gzipped with ?format=gzip (see api/transfer.py)."""
+    project = get_object_or_404(Project, id=project_id, user=request.user)
+    compress = request.GET.get('format') == 'gzip'
+    response = StreamingHttpResponse(transfer.aexport_chunks(project, compress),
+                                     content_type='application/gzip' if compress else 'application/x-ndjson')
+    filename = f"project-{project.id}.jsonl{'.gz' if compress else ''}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@staff_member_required
+def upstream_stats_view(request):
+    return JsonResponse(upstream.pool_stats())
+
+@staff_member_required
+def model_health_view(request):
+    states = router.snapshot(AI_MODELS)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'models': states, 'pool': upstream.pool_stats()})
+    return render(request, 'model_health.html', {
+        'models': states,
+        'routing_order': router.candidates(AI_MODELS, claim_probes=False),
+        'pool': upstream.pool_stats(),
     })
 
+def metrics_view(request):
+    """Prometheus scrape target: staff sessions or `Authorization: Bearer <METRICS['TOKEN']>`."""
+    token = metrics.get_config()['TOKEN']
+    header = request.headers.get('Authorization', '')
+    authorized = bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+    if not (authorized or request.user.is_staff):
+        return JsonResponse({'error': 'Forbidden.'}, status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def logout_view(request):
     logout(request)
     return redirect('login')
@@ -0,0 +1,286 @@
+"""WebSocket chat transport, served next to Django by chatbot_platform/asgi.py.
+
+A browser opens `/ws/project/<id>/chat/` once per page. The session cookie
+is checked and the project resolved when the socket connects, instead of
+once per turn, and the project's chat configuration stays in connection
+state (refreshed every `PROJECT_REFRESH` seconds so prompt edits still
+arrive). Frames are JSON text:
+
+    client: {"type": "message", "message": "..."}
+            {"type": "cancel"}        stop the turn being generated
+            {"type": "ping"}
+    server: {"type": "ready", "project_id": 1}
+            {"type": "token", "token": "..."}   one or more tokens
+            {"type": "done", "response": "..."}
+            {"type": "cancelled", "response": "..."}   what was generated
+            {"type": "error", "error": "...", "retry_after": 5}
+            {"type": "pong"}
+
+One turn runs at a time per socket, under the same admission control as
+the HTTP endpoints. Tokens go through a queue of at most `MAX_PENDING`
+entries: while the client reads slowly, queued tokens are sent together
+in one frame, and once the queue is full the upstream is no longer read,
+so TCP backpressure reaches the model instead of memory growing. Cancel
+(or a disconnect) cancels the turn's task, which closes the upstream
+response. Whatever was generated is saved, as with the SSE endpoint.
+
+Connections are refused with close code 4403 for a foreign Origin, 4401
+without a logged-in session and 4404 for an unknown project.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.db import close_old_connections
+from django.http import Http404, parse_cookie
+from django.http.request import validate_host
+
+from . import admission, chat
+from .fallback import Completion, FallbackPolicy
+from .llm import astream_ai_response
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_PENDING': 256,
+    'MAX_MESSAGE_BYTES': 64 * 1024,
+    'PROJECT_REFRESH': 5.0,
+}
+
+PATH_RE = re.compile(r'^/ws/project/(?P<project_id>\d+)/chat/$')
+
+FORBIDDEN = 4403
+UNAUTHORIZED = 4401
+NOT_FOUND = 4404
+
+_END = object()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_WEBSOCKET', {})}
+
+
+def origin_allowed(headers):
+    """Browsers always send Origin; without a CSRF token it is what stops cross-site sockets."""
+    origin = headers.get('origin')
+    if origin is None:
+        return True
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    host = urlsplit(origin).netloc
+    return bool(host) and host == headers.get('host') and validate_host(host.rsplit(':', 1)[0], allowed_hosts)
+
+
+async def authenticate(headers):
+    """The user of the session in the request's cookies (AnonymousUser if none)."""
+    cookies = parse_cookie(headers.get('cookie', ''))
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore(cookies.get(settings.SESSION_COOKIE_NAME))
+    return await aget_user(SimpleNamespace(session=session))
+
+
+class ChatSocket:
+    """State of one connection: the user, their project and the turn in progress."""
+
+    def __init__(self, send, user, project):
+        self.send = send
+        self.user = user
+        self.project = project
+        self.resolved_at = time.monotonic()
+        self.config = get_config()
+        self.turn = None
+        # Turn frames and pongs come from different tasks
+        self.sending = asyncio.Lock()
+
+    async def send_json(self, data):
+        async with self.sending:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(data)})
+
+    async def refresh_project(self):
+        if time.monotonic() - self.resolved_at >= self.config['PROJECT_REFRESH']:
+            self.project = await chat.aget_project(self.project.id, self.user)
+            self.resolved_at = time.monotonic()
+
+    async def receive_frame(self, text):
+        try:
+            frame = json.loads(text or '')
+        except json.JSONDecodeError:
+            frame = None
+        kind = frame.get('type') if isinstance(frame, dict) else None
+        if kind == 'ping':
+            await self.send_json({'type': 'pong'})
+        elif kind == 'cancel':
+            if self.turn is not None:
+                self.turn.cancel()
+        elif kind == 'message':
+            message = frame.get('message')
+            if not isinstance(message, str) or not message.strip():
+                await self.send_json({'type': 'error', 'error': 'Message content cannot be empty.'})
+            elif self.turn is not None:
+                await self.send_json({'type': 'error', 'error': 'A reply is still being generated.'})
+            else:
+                self.turn = asyncio.create_task(self.run_turn(message))
+                self.turn.add_done_callback(self._turn_done)
+        else:
+            await self.send_json({'type': 'error', 'error': 'Unknown frame.'})
+
+    def _turn_done(self, task):
+        if self.turn is task:
+            self.turn = None
+
+    async def run_turn(self, message):
+        try:
+            await self.refresh_project()
+            slot = await admission.aadmit(self.user, self.project.id)
+        except Http404:
+            await self.send_json({'type': 'error', 'error': 'Project not found.'})
+            return
+        except admission.Rejected as e:
+            await self.send_json({'type': 'error', 'error': 'Too many requests, please retry shortly.',
+                                  'retry_after': e.retry_after})
+            return
+        try:
+            await self.stream_turn(message, slot)
+        finally:
+            await sync_to_async(admission.release)(slot)
+            await sync_to_async(close_old_connections)()
+
+    async def stream_turn(self, message, slot):
+        project = self.project
+        prompt_content, history = await chat.aload_context(project, message)
+        cache_key, cached = await sync_to_async(chat.cache_lookup)(project, message, prompt_content, history)
+        pending = asyncio.Queue(self.config['MAX_PENDING'])
+        chunks = []
+        outcome = None
+        started = time.monotonic()
+
+        async def produce():
+            try:
+                if cached:
+                    await pending.put(cached.content)
+                else:
+                    async for token in astream_ai_response(message, system_prompt=prompt_content, history=history,
+                                                           policy=FallbackPolicy.for_project(project)):
+                        await pending.put(token)
+            except Exception as e:
+                # Handed to the sender, which raises it after the tokens before it
+                await pending.put(e)
+                return
+            await pending.put(_END)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                # A client reading slowly gets everything queued meanwhile in one frame
+                items = [await pending.get()]
+                while not pending.empty():
+                    items.append(pending.get_nowait())
+                tokens = [item for item in items if isinstance(item, str)]
+                if tokens:
+                    chunks.extend(tokens)
+                    await self.send_json({'type': 'token', 'token': ''.join(tokens)})
+                    await admission.arenew(slot)
+                if isinstance(items[-1], Exception):
+                    raise items[-1]
+                if items[-1] is _END:
+                    break
+            outcome = {'type': 'done', 'response': ''.join(chunks)}
+        except asyncio.CancelledError:
+            outcome = {'type': 'cancelled', 'response': ''.join(chunks)}
+            raise
+        except Exception as e:
+            logger.exception("Chat WebSocket Error")
+            if not chunks:
+                chunks.append(f"AI Error: {str(e)}")
+            outcome = {'type': 'error', 'error': 'A server-side error occurred.', 'details': str(e)}
+        finally:
+            # Closes the upstream response if it is still streaming
+            producer.cancel()
+            completion = None
+            if chunks:
+                content = ''.join(chunks)
+                completion = Completion(content, cached.model if cached else None,
+                                        int((time.monotonic() - started) * 1000))
+                if not cached and outcome and outcome['type'] == 'done':
+                    await sync_to_async(chat.cache_store)(project, cache_key, content, None)
+            await asyncio.shield(chat.asave_turn(project, message, completion))
+            # Saved: the client may send its next message once it has this frame
+            self.turn = None
+            if outcome:
+                await asyncio.shield(self._send_quietly(outcome))
+
+    async def _send_quietly(self, data):
+        # The client may already be gone
+        try:
+            await self.send_json(data)
+        except Exception:
+            pass
+
+
+async def application(scope, receive, send):
+    """ASGI application for `websocket` scopes."""
+    # As Django's ASGIHandler does per request: the connection's ORM calls
+    # get a thread of their own instead of queueing behind every other
+    # socket's on the single shared sync thread
+    async with ThreadSensitiveContext():
+        await handle(scope, receive, send)
+
+
+async def handle(scope, receive, send):
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    match = PATH_RE.match(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': NOT_FOUND})
+        return
+    if not origin_allowed(headers):
+        await send({'type': 'websocket.close', 'code': FORBIDDEN})
+        return
+    user = await authenticate(headers)
+    if not user.is_authenticated:
+        await send({'type': 'websocket.close', 'code': UNAUTHORIZED})
+        return
+    try:
+        project = await chat.aget_project(int(match['project_id']), user)
+    except Http404:
+        await send({'type': 'websocket.close', 'code': NOT_FOUND})
+        return
+    finally:
+        await sync_to_async(close_old_connections)()
+
+    await send({'type': 'websocket.accept'})
+    socket = ChatSocket(send, user, project)
+    await socket.send_json({'type': 'ready', 'project_id': project.id})
+    config = socket.config
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+            text = event.get('text')
+            if text is None or len(text.encode()) > config['MAX_MESSAGE_BYTES']:
+                await socket.send_json({'type': 'error', 'error': 'Frames must be JSON text under '
+                                                                  f"{config['MAX_MESSAGE_BYTES']} bytes."})
+                continue
+            await socket.receive_frame(text)
+    finally:
+        if socket.turn is not None:
+            # Stop generating for a client that is gone; the partial reply is still saved
+            socket.turn.cancel()
+            try:
+                await socket.turn
+            except (asyncio.CancelledError, Exception):
+                pass
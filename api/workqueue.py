@@ -0,0 +1,59 @@
+"""The worker loop of the database-backed queues (api/ingest.py, api/jobs.py).
+
+A queue provides `claim(config)`, which takes the next job with a
+conditional UPDATE or returns None, and `run_job(job, config)`. This
+module runs them: in the calling thread until the queue is empty, in a
+background thread of a web process, or forever with a pool of threads.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+
+def run_pending(claim, run_job, config, limit=None):
+    """Run claimed jobs in this thread until none is left; returns how many ran."""
+    done = 0
+    while limit is None or done < limit:
+        job = claim(config)
+        if job is None:
+            break
+        run_job(job, config)
+        done += 1
+    return done
+
+
+def run_in_thread(fn, *args):
+    # Pool threads each hold their own connection; don't leak it
+    try:
+        return fn(*args)
+    finally:
+        close_old_connections()
+
+
+def run_worker(claim, run_job, config, thread_name_prefix, workers, poll_interval, stop_event=None, tick=None):
+    """Poll for jobs with a pool of `workers` threads until `stop_event` is set.
+
+    `tick`, if given, is called on every turn of the loop, e.g. for
+    housekeeping that must not wait for the queue to be empty.
+    """
+    stop_event = stop_event or threading.Event()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix) as pool:
+        running = set()
+        while not stop_event.is_set():
+            if tick is not None:
+                tick()
+            running = {future for future in running if not future.done()}
+            claimed = None
+            if len(running) < workers:
+                claimed = claim(config)
+                close_old_connections()
+            if claimed is None:
+                stop_event.wait(poll_interval)
+                continue
+            running.add(pool.submit(run_in_thread, run_job, claimed, config))
+
+
+def kick(drain, name):
+    """Run `drain` in a daemon thread of this process, e.g. a queue's `run_pending`."""
+    threading.Thread(target=run_in_thread, args=(drain,), name=name, daemon=True).start()
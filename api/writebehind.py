@@ -0,0 +1,143 @@
+"""Optional write-behind buffer for chat turn persistence.
+
+With `CHAT_WRITE_BEHIND['ENABLED']` a finished turn's ChatMessage rows are
+handed to an in-memory queue instead of being inserted before the
+response is sent. A background thread drains the queue and writes up to
+`BATCH_SIZE` rows per `bulk_create`, waiting at most `MAX_DELAY` seconds
+after the first queued row before flushing.
+
+The queue is bounded by `MAX_QUEUE` turns. When it is full the caller
+writes its own rows synchronously, so a slow database applies
+backpressure instead of growing memory without limit. Whatever is still
+queued is flushed when the process exits.
+
+Rows carry their own timestamps, taken when the turn finished, so history
+order does not depend on when the batch reaches the database. Queued
+turns are lost if the process is killed hard; leave this off where that
+matters.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_QUEUE': 10000,
+    'MAX_DELAY': 0.5,
+    'BATCH_SIZE': 500,
+}
+
+_STOP = object()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+def write_rows(rows):
+    from . import context, counters
+    from .models import ChatMessage
+
+    # One transaction, so the batch and its counter updates commit together
+    with transaction.atomic():
+        ChatMessage.objects.bulk_create(rows)
+        counters.record_messages(rows)
+    # Re-read once committed, so the next turn finds its window in the cache
+    context.refresh_windows({row.project_id for row in rows})
+
+
+class WriteBehindBuffer:
+    def __init__(self, writer=write_rows, max_queue=DEFAULTS['MAX_QUEUE'], max_delay=DEFAULTS['MAX_DELAY'],
+                 batch_size=DEFAULTS['BATCH_SIZE']):
+        self.writer = writer
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queue a turn's rows; write them inline if the queue is full."""
+        try:
+            self.queue.put_nowait(rows)
+        except queue.Full:
+            logger.warning("Write-behind queue full, writing turn synchronously")
+            self.writer(rows)
+
+    async def asubmit(self, rows):
+        """Async twin of submit; an inline write runs off the event loop."""
+        try:
+            self.queue.put_nowait(rows)
+        except queue.Full:
+            logger.warning("Write-behind queue full, writing turn synchronously")
+            await sync_to_async(self.writer)(rows)
+
+    def _flush(self, rows):
+        if not rows:
+            return
+        try:
+            self.writer(rows)
+        except Exception:
+            logger.exception("Write-behind flush of %d rows failed", len(rows))
+        finally:
+            close_old_connections()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            rows = list(item)
+            flush_at = time.monotonic() + self.max_delay
+            stopping = False
+            while len(rows) < self.batch_size:
+                timeout = flush_at - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                rows.extend(item)
+            self._flush(rows)
+            if stopping:
+                return
+
+    def close(self, timeout=10):
+        """Flush everything queued so far and stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("Write-behind buffer did not drain within %s seconds", timeout)
+
+
+_lock = threading.Lock()
+_buffer = None
+
+
+def get_buffer():
+    """Return the process-wide buffer, or None when write-behind is off."""
+    global _buffer
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    if _buffer is None:
+        with _lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(max_queue=config['MAX_QUEUE'], max_delay=config['MAX_DELAY'],
+                                            batch_size=config['BATCH_SIZE'])
+                atexit.register(_buffer.close)
+    return _buffer
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Concurrency load test: blocking vs async upstream calls.
+
+Fires N chat completions at a local fake upstream with a fixed latency and
+compares:
+
+* sync  - get_ai_response on a pool of W threads, the equivalent of W
+          gunicorn sync workers each holding one upstream call at a time;
+* async - aget_ai_response gathered on a single event loop, the equivalent
+          of one ASGI worker.
+
+Usage:
+    python benchmarks/async_chat_load.py --requests 400 --sync-workers 4 --delay 1.0
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_upstream import FakeUpstream  # noqa: E402
+
+
+def run_sync(get_ai_response, total, workers):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        replies = list(pool.map(lambda i: get_ai_response(f'load {i}'), range(total)))
+    return time.perf_counter() - start, replies
+
+
+def run_async(aget_ai_response, total):
+    async def main():
+        return await asyncio.gather(*(aget_ai_response(f'load {i}') for i in range(total)))
+
+    start = time.perf_counter()
+    replies = asyncio.run(main())
+    return time.perf_counter() - start, replies
+
+
+def report(label, elapsed, replies, upstream):
+    expected = ''.join(upstream.reply_words(upstream.behaviour))
+    ok = sum(1 for r in replies if r == expected)
+    print(f'{label:<6} {len(replies):>6} req  {elapsed:8.2f}s  {len(replies) / elapsed:8.1f} req/s  '
+          f'ok={ok}  peak upstream concurrency={upstream.peak_in_flight}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Blocking vs async upstream concurrency.')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=1.0, help='fake upstream latency in seconds')
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(delay=args.delay)
+    upstream.start_in_thread()
+
+    os.environ['OPENROUTER_API_KEY'] = 'sk-or-v1-loadtest'
+    os.environ['OPENROUTER_API_URL'] = upstream.url
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+    import django
+    django.setup()
+    from api.llm import get_ai_response, aget_ai_response
+    from api.upstream import pool_stats
+
+    # get_ai_response prints debug lines for every call
+    with contextlib.redirect_stdout(io.StringIO()):
+        sync_elapsed, sync_replies = run_sync(get_ai_response, args.requests, args.sync_workers)
+    sync_peak, upstream.peak_in_flight = upstream.peak_in_flight, 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        async_elapsed, async_replies = run_async(aget_ai_response, args.requests)
+
+    print(f'upstream latency {args.delay:.2f}s, {args.sync_workers} sync workers vs 1 event loop')
+    upstream_async_peak = upstream.peak_in_flight
+    upstream.peak_in_flight = sync_peak
+    report('sync', sync_elapsed, sync_replies, upstream)
+    upstream.peak_in_flight = upstream_async_peak
+    report('async', async_elapsed, async_replies, upstream)
+    print(f'speed-up: {sync_elapsed / async_elapsed:.1f}x')
+    stats = pool_stats()
+    print(f"connection pool: {stats['requests']} requests over {stats['new_connections']} connections "
+          f"(reuse rate {stats['reuse_rate']:.0%}, {stats['handshake_seconds_avg'] * 1000:.2f} ms per handshake)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Query plans and timings of the per-turn context read, before/after indexing.
+
+Builds a throwaway SQLite database migrated to 0004, fills it with a
+synthetic chat table (1M messages by default), then times the queries a
+chat turn runs to load its context:
+
+* before - latest prompt via ORDER BY created_at on the project's prompts,
+           last N messages via ORDER BY timestamp on the project_id index
+           (SQLite has to collect and sort every message of the project);
+* after  - migrated to the latest schema: the active prompt is joined
+           into the project lookup and the history is a range scan of
+           (project, -timestamp, -id).
+
+It finally compares fetching a page of chat history near the start and deep
+into a conversation, keyset cursor vs. OFFSET.
+
+Usage:
+    python benchmarks/chat_query_plans.py --messages 1000000 --projects 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def fill(connection, messages, projects, prompts_per_project):
+    from django.db import transaction
+
+    start = datetime(2025, 1, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("INSERT INTO auth_user (password, last_login, is_superuser, username, first_name, last_name, "
+                       "email, is_staff, is_active, date_joined) VALUES ('', %s, 0, 'bench', '', '', '', 0, 1, %s)",
+                       [start, start])
+        user_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO api_project (user_id, name, description, created_at, hedge_delay_ms, "
+            "max_parallel_attempts, request_deadline_ms, response_cache_enabled, response_cache_ttl) "
+            "VALUES (%s, %s, '', %s, 4000, 2, 30000, 0, 3600)",
+            [(user_id, f'project {i}', start) for i in range(projects)],
+        )
+        cursor.execute("SELECT id FROM api_project")
+        project_ids = [row[0] for row in cursor.fetchall()]
+        cursor.executemany(
+            "INSERT INTO api_prompt (project_id, content, created_at) VALUES (%s, %s, %s)",
+            [(pid, f'prompt {n}', start + timedelta(days=n)) for pid in project_ids for n in range(prompts_per_project)],
+        )
+        # Interleaved as they would arrive from many concurrent chats
+        rng = random.Random(0)
+        batch = []
+        for n in range(messages):
+            batch.append((rng.choice(project_ids), 'user' if n % 2 == 0 else 'assistant',
+                          f'message {n}', start + timedelta(seconds=n)))
+            if len(batch) == 50000:
+                cursor.executemany("INSERT INTO api_chatmessage (project_id, role, content, timestamp, model) "
+                                   "VALUES (%s, %s, %s, %s, '')", batch)
+                batch = []
+        if batch:
+            cursor.executemany("INSERT INTO api_chatmessage (project_id, role, content, timestamp, model) "
+                               "VALUES (%s, %s, %s, %s, '')", batch)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return project_ids
+
+
+def explain(connection, queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def timed(label, fn, project_ids, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        fn(project_ids[i % len(project_ids)])
+    per_turn = (time.perf_counter() - start) / rounds * 1000
+    print(f'{label:<7} {per_turn:8.3f} ms per turn ({rounds} turns)')
+    return per_turn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-turn context query plans before/after indexing.')
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--prompts', type=int, default=20, help='prompts per project')
+    parser.add_argument('--rounds', type=int, default=500)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import connection
+    from api import chat, context
+    from api.models import ChatMessage, Prompt
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    connection.settings_dict['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    call_command('migrate', 'api', '0004_response_cache', verbosity=0)
+
+    started = time.perf_counter()
+    project_ids = fill(connection, args.messages, args.projects, args.prompts)
+    print(f'{args.messages} messages over {args.projects} projects loaded in {time.perf_counter() - started:.1f}s '
+          f'({connection.settings_dict["NAME"]})')
+
+    def before(pid):
+        Prompt.objects.filter(project_id=pid).order_by('-created_at').first()
+        list(ChatMessage.objects.filter(project_id=pid).order_by('-timestamp')[:10])
+
+    def after(pid):
+        # The reads behind a cold context cache (see api/context.py)
+        chat.projects().get(pk=pid)
+        context.read_window(pid)
+
+    pid = project_ids[0]
+    print('\nbefore (0004)')
+    for line in explain(connection, Prompt.objects.filter(project_id=pid).order_by('-created_at')[:1]):
+        print('  prompt  ', line)
+    for line in explain(connection, ChatMessage.objects.filter(project_id=pid).order_by('-timestamp')[:10]):
+        print('  history ', line)
+    before_ms = timed('before', before, project_ids, args.rounds)
+
+    started = time.perf_counter()
+    call_command('migrate', 'api', verbosity=0)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    print(f'\nafter (latest, migrated in {time.perf_counter() - started:.1f}s)')
+    for line in explain(connection, chat.projects().filter(pk=pid)):
+        print('  project ', line)
+    for line in explain(connection, ChatMessage.objects.filter(project_id=pid).order_by('-timestamp', '-id')[:10]):
+        print('  history ', line)
+    after_ms = timed('after', after, project_ids, args.rounds)
+
+    print(f'\nspeed-up: {before_ms / after_ms:.1f}x')
+
+    from api.history import PAGE_SIZE, encode_cursor, history_page
+    project = chat.projects().get(pk=pid)
+    total = project.messages.count()
+    print(f'\nhistory pages of {PAGE_SIZE} for a project with {total} messages')
+    anchor = project.messages.order_by('-timestamp', '-id')[total // 2]
+    timestamp, message_id = anchor.timestamp, anchor.id
+    keyset = (project.messages.order_by('-timestamp', '-id').filter(timestamp__lte=timestamp)
+              .exclude(timestamp=timestamp, id__gte=message_id)[:PAGE_SIZE + 1])
+    for line in explain(connection, keyset):
+        print('  keyset  ', line)
+    for label, depth in (('newest', 0), ('middle', total // 2), ('oldest', total - PAGE_SIZE)):
+        anchor = project.messages.order_by('-timestamp', '-id')[depth] if depth else None
+        cursor = encode_cursor(anchor) if anchor else None
+        rounds = 200
+        started = time.perf_counter()
+        for _ in range(rounds):
+            history_page(project, before=cursor)
+        keyset_ms = (time.perf_counter() - started) / rounds * 1000
+        started = time.perf_counter()
+        for _ in range(rounds):
+            list(project.messages.order_by('-timestamp', '-id')[depth:depth + PAGE_SIZE])
+        offset_ms = (time.perf_counter() - started) / rounds * 1000
+        print(f'  {label:<7} keyset {keyset_ms:7.3f} ms   offset {offset_ms:7.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
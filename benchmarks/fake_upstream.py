@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""OpenRouter-compatible fake upstream for local load tests.
+
+Serves POST /api/v1/chat/completions, plain JSON or streamed as SSE when
+the request has "stream": true, so the app can be load-tested end to end
+without spending credits: point OPENROUTER_API_URL at it and set any
+non-placeholder OPENROUTER_API_KEY. Standard library only, so it runs
+anywhere the app does.
+
+Every reply is shaped by a behaviour:
+
+* latency         - time to first token, drawn from a distribution:
+                    fixed:S, uniform:LO,HI, normal:MEAN,SD,
+                    lognormal:MEDIAN,SIGMA or exponential:MEAN (seconds);
+* tokens_per_second - pace of the reply after the first token (0: at once);
+* reply_tokens    - words per reply;
+* error_rate      - share of requests answered 500 after the latency;
+* rate_limit_rate - share of requests answered 429 straight away, with a
+                    Retry-After of `retry_after` seconds.
+
+The defaults apply to every model; `models` overrides them per model, e.g.
+'{"meta-llama/llama-3-8b-instruct": {"error_rate": 0.3}}'.
+
+    python benchmarks/fake_upstream.py --port 8099 --latency lognormal:0.8,0.4 \\
+        --tokens-per-second 40 --rate-limit-rate 0.05 --models models.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+from collections import Counter
+
+PATH = '/api/v1/chat/completions'
+
+LATENCY_PARAMS = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2, 'exponential': 1}
+
+DEFAULT_BEHAVIOUR = {
+    'latency': 'fixed:1.0',
+    'tokens_per_second': 0,
+    'reply_tokens': 20,
+    'error_rate': 0.0,
+    'rate_limit_rate': 0.0,
+    'retry_after': 1,
+}
+
+
+def parse_latency(spec):
+    """Turn 'kind:a,b' into a function of a random.Random returning seconds."""
+    if isinstance(spec, (int, float)):
+        spec = f'fixed:{spec}'
+    kind, _, params = spec.partition(':')
+    if kind not in LATENCY_PARAMS:
+        raise ValueError(f"Unknown latency distribution {kind!r}, expected one of {', '.join(LATENCY_PARAMS)}")
+    values = [float(v) for v in params.split(',') if v.strip()]
+    if len(values) != LATENCY_PARAMS[kind]:
+        raise ValueError(f"Latency {kind!r} takes {LATENCY_PARAMS[kind]} parameter(s), got {spec!r}")
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(*values)
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(*values))
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+
+
+def load_models(value):
+    """Per-model overrides from a JSON string or the path of a JSON file."""
+    if not value:
+        return {}
+    if not value.lstrip().startswith('{'):
+        with open(value) as f:
+            value = f.read()
+    return json.loads(value)
+
+
+class Behaviour:
+    def __init__(self, **options):
+        unknown = set(options) - set(DEFAULT_BEHAVIOUR)
+        if unknown:
+            raise ValueError(f"Unknown behaviour option(s): {', '.join(sorted(unknown))}")
+        options = {**DEFAULT_BEHAVIOUR, **options}
+        self.latency = parse_latency(options['latency'])
+        self.tokens_per_second = float(options['tokens_per_second'])
+        self.reply_tokens = max(1, int(options['reply_tokens']))
+        self.error_rate = float(options['error_rate'])
+        self.rate_limit_rate = float(options['rate_limit_rate'])
+        self.retry_after = options['retry_after']
+        self.options = options
+
+    def override(self, **options):
+        return Behaviour(**{**self.options, **options})
+
+    def token_gap(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+
+class FakeUpstream:
+    def __init__(self, host='127.0.0.1', port=0, delay=None, behaviour=None, models=None, seed=None):
+        self.host = host
+        self.port = port
+        self.behaviour = behaviour or Behaviour()
+        if delay is not None:
+            self.behaviour = self.behaviour.override(latency=f'fixed:{delay}')
+        self.models = {name: self.behaviour.override(**options) for name, options in (models or {}).items()}
+        self.rng = random.Random(seed)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.statuses = Counter()
+        self._server = None
+
+    def behaviour_for(self, model):
+        return self.models.get(model, self.behaviour)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'statuses': dict(self.statuses),
+            'peak_in_flight': self.peak_in_flight,
+        }
+
+    def reply_words(self, behaviour):
+        return [f'token{n} ' for n in range(behaviour.reply_tokens)]
+
+    async def write_json(self, writer, status, reason, payload, extra_headers=b''):
+        data = json.dumps(payload).encode()
+        writer.write(
+            f'HTTP/1.1 {status} {reason}\r\n'.encode() + b'Content-Type: application/json\r\n' + extra_headers +
+            b'Content-Length: ' + str(len(data)).encode() + b'\r\n\r\n' + data
+        )
+        await writer.drain()
+
+    async def write_chunk(self, writer, data):
+        writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        await writer.drain()
+
+    async def reply(self, writer, path, payload):
+        if path != PATH:
+            self.statuses[404] += 1
+            await self.write_json(writer, 404, 'Not Found', {'error': {'message': 'Not found', 'code': 404}})
+            return
+
+        model = payload.get('model')
+        behaviour = self.behaviour_for(model)
+        if self.rng.random() < behaviour.rate_limit_rate:
+            self.statuses[429] += 1
+            await self.write_json(
+                writer, 429, 'Too Many Requests',
+                {'error': {'message': f'Rate limit exceeded for {model}', 'code': 429}},
+                f'Retry-After: {behaviour.retry_after}\r\n'.encode(),
+            )
+            return
+
+        await asyncio.sleep(behaviour.latency(self.rng))
+        if self.rng.random() < behaviour.error_rate:
+            self.statuses[500] += 1
+            await self.write_json(writer, 500, 'Internal Server Error',
+                                  {'error': {'message': f'Injected failure for {model}', 'code': 500}})
+            return
+
+        self.statuses[200] += 1
+        reply_id = f'fake-{self.requests}'
+        words = self.reply_words(behaviour)
+        gap = behaviour.token_gap()
+        if not payload.get('stream'):
+            await asyncio.sleep(gap * len(words))
+            await self.write_json(writer, 200, 'OK', {
+                'id': reply_id,
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)}}],
+            })
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        for n, word in enumerate(words):
+            if n and gap:
+                await asyncio.sleep(gap)
+            chunk = {'id': reply_id, 'model': model, 'choices': [{'index': 0, 'delta': {'content': word}}]}
+            await self.write_chunk(writer, f'data: {json.dumps(chunk)}\n\n'.encode())
+        await self.write_chunk(writer, b'data: [DONE]\n\n')
+        await self.write_chunk(writer, b'')
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                payload = json.loads(body or b'{}')
+                _, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                self.requests += 1
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                try:
+                    await self.reply(writer, path, payload)
+                finally:
+                    self.in_flight -= 1
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, started=None):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if started:
+            started.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}{PATH}'
+
+    def start_in_thread(self):
+        """Run the server on a daemon thread and return once it is listening."""
+        started = threading.Event()
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve(started)), daemon=True)
+        thread.start()
+        started.wait()
+        return thread
+
+
+def add_behaviour_arguments(parser):
+    """Behaviour options shared with the load-test suite."""
+    parser.add_argument('--latency', default=DEFAULT_BEHAVIOUR['latency'],
+                        help="time to first token, e.g. fixed:1.0, uniform:0.2,2, lognormal:0.8,0.4")
+    parser.add_argument('--tokens-per-second', type=float, default=DEFAULT_BEHAVIOUR['tokens_per_second'],
+                        help='reply pace after the first token (0: whole reply at once)')
+    parser.add_argument('--reply-tokens', type=int, default=DEFAULT_BEHAVIOUR['reply_tokens'])
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of requests answered 429')
+    parser.add_argument('--retry-after', type=int, default=DEFAULT_BEHAVIOUR['retry_after'])
+    parser.add_argument('--models', help='per-model overrides: JSON object or path to a JSON file')
+    parser.add_argument('--seed', type=int, help='seed the random draws for repeatable runs')
+
+
+def upstream_from_args(args, host='127.0.0.1', port=0):
+    behaviour = Behaviour(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+    )
+    return FakeUpstream(host, port, behaviour=behaviour, models=load_models(args.models), seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_UPSTREAM_PORT', '8099')))
+    parser.add_argument('--delay', type=float, help='shorthand for --latency fixed:DELAY')
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+    if args.delay is not None:
+        args.latency = f'fixed:{args.delay}'
+    upstream = upstream_from_args(args, args.host, args.port)
+    print(f'Fake upstream listening on {upstream.url}')
+    asyncio.run(upstream.serve())
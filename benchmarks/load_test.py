@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""End-to-end load test of the chat, dashboard and project pages.
+
+Logs in a set of virtual users and keeps `--concurrency` requests in flight
+over real HTTP, picking each one from a weighted mix of scenarios:
+
+* chat        - POST /project/<id>/chat/ (chat_api_view);
+* chat_async  - POST /project/<id>/chat/async/;
+* chat_stream - POST /project/<id>/chat/stream/, read to the end; the time
+                to the first token is reported as chat_stream_ttft;
+* dashboard   - GET /dashboard/;
+* project     - GET /project/<id>/.
+
+and reports throughput and p50/p95/p99 latency per scenario.
+
+By default everything runs in this process: the fake upstream
+(benchmarks/fake_upstream.py, which takes the same behaviour options) and
+the ASGI application under uvicorn, on a throwaway SQLite database seeded
+with `--users` users, one project each and `--history` messages of history.
+With --base-url it drives an already running deployment instead, as the
+given user and project; point that server's OPENROUTER_API_URL at a
+separately started fake upstream.
+
+Usage:
+    python benchmarks/load_test.py --concurrency 50 --duration 30 --latency lognormal:0.8,0.4
+    python benchmarks/load_test.py --mix chat_stream=1 --tokens-per-second 50 --reply-tokens 100
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8000 --username alice --password ... --project 3
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_upstream import add_behaviour_arguments, upstream_from_args  # noqa: E402
+
+SCENARIOS = ('chat', 'chat_async', 'chat_stream', 'dashboard', 'project')
+PASSWORD = 'load-test-password'
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}, expected one of {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(0, min(len(samples), math.ceil(p / 100 * len(samples))) - 1)
+    return samples[rank]
+
+
+class VirtualUser:
+    """One logged-in session; shared by the workers assigned to that user."""
+
+    def __init__(self, base_url, username, password, project_id, limits):
+        self.client = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=httpx.Timeout(120))
+        self.username = username
+        self.password = password
+        self.project_id = project_id
+
+    async def login(self):
+        await self.client.get('/login/')
+        response = await self.client.post('/login/', data={
+            'username': self.username,
+            'password': self.password,
+            'csrfmiddlewaretoken': self.client.cookies.get('csrftoken'),
+        })
+        if response.status_code != 302:
+            raise RuntimeError(f'Login as {self.username} failed with status {response.status_code}')
+
+    def chat_headers(self):
+        # Django rotates the CSRF token on login, so read it on every call
+        return {'X-CSRFToken': self.client.cookies.get('csrftoken', ''), 'Content-Type': 'application/json'}
+
+    async def chat(self, path, message):
+        response = await self.client.post(path, content=json.dumps({'message': message}),
+                                          headers=self.chat_headers())
+        return response.status_code == 200 and 'response' in response.json()
+
+    async def chat_stream(self, message, record):
+        started = time.perf_counter()
+        ok = False
+        async with self.client.stream('POST', f'/project/{self.project_id}/chat/stream/',
+                                      content=json.dumps({'message': message}),
+                                      headers=self.chat_headers()) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return False
+            first = True
+            async for line in response.aiter_lines():
+                if first and line == 'event: token':
+                    record('chat_stream_ttft', time.perf_counter() - started, True)
+                    first = False
+                elif line == 'event: done':
+                    ok = True
+                elif line == 'event: error':
+                    ok = False
+        return ok
+
+    async def run(self, scenario, message, record):
+        if scenario == 'chat':
+            return await self.chat(f'/project/{self.project_id}/chat/', message)
+        if scenario == 'chat_async':
+            return await self.chat(f'/project/{self.project_id}/chat/async/', message)
+        if scenario == 'chat_stream':
+            return await self.chat_stream(message, record)
+        path = '/dashboard/' if scenario == 'dashboard' else f'/project/{self.project_id}/'
+        response = await self.client.get(path)
+        return response.status_code == 200
+
+
+async def drive(users, args):
+    """Run the workers until the duration or request count is reached."""
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    names, weights = zip(*args.mix.items())
+    rng = random.Random(args.seed)
+    issued = 0
+    deadline = None
+
+    def record(scenario, seconds, ok):
+        samples[scenario].append(seconds)
+        if not ok:
+            errors[scenario] += 1
+
+    def claim():
+        nonlocal issued
+        if args.requests:
+            if issued >= args.requests:
+                return False
+        elif time.perf_counter() >= deadline:
+            return False
+        issued += 1
+        return True
+
+    async def worker(n, user):
+        turn = 0
+        while claim():
+            scenario = rng.choices(names, weights)[0]
+            turn += 1
+            started = time.perf_counter()
+            try:
+                ok = await user.run(scenario, f'load test message {n}.{turn}', record)
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            record(scenario, time.perf_counter() - started, ok)
+
+    await asyncio.gather(*(user.login() for user in users))
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(worker(n, users[n % len(users)]) for n in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*(user.client.aclose() for user in users))
+    return elapsed, samples, errors
+
+
+def report(elapsed, samples, errors):
+    total = sum(len(s) for name, s in samples.items() if name != 'chat_stream_ttft')
+    failed = sum(n for name, n in errors.items() if name != 'chat_stream_ttft')
+    print(f'{total} requests in {elapsed:.2f}s: {total / elapsed:.1f} req/s, {failed} errors')
+    print(f"{'scenario':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in list(SCENARIOS) + ['chat_stream_ttft']:
+        if not samples.get(name):
+            continue
+        ordered = sorted(samples[name])
+        print(f'{name:<18}{len(ordered):>9}{errors[name]:>8}{len(ordered) / elapsed:>9.1f}'
+              f'{percentile(ordered, 50) * 1000:>10.1f}{percentile(ordered, 95) * 1000:>10.1f}'
+              f'{percentile(ordered, 99) * 1000:>10.1f}')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, workdir, upstream_url):
+    """Migrate and seed a throwaway database, then serve the ASGI app on a thread."""
+    os.environ['OPENROUTER_API_KEY'] = 'sk-or-v1-loadtest'
+    os.environ['OPENROUTER_API_URL'] = upstream_url
+    # One process, so the in-memory cache is as shared as the file cache would be
+    os.environ.setdefault('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+    # Per-user rate limits would cap the run; keep them only when asked to
+    os.environ.setdefault('CHAT_ADMISSION', str(args.admission))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import connection
+
+    connection.settings_dict['NAME'] = os.path.join(workdir, 'load.sqlite3')
+    call_command('migrate', verbosity=0)
+    # Keep server errors of the run out of the project's production_errors.log
+    django_logger = logging.getLogger('django')
+    django_logger.handlers = [logging.FileHandler(os.path.join(workdir, 'errors.log'))]
+
+    from django.contrib.auth.models import User
+    from api import chat
+    from api.fallback import Completion
+    from api.models import Project, Prompt
+
+    seeded = []
+    for n in range(args.users):
+        user = User.objects.create_user(username=f'load{n}', password=PASSWORD)
+        project = Project.objects.create(user=user, name=f'Load test {n}')
+        Prompt.objects.create(project=project, content='You are a load-test assistant.')
+        project = chat.get_project(project.id, user)
+        for turn in range(args.history // 2):
+            chat.save_turn(project, f'seeded question {turn}', Completion(f'seeded answer {turn}', None, 1))
+        seeded.append((user.username, PASSWORD, project.id))
+    connection.close()
+
+    import uvicorn
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config('chatbot_platform.asgi:application', host='127.0.0.1', port=port,
+                                           log_level='warning', lifespan='off'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f'http://127.0.0.1:{port}', seeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test against a fake upstream.')
+    parser.add_argument('--concurrency', type=int, default=20, help='requests kept in flight')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='stop after this many requests instead of --duration')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=6,dashboard=2,project=2'),
+                        help=f"weighted scenarios, e.g. chat=6,dashboard=2 (from {', '.join(SCENARIOS)})")
+    parser.add_argument('--users', type=int, default=10, help='seeded users, one project each')
+    parser.add_argument('--history', type=int, default=20, help='seeded messages per project')
+    parser.add_argument('--admission', action='store_true', help='keep chat admission control (rate limits) on')
+    parser.add_argument('--base-url', help='drive a running deployment instead of an in-process one')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--project', type=int, help='project id of --username to chat with')
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    upstream = None
+    if args.base_url:
+        if not (args.username and args.password and args.project):
+            parser.error('--base-url needs --username, --password and --project')
+        base_url, accounts = args.base_url, [(args.username, args.password, args.project)]
+        print(f'Driving {base_url} as {args.username}, project {args.project}')
+    else:
+        upstream = upstream_from_args(args)
+        upstream.start_in_thread()
+        workdir = tempfile.mkdtemp(prefix='load-test-')
+        # llm.py prints debug lines for every upstream call
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            base_url, accounts = start_app(args, workdir, upstream.url)
+        print(f'App on {base_url} ({workdir}), fake upstream on {upstream.url} with latency {args.latency}, '
+              f'{args.tokens_per_second:g} tokens/s, {args.error_rate:.0%} errors, '
+              f'{args.rate_limit_rate:.0%} rate limited')
+
+    users = [VirtualUser(base_url, *account, limits) for account in accounts]
+    print(f"{args.concurrency} concurrent requests over {len(users)} users, mix "
+          f"{', '.join(f'{name}={weight:g}' for name, weight in args.mix.items())}")
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        elapsed, samples, errors = asyncio.run(drive(users, args))
+    report(elapsed, samples, errors)
+    if upstream:
+        stats = upstream.stats()
+        print(f"upstream: {stats['requests']} requests, statuses {stats['statuses']}, "
+              f"peak concurrency {stats['peak_in_flight']}")
+
+
+if __name__ == '__main__':
+    main()
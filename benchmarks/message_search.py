@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Message search: LIKE scan vs the FTS5 index (api/search.py).
+
+Builds a throwaway SQLite database at the latest schema and fills it with
+synthetic chat messages (1M by default) drawn from a Zipf-like vocabulary,
+so some words are in most messages and others in a handful. The FTS index
+is filled by its triggers during the load. For a set of queries it then
+times:
+
+* like - what the admin ran before: `content LIKE '%word%'` over the whole
+         table, first page of 20 and the total count (`matches`, which
+         includes words that merely contain the query);
+* fts  - search.search (page of 20 with snippets, scoped to the user, the
+         newest search.MAX_CANDIDATES matches ranked with bm25) and the
+         admin's count through the index.
+
+Usage:
+    python benchmarks/message_search.py --messages 1000000 --projects 100
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VOCABULARY = 20000
+
+
+def word(n):
+    # Pronounceable and unique per rank
+    consonants, vowels = 'bcdfghjklmnprstvz', 'aeiou'
+    out = ''
+    n += 1
+    while n:
+        n, c = divmod(n, len(consonants))
+        n, v = divmod(n, len(vowels))
+        out += consonants[c] + vowels[v]
+    return out
+
+
+def fill(connection, messages, projects, words_per_message):
+    from django.db import transaction
+
+    rng = random.Random(0)
+    vocabulary = [word(n) for n in range(VOCABULARY)]
+    # Zipf-like: weight 1/rank
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+    start = datetime(2025, 1, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("INSERT INTO auth_user (password, last_login, is_superuser, username, first_name, last_name, "
+                       "email, is_staff, is_active, date_joined) VALUES ('', %s, 0, 'bench', '', '', '', 0, 1, %s)",
+                       [start, start])
+        user_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO api_project (user_id, name, description, created_at, hedge_delay_ms, "
+            "max_parallel_attempts, request_deadline_ms, response_cache_enabled, response_cache_ttl, "
+            "context_token_budget, message_count, archived_message_count) "
+            "VALUES (%s, %s, '', %s, 4000, 2, 30000, 0, 3600, 3000, 0, 0)",
+            [(user_id, f'project {i}', start) for i in range(projects)],
+        )
+        cursor.execute("SELECT id FROM api_project")
+        project_ids = [row[0] for row in cursor.fetchall()]
+        batch = []
+        for n in range(messages):
+            length = rng.randint(words_per_message // 2, words_per_message * 2)
+            text = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length))
+            batch.append((rng.choice(project_ids), 'user' if n % 2 == 0 else 'assistant', text.capitalize() + '.',
+                          start + timedelta(seconds=n)))
+            if len(batch) == 20000:
+                cursor.executemany("INSERT INTO api_chatmessage (project_id, role, content, timestamp, model) "
+                                   "VALUES (%s, %s, %s, %s, '')", batch)
+                batch = []
+        if batch:
+            cursor.executemany("INSERT INTO api_chatmessage (project_id, role, content, timestamp, model) "
+                               "VALUES (%s, %s, %s, %s, '')", batch)
+    return user_id, vocabulary
+
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - start) / rounds * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Message search: LIKE scan vs FTS5 index.')
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--words', type=int, default=12, help='average words per message')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.db import connection
+    from api import search
+    from api.models import ChatMessage
+
+    workdir = tempfile.mkdtemp(prefix='search-bench-')
+    connection.settings_dict['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    call_command('migrate', verbosity=0)
+
+    started = time.perf_counter()
+    user_id, vocabulary = fill(connection, args.messages, args.projects, args.words)
+    print(f'{args.messages} messages indexed while loading in {time.perf_counter() - started:.1f}s '
+          f'({connection.settings_dict["NAME"]})')
+    user = User.objects.get(pk=user_id)
+
+    queries = {
+        'common word': vocabulary[2],
+        'mid word': vocabulary[500],
+        'rare word': vocabulary[15000],
+        'two words': f'{vocabulary[40]} {vocabulary[300]} ',
+        'prefix': vocabulary[1200][:4],
+    }
+    print(f"\n{'query':<14}{'matches':>9}{'like page':>12}{'fts page':>11}{'like count':>13}{'fts count':>12}  (ms)")
+    for label, text in queries.items():
+        words = text.split()
+        like = ChatMessage.objects.all()
+        for w in words:
+            like = like.filter(content__icontains=w)
+        fts = ChatMessage.objects.filter(id__in=search.matching_ids(search.match_query(text)))
+        like_page, _ = timed(lambda: list(like.order_by('-id')[:20]), args.rounds)
+        fts_page, _ = timed(lambda: search.search(user, text), args.rounds)
+        like_count, matches = timed(like.count, args.rounds)
+        fts_count, _ = timed(fts.count, args.rounds)
+        print(f'{label:<14}{matches:>9}{like_page:>12.1f}{fts_page:>11.1f}{like_count:>13.1f}{fts_count:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
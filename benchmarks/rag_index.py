@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Index build and query latency of the local retrieval engine (api/rag.py).
+
+Fills a throwaway SQLite database with N synthetic chunks for one project
+(Zipf-distributed words, so the hashed TF-IDF sees a realistic vocabulary),
+builds the memory-mapped index and then times:
+
+* search   - hashing the query + reading its postings + top-k, the part
+             that grows with the number of chunks;
+* retrieve - search plus loading the winning chunks from the database,
+             which is what a chat turn pays.
+
+and checks relevance:
+
+* recall   - share of queries made of 6 distinct words of one chunk that
+             find that chunk among the top-k;
+* noise    - share of queries sharing no word with the corpus (small
+             talk) that still retrieve something, and their best score.
+             Every such hit is an irrelevant excerpt in the prompt.
+
+Usage:
+    python benchmarks/rag_index.py --chunks 100000 --queries 500
+    python benchmarks/rag_index.py --chunks 20000 --dim 256   # compare bucket counts
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(samples, p):
+    return float(np.percentile(samples, p)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RAG index build and query latency.')
+    parser.add_argument('--chunks', type=int, default=100_000)
+    parser.add_argument('--words', type=int, default=120, help='words per chunk')
+    parser.add_argument('--vocabulary', type=int, default=50_000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dim', type=int, default=None, help="defaults to RAG['DIM']")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='rag-bench-')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection, transaction
+
+    settings.RAG = {**getattr(settings, 'RAG', {}), 'INDEX_ROOT': os.path.join(workdir, 'index')}
+    if args.dim:
+        settings.RAG['DIM'] = args.dim
+    connection.settings_dict['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    call_command('migrate', verbosity=0)
+
+    from django.contrib.auth.models import User
+    from api import rag
+    from api.models import DocumentChunk, Project, ProjectFile
+
+    rng = np.random.default_rng(0)
+    vocabulary = np.array([f'term{n}' for n in range(args.vocabulary)])
+    user = User.objects.create_user(username='bench')
+    project = Project.objects.create(user=user, name='bench')
+    # Created without a file on disk: chunks are inserted directly below
+    project_file = ProjectFile.objects.bulk_create([ProjectFile(project=project, name='corpus.txt', file='x',
+                                                                  status=ProjectFile.READY)])[0]
+
+    # Chunks whose own words are used as recall queries
+    probes = {int(n): None for n in rng.choice(args.chunks, min(args.queries, args.chunks), replace=False)}
+    started = time.perf_counter()
+    with transaction.atomic():
+        batch = []
+        for n in range(args.chunks):
+            words = vocabulary[np.minimum(rng.zipf(1.3, args.words), args.vocabulary) - 1]
+            if n in probes:
+                probes[n] = list(words)
+            batch.append(DocumentChunk(project=project, file=project_file, ordinal=n, content=' '.join(words)))
+            if len(batch) == 5000:
+                DocumentChunk.objects.bulk_create(batch)
+                batch = []
+        DocumentChunk.objects.bulk_create(batch)
+    print(f'{args.chunks} chunks of {args.words} words inserted in {time.perf_counter() - started:.1f}s')
+
+    started = time.perf_counter()
+    rows = rag.build_index(project.id)
+    build_seconds = time.perf_counter() - started
+    index = rag.load_index(project.id)
+    size = index.buckets.nbytes + index.indptr.nbytes + index.rows.nbytes + index.weights.nbytes
+    print(f'index build: {rows} rows in {build_seconds:.1f}s ({rows / build_seconds:,.0f} chunks/s, '
+          f'{len(index.buckets):,} buckets of {rag.get_config()["DIM"]:,} used, {len(index.rows):,} postings, '
+          f'{size / 2**20:.0f} MiB)')
+
+    queries = [' '.join(vocabulary[np.minimum(rng.zipf(1.3, 12), args.vocabulary) - 1])
+               for _ in range(args.queries)]
+    for label, fn in (('search', rag.search), ('retrieve', rag.retrieve)):
+        fn(project.id, queries[0])  # warm the page cache and the open index
+        samples = []
+        for query in queries:
+            started = time.perf_counter()
+            fn(project.id, query)
+            samples.append(time.perf_counter() - started)
+        print(f'{label:<9} p50 {percentile(samples, 50):6.2f} ms   p95 {percentile(samples, 95):6.2f} ms   '
+              f'p99 {percentile(samples, 99):6.2f} ms')
+
+    config = rag.get_config()
+    ids = dict(DocumentChunk.objects.filter(project=project, ordinal__in=list(probes)).values_list('ordinal', 'id'))
+    found = 0
+    for n, words in probes.items():
+        query = ' '.join(rng.choice(np.unique(words), 6, replace=False))
+        found += ids[n] in [chunk_id for chunk_id, _ in rag.search(project.id, query)]
+    print(f"recall    {found / len(probes):.1%} of {len(probes)} queries of 6 distinct words of one chunk "
+          f"find it in the top {config['TOP_K']}")
+
+    small_talk = ['hello can you help me today', 'thanks!', 'what is the weather like', 'ok great, bye',
+                  'please summarise our conversation so far']
+    settings.RAG['MIN_SCORE'] = 0
+    best = [max((score for _, score in rag.search(project.id, query)), default=0.0) for query in small_talk]
+    noisy = sum(score >= config['MIN_SCORE'] for score in best)
+    print(f"noise     {noisy} of {len(small_talk)} unrelated queries retrieve something "
+          f"(best score {max(best):.3f}, MIN_SCORE {config['MIN_SCORE']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Multi-process SQLite stress test: stock setup vs the tuned profile.
+
+Starts `--processes` worker processes with `--threads` threads each, all on
+one throwaway database file, for each DB_PROFILE (see settings.py and
+api/sqlite/base.py). Every thread loops until `--duration` is up, either
+saving a chat turn (chat.save_turn: the INSERT, the counters and the
+context window refresh) or reading a history page, with `--write-ratio`
+of operations being writes. After every operation it closes its connection
+as a request would, so CONN_MAX_AGE matters as it does when serving.
+
+Reports turns/s, reads/s, p50/p95/p99 latency and the number of
+"database is locked" errors per profile.
+
+Usage:
+    python benchmarks/sqlite_stress.py --processes 4 --threads 8 --duration 10
+    python benchmarks/sqlite_stress.py --profiles tuned --write-ratio 0.9
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ('plain', 'tuned')
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples), math.ceil(p / 100 * len(samples))) - 1)
+    return samples[rank]
+
+
+def setup_django(profile, path):
+    sys.path.insert(0, ROOT)
+    os.environ['DB_PROFILE'] = profile
+    os.environ['SQLITE_PATH'] = path
+    os.environ['CACHE_BACKEND'] = 'django.core.cache.backends.locmem.LocMemCache'
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'chatbot_platform.settings'
+    import django
+    django.setup()
+
+
+def seed(profile, path, projects, history):
+    """Migrate the database and create `projects` projects with `history` messages each."""
+    setup_django(profile, path)
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.db import connection
+    from api import chat
+    from api.fallback import Completion
+    from api.models import Project, Prompt
+
+    call_command('migrate', verbosity=0)
+    for n in range(projects):
+        user = User.objects.create_user(username=f'stress{n}')
+        project = Project.objects.create(user=user, name=f'Stress test {n}')
+        Prompt.objects.create(project=project, content='You are a stress-test assistant.')
+        chat.save_turns([(project, f'seeded question {turn}', Completion(f'seeded answer {turn}', None, 1))
+                         for turn in range(history // 2)])
+    connection.close()
+
+
+def worker(profile, path, threads, deadline, write_ratio, seed_value, results):
+    setup_django(profile, path)
+    from django.db import OperationalError, close_old_connections
+    from api import chat
+    from api.fallback import Completion
+    from api.history import history_page
+    from api.models import Project
+
+    projects = list(Project.objects.all())
+    close_old_connections()
+    stats = {'write': [], 'read': [], 'locked': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def loop(n):
+        rng = random.Random(f'{seed_value}.{n}')
+        turn = 0
+        while time.time() < deadline:
+            project = rng.choice(projects)
+            kind = 'write' if rng.random() < write_ratio else 'read'
+            started = time.perf_counter()
+            try:
+                if kind == 'write':
+                    turn += 1
+                    chat.save_turn(project, f'stress message {os.getpid()}.{n}.{turn}',
+                                   Completion(f'stress answer {turn}', None, 1))
+                else:
+                    history_page(project)
+            except OperationalError as e:
+                with stats_lock:
+                    stats['locked' if 'locked' in str(e) else 'failed'] += 1
+                continue
+            finally:
+                # The end of a request
+                close_old_connections()
+            elapsed = time.perf_counter() - started
+            with stats_lock:
+                stats[kind].append(elapsed)
+
+    pool = [threading.Thread(target=loop, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(stats)
+
+
+def run_profile(ctx, profile, args):
+    workdir = tempfile.mkdtemp(prefix='sqlite-stress-')
+    path = os.path.join(workdir, f'{profile}.sqlite3')
+    seeder = ctx.Process(target=seed, args=(profile, path, args.projects, args.history))
+    seeder.start()
+    seeder.join()
+    if seeder.exitcode:
+        raise SystemExit(f'Seeding the {profile} database failed')
+
+    results = ctx.Queue()
+    # Leave the processes time to import Django before the clock starts
+    deadline = time.time() + 2 + args.duration
+    processes = [ctx.Process(target=worker, args=(profile, path, args.threads, deadline, args.write_ratio,
+                                                  f'{args.seed}.{n}', results))
+                 for n in range(args.processes)]
+    for process in processes:
+        process.start()
+    totals = {'write': [], 'read': [], 'locked': 0, 'failed': 0}
+    for _ in processes:
+        stats = results.get()
+        for key, value in stats.items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    return path, totals
+
+
+def report(profile, path, totals, duration):
+    writes, reads = sorted(totals['write']), sorted(totals['read'])
+    print(f'{profile} ({path}): {totals["locked"]} "database is locked" errors, {totals["failed"]} other errors')
+    for name, samples in (('turns', writes), ('reads', reads)):
+        print(f'  {name:<6}{len(samples):>8}{len(samples) / duration:>10.1f}/s'
+              f'{percentile(samples, 50) * 1000:>10.1f}{percentile(samples, 95) * 1000:>10.1f}'
+              f'{percentile(samples, 99) * 1000:>10.1f}')
+    return len(writes) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent writers and readers on one SQLite file, per profile.')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='threads per process')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per profile')
+    parser.add_argument('--write-ratio', type=float, default=0.5, help='share of operations that save a turn')
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--history', type=int, default=200, help='seeded messages per project')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='comma-separated, from plain,tuned')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    profiles = [p.strip() for p in args.profiles.split(',')]
+    if not set(profiles) <= set(PROFILES):
+        parser.error(f"--profiles takes {', '.join(PROFILES)}")
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{args.processes} processes x {args.threads} threads for {args.duration:g}s, '
+          f'{args.write_ratio:.0%} writes, {args.projects} projects')
+    print(f"{'':<8}{'ops':>8}{'rate':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    throughput = {}
+    for profile in profiles:
+        path, totals = run_profile(ctx, profile, args)
+        throughput[profile] = report(profile, path, totals, args.duration)
+    if throughput.get('plain') and throughput.get('tuned'):
+        print(f"\ntuned/plain turns per second: {throughput['tuned'] / throughput['plain']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
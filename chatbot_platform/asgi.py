@@ -12,5 +12,19 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+# Requests and WebSockets run in short-lived threads that would each keep a
+# connection of their own, so persistent connections only pay off for WSGI
+# and the queue workers; connections close at the end of every request
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from api import websocket  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # WebSocket chat (see api/websocket.py) next to the regular Django views
+    if scope['type'] == 'websocket':
+        return await websocket.application(scope, receive, send)
+    return await django_application(scope, receive, send)
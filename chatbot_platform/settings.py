@@ -34,6 +34,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Middleware
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',  # first, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Static file support
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -68,13 +69,70 @@ WSGI_APPLICATION = 'chatbot_platform.wsgi.application'
 # DATABASE — SQLITE ONLY (no PostgreSQL)
 # ============================================================
 
+# DB_PROFILE=tuned (the default) is set up for several worker processes
+# writing chat turns at once (see api/sqlite/base.py): WAL, so readers never
+# wait for the writer; write transactions take the lock when they begin
+# and queue for it per process; persistent connections, which only WSGI
+# and the queue workers get (see asgi.py). DB_PROFILE=plain is Django's
+# stock SQLite setup.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',           # durable in WAL mode, fsyncs only at checkpoints
+    f"PRAGMA cache_size = -{os.getenv('SQLITE_CACHE_KB', '16384')}",          # KiB per connection
+    f"PRAGMA mmap_size = {os.getenv('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024))}",
+    'PRAGMA temp_store = MEMORY',
+]
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+if os.getenv('DB_PROFILE', 'tuned') == 'tuned':
+    DATABASES['default'].update({
+        'ENGINE': 'api.sqlite',
+        # asgi.py defaults it to 0: under ASGI every request and WebSocket
+        # runs in a thread of its own, which a kept connection would outlive
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),   # seconds to wait for the write lock
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': '; '.join(SQLITE_PRAGMAS),
+        },
+    })
+
+# ============================================================
+# CACHE
+# ============================================================
+
+# File-based by default so state kept in the cache is shared by every
+# gunicorn worker on the host. `default` holds replies, context windows and
+# project configuration, and is culled past CACHE_MAX_ENTRIES. The state
+# workers coordinate through (model routing, admission slots, coalescing
+# locks, metrics) is in `coordination` (see api/coordination.py), sized
+# never to be culled. It needs an atomic add and incr: use Redis,
+# Memcached or the locking file cache (`python manage.py check` warns
+# otherwise).
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'api.filecache.LockingFileBasedCache')
+
+
+def _cache(backend, location, max_entries):
+    # Redis and Memcached clients reject options they do not know
+    options = {'MAX_ENTRIES': max_entries} if backend.endswith(('FileBasedCache', 'LocMemCache')) else {}
+    return {'BACKEND': backend, 'LOCATION': location, 'OPTIONS': options}
+
+
+CACHES = {
+    'default': _cache(CACHE_BACKEND, os.getenv('CACHE_LOCATION', str(BASE_DIR / '.cache')),
+                      int(os.getenv('CACHE_MAX_ENTRIES', '10000'))),
+    'coordination': _cache(os.getenv('COORDINATION_CACHE_BACKEND', CACHE_BACKEND),
+                           os.getenv('COORDINATION_CACHE_LOCATION', str(BASE_DIR / '.cache' / 'coordination')),
+                           int(os.getenv('COORDINATION_CACHE_MAX_ENTRIES', '1000000'))),
+}
+
 # ============================================================
 # AUTH
 # ============================================================
@@ -112,6 +170,136 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 # API KEY
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+# Point at a local fake upstream for load tests
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# Shared keep-alive client used for every upstream LLM call (see api/upstream.py).
+# Timeouts are in seconds; TOTAL_TIMEOUT bounds a single attempt end to end.
+UPSTREAM_HTTP = {
+    'MAX_CONNECTIONS': int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '500')),
+    'MAX_KEEPALIVE_CONNECTIONS': int(os.getenv('UPSTREAM_MAX_KEEPALIVE_CONNECTIONS', '100')),
+    'KEEPALIVE_EXPIRY': float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', '60')),
+    'HTTP2': os.getenv('UPSTREAM_HTTP2', 'False') == 'True',  # needs the 'h2' package
+    'CONNECT_TIMEOUT': float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5')),
+    'READ_TIMEOUT': float(os.getenv('UPSTREAM_READ_TIMEOUT', '30')),
+    'WRITE_TIMEOUT': float(os.getenv('UPSTREAM_WRITE_TIMEOUT', '10')),
+    'POOL_TIMEOUT': float(os.getenv('UPSTREAM_POOL_TIMEOUT', '5')),
+    'TOTAL_TIMEOUT': float(os.getenv('UPSTREAM_TOTAL_TIMEOUT', '45')),
+}
+
+# Adaptive model routing and circuit breakers (see api/routing.py)
+MODEL_ROUTER = {
+    'EWMA_ALPHA': 0.3,
+    'FAILURE_THRESHOLD': 0.5,   # EWMA error rate that opens the breaker
+    'MIN_SAMPLES': 5,
+    'CONSECUTIVE_FAILURES': 3,  # or this many failures in a row
+    'OPEN_SECONDS': 30,         # cool-down before a half-open probe
+}
+
+# Per-project reply cache, enabled with Project.response_cache_enabled
+RESPONSE_CACHE = {
+    'MAX_ENTRIES_PER_PROJECT': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '500')),
+}
+
+# Per-project chat configuration cache (see api/project_cache.py).
+# LOCAL_TTL bounds how long another worker may serve a replaced prompt.
+PROJECT_CACHE = {
+    'TTL': int(os.getenv('PROJECT_CACHE_TTL', '3600')),                   # seconds, shared cache
+    'LOCAL_TTL': float(os.getenv('PROJECT_CACHE_LOCAL_TTL', '5')),        # seconds, in-process LRU
+    'LOCAL_MAX_ENTRIES': int(os.getenv('PROJECT_CACHE_LOCAL_MAX_ENTRIES', '1024')),
+}
+
+# Retrieval over uploaded files (see api/rag.py)
+RAG = {
+    'INDEX_ROOT': Path(os.getenv('RAG_INDEX_ROOT', BASE_DIR / 'rag_index')),
+    'DIM': int(os.getenv('RAG_DIM', str(2 ** 32))),  # hashed feature buckets; only those used are stored
+    'TOP_K': int(os.getenv('RAG_TOP_K', '3')),     # chunks injected per turn
+}
+
+# Background ingestion of uploaded files (see api/ingest.py). Run
+# `python manage.py run_ingest_worker`, or set INGEST_IN_PROCESS=True to
+# process uploads in a thread of the web process instead.
+INGEST = {
+    'WORKERS': int(os.getenv('INGEST_WORKERS', '2')),                  # files processed in parallel
+    'MAX_ATTEMPTS': int(os.getenv('INGEST_MAX_ATTEMPTS', '3')),
+    'RETRY_DELAY': int(os.getenv('INGEST_RETRY_DELAY', '30')),          # seconds
+    'POLL_INTERVAL': float(os.getenv('INGEST_POLL_INTERVAL', '2')),     # seconds
+    'IN_PROCESS': os.getenv('INGEST_IN_PROCESS', 'False') == 'True',
+}
+
+# Chat turns answered in the background for slow models (see api/jobs.py).
+# Run `python manage.py run_chat_worker`, or set CHAT_JOBS_IN_PROCESS=True
+# to answer them in a thread of the web process instead.
+CHAT_JOBS = {
+    'WORKERS': int(os.getenv('CHAT_JOBS_WORKERS', '8')),                # turns answered in parallel
+    'MAX_ATTEMPTS': int(os.getenv('CHAT_JOBS_MAX_ATTEMPTS', '2')),
+    'MAX_WAIT': float(os.getenv('CHAT_JOBS_MAX_WAIT', '25')),           # longest long-poll, seconds
+    'KEEP_HOURS': int(os.getenv('CHAT_JOBS_KEEP_HOURS', '24')),         # finished jobs kept this long
+    'IN_PROCESS': os.getenv('CHAT_JOBS_IN_PROCESS', 'False') == 'True',
+}
+
+# Cold storage of old chat messages (see api/archive.py). Run
+# `python manage.py compact_chat_history` periodically, e.g. nightly; the
+# horizon can be set per project in the admin.
+CHAT_ARCHIVE = {
+    'HORIZON_DAYS': int(os.getenv('CHAT_ARCHIVE_HORIZON_DAYS', '90')),             # messages older move out
+    'SEGMENT_MESSAGES': int(os.getenv('CHAT_ARCHIVE_SEGMENT_MESSAGES', '500')),    # per compressed row
+    'CODEC': os.getenv('CHAT_ARCHIVE_CODEC', 'zlib'),                              # or 'zstd' (zstandard package)
+}
+
+# Queue chat turns in memory and insert them in batches off the request path
+# (see api/writebehind.py). Queued turns are lost if a worker is killed hard.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'False') == 'True',
+    'MAX_QUEUE': int(os.getenv('CHAT_WRITE_BEHIND_MAX_QUEUE', '10000')),      # turns
+    'MAX_DELAY': float(os.getenv('CHAT_WRITE_BEHIND_MAX_DELAY', '0.5')),     # seconds
+    'BATCH_SIZE': int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', '500')),     # rows per INSERT
+}
+
+# Admission control for chat turns (see api/admission.py). Rates of 0 turn a
+# bucket off; per-user overrides are set in the admin (User rate limits).
+CHAT_ADMISSION = {
+    'ENABLED': os.getenv('CHAT_ADMISSION', 'True') == 'True',
+    'USER_RATE_PER_MINUTE': float(os.getenv('CHAT_USER_RATE_PER_MINUTE', '20')),
+    'USER_BURST': int(os.getenv('CHAT_USER_BURST', '10')),
+    'PROJECT_RATE_PER_MINUTE': float(os.getenv('CHAT_PROJECT_RATE_PER_MINUTE', '30')),
+    'PROJECT_BURST': int(os.getenv('CHAT_PROJECT_BURST', '15')),
+    'MAX_CONCURRENT': int(os.getenv('CHAT_MAX_CONCURRENT', '64')),   # upstream calls in flight, all workers
+    'MAX_QUEUE': int(os.getenv('CHAT_MAX_QUEUE', '128')),            # turns waiting for a slot
+    'MAX_WAIT': float(os.getenv('CHAT_MAX_WAIT', '5')),              # seconds in the queue before a 429
+}
+
+# WebSocket chat at /ws/project/<id>/chat/ (see api/websocket.py); needs the
+# ASGI server from the Procfile, the project page falls back to HTTP otherwise.
+CHAT_WEBSOCKET = {
+    'MAX_PENDING': int(os.getenv('CHAT_WS_MAX_PENDING', '256')),    # tokens buffered for a slow client
+}
+
+# Batch chat endpoint for evaluation runs (see api/batch.py)
+CHAT_BATCH = {
+    'MAX_ITEMS': int(os.getenv('CHAT_BATCH_MAX_ITEMS', '500')),
+    'CONCURRENCY': int(os.getenv('CHAT_BATCH_CONCURRENCY', '8')),            # default workers per batch
+    'MAX_CONCURRENCY': int(os.getenv('CHAT_BATCH_MAX_CONCURRENCY', '32')),   # cap on what a request may ask
+}
+
+# Duplicate chat turns (double submits, client retries) share one upstream
+# call and one saved turn (see api/coalesce.py). Clients can send an
+# Idempotency-Key header to mark retries explicitly.
+COALESCE = {
+    'ENABLED': os.getenv('CHAT_COALESCE', 'True') == 'True',
+    'TTL': int(os.getenv('CHAT_COALESCE_TTL', '60')),                # seconds a keyed turn is replayed
+    'REPLAY_TTL': int(os.getenv('CHAT_COALESCE_REPLAY_TTL', '10')),  # same without an Idempotency-Key
+    'FAILED_TTL': int(os.getenv('CHAT_COALESCE_FAILED_TTL', '5')),   # same for failed turns
+}
+
+# Request/upstream metrics served at /metrics (see api/metrics.py). Workers
+# share them through the coordination cache, so keep it file-based (or
+# another backend every worker sees) when running several gunicorn workers.
+METRICS = {
+    'ENABLED': os.getenv('METRICS_ENABLED', 'True') == 'True',
+    'TOKEN': os.getenv('METRICS_TOKEN', ''),                                # bearer token for scrapers
+    'FLUSH_INTERVAL': float(os.getenv('METRICS_FLUSH_INTERVAL', '5')),     # seconds between snapshots
+}
 
 # ============================================================
 # SECURITY FOR RENDER DEPLOYMENT